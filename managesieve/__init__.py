@@ -13,21 +13,34 @@
     :copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
     :license: GNU Public License v3 (GPLv3)
 """
+import io
+import os
 import re
-import shlex
+import stat
 import logging
+import time
 import socket
 import binascii
+import threading
+import contextlib
+from .metrics import Metrics
 
 try:
     import ssl
     ssl_wrap_socket = ssl.wrap_socket
 except ImportError:
+    ssl = None
     ssl_wrap_socket = socket.ssl
 
 
 log = logging.getLogger(__name__)
 
+# The data exchanged with the server is traced at DEBUG level on its own
+# logger; messages are built only when it is enabled, and long data is cut
+# by _summarize() so that script bodies aren't dumped whole.
+trace = logging.getLogger(__name__ + '.protocol')
+TRACE_LIMIT = 200
+
 
 # All client queries are replied to with either an OK, NO, or BYE response.
 # Each response may be followed by a response code (see Section 1.3) and by a
@@ -38,25 +51,46 @@ log = logging.getLogger(__name__)
 # describe the event in a more detailed machine-parsable fashion.  A response
 # code consists of data inside parentheses in the form of an atom, possibly
 # followed by a space and arguments.
-_response = re.compile(r'''
-                       (?P<status>
-                       OK | NO | BYE
-                       )
-
-                       (?: \s \(
-                           (?P<code>.*)
-                           \)
-                       )?
-
-                       (?: \s
-                       (?P<data>.*)
-                       )?
-                       ''', re.VERBOSE)
+#
+# Responses share these interned status strings.
+_STATUSES = dict((status, intern(status)) for status in ('OK', 'NO', 'BYE'))
 
+# Tokens of a single line of a server response; a literal can only appear at
+# the end of a line, as its data starts after the CRLF.
+#
 # draft-martin-managesieve-04.txt defines the size tag of literals to
 # contain a '+' (plus sign) behind the digits, but timsieved does not
-# send one. Thus we are less strikt here:
-_literal = re.compile(r'\{(?P<size>\d+)\+?\}$')
+# send one. Thus we are less strikt here.
+_token = re.compile(r'''
+                    (?P<space> \x20+ )
+                    | " (?P<quoted> (?: [^"\\\r\n] | \\. )* ) "
+                    | \{ (?P<literal> \d+ ) \+? \} $
+                    | (?P<open> \( )
+                    | (?P<close> \) )
+                    | (?P<atom> [^\x00-\x20"(){}\\\x7f]+ )
+                    | (?P<error> . )
+                    ''', re.VERBOSE)
+
+_quoted_special = re.compile(r'\\(.)')
+
+# Strings sent by the client are quoted when they are short enough and free
+# of the characters a quoted string can't carry (Section 4 of RFC 5804),
+# else sent as literals.
+MAX_QUOTED = 1024
+_unquotable = re.compile(r'[\0\r\n]')
+
+
+def _summarize(value, limit=TRACE_LIMIT):
+    """Return the repr() of `value` for the trace log, cutting strings and
+    lists longer than `limit` bytes or items."""
+    if isinstance(value, list):
+        items = [_summarize(item, limit) for item in value[:limit]]
+        if len(value) > limit:
+            items.append('... %d more' % (len(value) - limit))
+        return '[%s]' % ', '.join(items)
+    if isinstance(value, (str, unicode, bytearray)) and len(value) > limit:
+        return '%r... (%d bytes)' % (value[:limit], len(value))
+    return repr(value)
 
 
 class ManageSieveClientError(Exception): pass
@@ -64,6 +98,7 @@ class EOFFromServer(ManageSieveClientError): pass
 class InvalidResponse(ManageSieveClientError): pass
 class InvalidState(ManageSieveClientError): pass
 class ConnectionError(ManageSieveClientError): pass
+class Timeout(ConnectionError): pass
 
 
 class CommandFailed(ManageSieveClientError):
@@ -74,25 +109,36 @@ class CommandFailed(ManageSieveClientError):
 
 
 class Response(object):
+    """A status response of the server and the data lines before it.
+
+    `text` is decoded from the bytes received when first accessed, so that
+    callers looking at the status only don't pay for it.
+    """
+    __slots__ = ('status', 'code', 'data', '_text', '_raw_text')
 
     # Response status
-    OK = "OK"
-    NO = "NO"
-    BYE = "BYE"
+    OK = _STATUSES['OK']
+    NO = _STATUSES['NO']
+    BYE = _STATUSES['BYE']
 
     def __init__(self, status, code, text, data):
-        self.status = status
+        self.status = _STATUSES.get(status, status)
         self.code = code
-        if text is not None:
-            self.text = unicode(text, 'utf-8', 'replace')
-            self.text = self._clean_string(self.text)
-        else:
-            self.text = text
-        self.data = data[:]
+        self.data = data
+        self._raw_text = text
+        self._text = None
+
+    @property
+    def text(self):
+        if self._raw_text is not None:
+            self._text = self._clean_string(
+                self._raw_text.decode('utf-8', 'replace'))
+            self._raw_text = None
+        return self._text
 
     @property
     def is_ok(self):
-        return self.status == self.OK
+        return self.status is self.OK
 
     def _clean_string(self, string):
         string = string.replace(u"\r\n", u"\n")
@@ -100,8 +146,262 @@ class Response(object):
         return string
 
     def __repr__(self):
-        return "<Response(%r, %r, %r, %r)>" % (self.status, self.code,
-                                               self.text, self.data)
+        return "<Response(%r, %r, %r, %s)>" % (self.status, self.code,
+                                               self.text,
+                                               _summarize(self.data))
+
+
+class ResponseParser(object):
+    """Incremental parser for the responses of a ManageSieve server.
+
+    Data received from the server is passed to `feed()`, in chunks of any
+    size; complete responses are then returned by `next_response()`, which
+    returns None when more data is needed.  The parser never blocks and never
+    reads by itself, so it can be used by both blocking and non-blocking
+    transports.
+
+    Every data line of a response is a list of tokens: atoms and quoted
+    strings are returned as `str`, literals as `bytearray` and parenthesized
+    lists as nested lists.  When the parser is waiting for the data of a
+    literal, `literal_buffer()` returns a writable view of the missing part,
+    so that a transport can receive it in place and report the amount with
+    `literal_received()`.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._pos = 0
+        # tokens of the line being parsed; a line may span several literals
+        self._tokens = []
+        self._stack = []
+        # whether the line starts with an atom, as status responses do
+        self._atom_first = False
+        # the literal being read and the number of bytes read so far
+        self._literal = None
+        self._literal_pos = 0
+        # data lines of the response being parsed
+        self._lines = []
+
+    def feed(self, data):
+        if self._pos:
+            del self._buf[:self._pos]
+            self._pos = 0
+        self._buf += data
+
+    def literal_buffer(self):
+        """Return a view of the missing part of the current literal.
+
+        Returns None unless the parser is waiting for literal data and all
+        the fed data has been consumed.
+        """
+        if self._literal is None or self._pos < len(self._buf) or \
+           self._literal_pos == len(self._literal):
+            return None
+        return memoryview(self._literal)[self._literal_pos:]
+
+    def literal_received(self, count):
+        """Account for `count` bytes written into `literal_buffer()`."""
+        self._literal_pos += count
+
+    def next_response(self):
+        """Return the next complete Response, or None if more data is needed."""
+        while True:
+            item = self.next_item()
+            if item is None:
+                return None
+            elif isinstance(item, Response):
+                item.data = self._lines
+                self._lines = []
+                return item
+            self._lines.append(item)
+
+    def next_item(self):
+        """Return the next data line or Response, or None if incomplete.
+
+        Responses returned by this method carry no data lines.
+        """
+        while True:
+            if self._literal is not None:
+                if not self._fill_literal():
+                    return None
+                self._tokens.append(self._literal)
+                self._literal = None
+
+            buf = self._buf
+            eol = buf.find("\n", self._pos)
+            if eol < 0:
+                return None
+            end = eol
+            if end > self._pos and buf[end - 1] == 13:
+                end -= 1
+            line = str(buf[self._pos:end])
+            self._pos = eol + 1
+            if self._pos == len(buf):
+                del buf[:]
+                self._pos = 0
+
+            if self._tokenize(line):
+                # wait for the data of a literal
+                continue
+
+            tokens = self._tokens
+            atom_first = self._atom_first
+            self._tokens = []
+            self._atom_first = False
+            if self._stack:
+                self._stack = []
+                raise InvalidResponse("Unbalanced parenthesis: %r" % line)
+            if atom_first and tokens and tokens[0] in _STATUSES:
+                return self._make_response(tokens)
+            return tokens
+
+    def _fill_literal(self):
+        """Move buffered data into the current literal; True when complete."""
+        missing = len(self._literal) - self._literal_pos
+        available = min(len(self._buf) - self._pos, missing)
+        if available:
+            view = memoryview(self._literal)
+            view[self._literal_pos:self._literal_pos + available] = \
+                self._buf[self._pos:self._pos + available]
+            self._literal_pos += available
+            self._pos += available
+            missing -= available
+        return missing == 0
+
+    def _tokenize(self, line):
+        """Tokenize a line; return True if it ends with a literal."""
+        tokens = self._stack[-1] if self._stack else self._tokens
+        expect_space = len(tokens) > 0
+        for match in _token.finditer(line):
+            kind = match.lastgroup
+            if kind == 'space':
+                expect_space = False
+                continue
+            elif kind == 'close':
+                if not self._stack:
+                    raise InvalidResponse("Unbalanced parenthesis: %r" % line)
+                self._stack.pop()
+                tokens = self._stack[-1] if self._stack else self._tokens
+                expect_space = True
+                continue
+            elif kind == 'error':
+                raise InvalidResponse("Invalid data in response: %r" % line)
+            elif expect_space:
+                raise InvalidResponse("Missing white space in response: %r" %
+                                      line)
+
+            if not self._tokens:
+                self._atom_first = kind == 'atom'
+
+            if kind == 'atom':
+                tokens.append(match.group('atom'))
+            elif kind == 'quoted':
+                value = match.group('quoted')
+                if '\\' in value:
+                    value = _quoted_special.sub(r'\1', value)
+                tokens.append(value)
+            elif kind == 'open':
+                nested = []
+                tokens.append(nested)
+                self._stack.append(nested)
+                tokens = nested
+                expect_space = False
+                continue
+            elif kind == 'literal':
+                self._literal = bytearray(int(match.group('literal')))
+                self._literal_pos = 0
+                return True
+            expect_space = True
+        return False
+
+    def _make_response(self, tokens):
+        status = tokens[0]
+        code = None
+        text = None
+        rest = tokens[1:]
+        if rest and isinstance(rest[0], list):
+            code = ' '.join(str(t) for t in rest.pop(0)
+                            if not isinstance(t, list))
+        if rest:
+            if len(rest) > 1 or isinstance(rest[0], list):
+                raise InvalidResponse("Invalid %s response: %r" %
+                                      (status, tokens))
+            text = rest[0]
+        return Response(status, code, text, [])
+
+
+# TLS
+#
+# Connections share one SSLContext per (keyfile, certfile) pair, so that
+# certificates are loaded once per process. TLS sessions are not resumed:
+# the ssl module of Python 2.7 can't hand a session from one connection to
+# the next, every connection makes a full handshake.
+
+_ssl_contexts = {}
+_ssl_lock = threading.Lock()
+
+
+def create_ssl_context(keyfile=None, certfile=None):
+    """Return a new SSLContext configured for ManageSieve clients.
+
+    Like `ssl.wrap_socket`, used up to 0.4.4, the context does not verify
+    the server certificate; install a context that does with
+    `set_ssl_context()`.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+def get_ssl_context(keyfile=None, certfile=None):
+    """Return the SSLContext shared by connections using `keyfile` and
+    `certfile`, creating it on first use.
+
+    Returns None if the ssl module has no SSLContext.
+    """
+    if not hasattr(ssl, 'SSLContext'):
+        return None
+    with _ssl_lock:
+        context = _ssl_contexts.get((keyfile, certfile))
+        if context is None:
+            context = create_ssl_context(keyfile, certfile)
+            _ssl_contexts[(keyfile, certfile)] = context
+        return context
+
+
+def set_ssl_context(context, keyfile=None, certfile=None):
+    """Use `context` for the connections using `keyfile` and `certfile`."""
+    with _ssl_lock:
+        _ssl_contexts[(keyfile, certfile)] = context
+
+
+def wrap_tls(sock, host, keyfile=None, certfile=None,
+             do_handshake_on_connect=True):
+    """Start TLS on `sock`, connected to the server `host`."""
+    context = get_ssl_context(keyfile, certfile)
+    if context is None:
+        return ssl_wrap_socket(sock, keyfile, certfile)
+    kwargs = {}
+    if getattr(ssl, 'HAS_SNI', False):
+        kwargs['server_hostname'] = host
+    return context.wrap_socket(
+        sock, do_handshake_on_connect=do_handshake_on_connect, **kwargs)
+
+
+# Python 2 reports TLS reads that timed out with an SSLError rather than
+# socket.timeout; they are turned into socket.timeout so that they are
+# handled like the timeouts of plain connections.
+_SSLError = getattr(ssl, 'SSLError', socket.error)
+
+
+def _tls_timeout(error):
+    """Return socket.timeout if the SSLError `error` is a timeout, else
+    None."""
+    if 'timed out' in str(error):
+        return socket.timeout(*error.args)
+    return None
 
 
 class SSLFakeSocket:
@@ -113,43 +413,583 @@ class SSLFakeSocket:
         self.realsock = realsock
         self.sslobj = sslobj
 
-    def send(self, str):
-        self.sslobj.write(str)
-        return len(str)
-
-    sendall = send
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def sendall(self, data):
+        # SSLObject.write() may accept less than the whole buffer; keep
+        # writing from a view of the remaining data to avoid copies.
+        view = memoryview(data)
+        while len(view):
+            try:
+                written = self.sslobj.write(view)
+            except _SSLError, e:
+                raise _tls_timeout(e) or e
+            view = view[written:]
+
+    def settimeout(self, timeout):
+        if hasattr(self.sslobj, 'settimeout'):
+            self.sslobj.settimeout(timeout)
+        else:
+            self.realsock.settimeout(timeout)
 
     def close(self):
         self.realsock.close()
 
 
-class SSLFakeFile:
-    """A fake file like object that really wraps a SSLObject.
+class SocketFile:
+    """A buffered, read-only file like object on top of a socket.
+
+    Data is read from the socket in chunks of `bufsize` bytes into an
+    internal buffer; both `readline()` and `read()` are served from that
+    buffer, while `readinto()` lets large reads go straight from the socket
+    into a caller supplied buffer.
 
     It only supports what is needed in managesieve.
     """
-    def __init__(self, sslobj):
-        self.sslobj = sslobj
+    bufsize = 16384
+
+    def __init__(self, sock):
+        self.sock = sock
+        self._buf = bytearray()
+        self._pos = 0
+
+    def _recv(self, size):
+        return self.sock.recv(size)
+
+    def _recv_into(self, view):
+        return self.sock.recv_into(view)
+
+    def _fill(self):
+        """Append a chunk of data to the buffer; return False on EOF."""
+        chunk = self._recv(self.bufsize)
+        if not chunk:
+            return False
+        if self._pos:
+            # discard the data already consumed
+            del self._buf[:self._pos]
+            self._pos = 0
+        self._buf += chunk
+        return True
+
+    def _consume(self, size):
+        end = self._pos + size
+        data = str(self._buf[self._pos:end])
+        self._skip(size)
+        return data
+
+    def _skip(self, size):
+        self._pos += size
+        if self._pos >= len(self._buf):
+            del self._buf[:]
+            self._pos = 0
 
     def readline(self):
-        str = ""
-        chr = None
-        while chr != "\n":
-            chr = self.sslobj.read(1)
-            str += chr
-        return str
+        scanned = 0
+        while True:
+            idx = self._buf.find("\n", self._pos + scanned)
+            if idx >= 0:
+                return self._consume(idx + 1 - self._pos)
+            scanned = len(self._buf) - self._pos
+            if not self._fill():
+                return self._consume(scanned)
 
     def read(self, size=0):
-        if size == 0:
+        if size <= 0:
             return ''
-        else:
-            return self.sslobj.read(size)
+
+        available = len(self._buf) - self._pos
+        if available >= size:
+            return self._consume(size)
+
+        chunks = [self._consume(available)]
+        size -= available
+        while size > 0:
+            chunk = self._recv(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return ''.join(chunks)
+
+    def read1(self, size):
+        """Return buffered data, or the result of a single receive."""
+        available = len(self._buf) - self._pos
+        if available:
+            return self._consume(min(size, available))
+        return self._recv(size)
+
+    def readinto(self, buf):
+        """Fill the writable buffer `buf`, returning the number of bytes read.
+
+        Buffered data is copied first, the rest is received directly into
+        `buf`; the result is less than ``len(buf)`` only at end of file.
+        """
+        view = memoryview(buf)
+        size = len(view)
+        available = min(len(self._buf) - self._pos, size)
+        if available:
+            view[:available] = self._buf[self._pos:self._pos + available]
+            self._skip(available)
+
+        nread = available
+        while nread < size:
+            count = self._recv_into(view[nread:])
+            if not count:
+                break
+            nread += count
+        return nread
+
+    def readinto1(self, buf):
+        """Like `readinto()`, but with at most a single receive; returns 0
+        only at end of file."""
+        view = memoryview(buf)
+        available = min(len(self._buf) - self._pos, len(view))
+        if available:
+            view[:available] = self._buf[self._pos:self._pos + available]
+            self._skip(available)
+            return available
+        return self._recv_into(view)
 
     def close(self):
         pass
 
 
-class ManageSieveClient(object):
+class SSLFakeFile(SocketFile):
+    """A fake file like object that really wraps a SSLObject.
+
+    It only supports what is needed in managesieve.
+    """
+    # A TLS record can carry at most 16KB of plaintext
+    bufsize = 16384
+
+    def __init__(self, sslobj):
+        SocketFile.__init__(self, sslobj)
+        self.sslobj = sslobj
+
+    def _recv(self, size):
+        try:
+            return self.sslobj.read(size)
+        except _SSLError, e:
+            raise _tls_timeout(e) or e
+
+    def _recv_into(self, view):
+        try:
+            return self.sslobj.recv_into(view)
+        except _SSLError, e:
+            raise _tls_timeout(e) or e
+
+
+class FileLiteral(object):
+    """A literal whose data is read from a file while it is sent.
+
+    The data is read from the open file `fd`, from its current position to
+    the end, or from the file at `path`, which is opened only while the
+    literal is sent, so that queuing many literals doesn't hold a file
+    descriptor each. The size of the literal is given by fstat() or stat();
+    the data is never loaded in memory as a whole. Only regular files can
+    be streamed, see `streamable()`.
+    """
+    chunk_size = 65536
+
+    def __init__(self, fd=None, close=False, sync=False, path=None):
+        self.fd = fd
+        self.path = path
+        self.close = close
+        self.sync = sync
+        if fd is not None:
+            self.name = fd.name
+            self.offset = fd.tell()
+            self.size = os.fstat(fd.fileno()).st_size - self.offset
+        else:
+            self.name = path
+            self.offset = 0
+            self.size = os.stat(path).st_size
+
+    def __len__(self):
+        return self.size
+
+    def read(self):
+        """Return the data as a whole, for transports that can't stream."""
+        self._open()
+        try:
+            data = self.fd.read(self.size)
+        finally:
+            self._done()
+        if len(data) != self.size:
+            raise ConnectionError("%s changed while being sent" % self.name)
+        return data
+
+    def send(self, sock, head, tail):
+        """Send `head`, the data and `tail` to `sock`, in chunks read into
+        a single buffer; `head` and `tail` are sent with the first and last
+        chunk.
+
+        The file is not mapped in memory: a file truncated while mapped
+        kills the process with SIGBUS, while a short read is reported with
+        ConnectionError. Part of the literal may have been sent by then, so
+        the connection can't be used any longer.
+        """
+        self._open()
+        try:
+            self._send_chunks(sock, head, tail)
+        finally:
+            self._done()
+
+    def _send_chunks(self, sock, head, tail):
+        buf = bytearray(len(head) + min(self.size, self.chunk_size) +
+                        len(tail))
+        view = memoryview(buf)
+        view[:len(head)] = head
+        start = len(head)
+        left = self.size
+        while True:
+            count = min(left, len(buf) - start - len(tail))
+            end = start
+            while end < start + count:
+                read = self.fd.readinto(view[end:start + count])
+                if not read:
+                    raise ConnectionError("%s changed while being sent" %
+                                          self.name)
+                end += read
+            left -= count
+            if not left:
+                view[end:end + len(tail)] = tail
+                sock.sendall(view[:end + len(tail)])
+                return
+            sock.sendall(view[:end])
+            start = 0
+
+    def _open(self):
+        if self.path is not None:
+            self.fd = open(self.path, 'rb')
+
+    def _done(self):
+        if self.close or self.path is not None:
+            self.fd.close()
+
+
+def streamable(fd):
+    """Return whether the file object `fd` can be sent as a FileLiteral:
+    a plain file reading the bytes of a regular file.
+
+    Other file objects with a descriptor, like gzip files or pipes, must be
+    read through their own read().
+    """
+    if not isinstance(fd, (file, io.FileIO, io.BufferedReader)):
+        return False
+    try:
+        return stat.S_ISREG(os.fstat(fd.fileno()).st_mode)
+    except (IOError, OSError, ValueError):
+        return False
+
+
+class Command(object):
+    """A command to be sent to the server.
+
+    `args` are joined to the command name on the first line, while each item
+    of `lines` is sent on a line of its own; an argument may be a tuple of
+    strings, sent one after the other, so that literals aren't copied before
+    the whole command is.  A FileLiteral `literal` is sent after `args`,
+    streamed from its file.  `handler` is called with the
+    Response of the command and returns the result of the command, raising
+    CommandFailed when the server refused it; by default the Response itself
+    is returned when its status is OK.  `challenge`, for the SASL exchanges
+    of AUTHENTICATE, is called with each data line the server sends before
+    its response and returns the encoded line to send back.
+    """
+
+    def __init__(self, name, args=(), lines=(), handler=None, literal=None,
+                 challenge=None):
+        self.name = name
+        self.args = args
+        self.lines = lines
+        self.handler = handler
+        self.literal = literal
+        self.challenge = challenge
+
+    def encode(self):
+        """Return the whole command, built with a single copy of its
+        arguments."""
+        if self.literal is not None:
+            return "%s%s\r\n" % (self.encode_head(), self.literal.read())
+        return ''.join(self._all_parts())
+
+    def size(self):
+        """Return the number of bytes `send()` sends, without encoding the
+        command."""
+        if self.literal is not None:
+            return len(self.encode_head()) + len(self.literal) + 2
+        return sum(len(part) for part in self._all_parts())
+
+    def _all_parts(self):
+        parts = self._parts()
+        parts.append("\r\n")
+        for line in self.lines:
+            self._add(parts, line)
+            parts.append("\r\n")
+        return parts
+
+    def encode_head(self):
+        """Return the command up to its FileLiteral, if any."""
+        if self.literal is None:
+            return self.encode()
+        parts = self._parts()
+        parts.append(" {%d%s}\r\n" % (len(self.literal),
+                                        '' if self.literal.sync else '+'))
+        return ''.join(parts)
+
+    def _parts(self):
+        parts = [self.name]
+        for arg in self.args:
+            if arg:
+                parts.append(' ')
+                self._add(parts, arg)
+        return parts
+
+    def _add(self, parts, arg):
+        if isinstance(arg, tuple):
+            parts.extend(arg)
+        else:
+            parts.append(arg)
+
+    def send(self, sock):
+        """Send the command to `sock`, streaming its literal; return the
+        number of bytes sent."""
+        if self.literal is None:
+            data = self.encode()
+            sock.sendall(data)
+            return len(data)
+        head = self.encode_head()
+        self.literal.send(sock, head, "\r\n")
+        return len(head) + len(self.literal) + 2
+
+    def finish(self, response):
+        if self.handler is not None:
+            return self.handler(response)
+        if response.status != Response.OK:
+            raise CommandFailed(self.name, response, response.text)
+        return response
+
+    def __repr__(self):
+        return "<Command(%r)>" % self.name
+
+
+class PipelineResult(object):
+    """The outcome of a command sent through a Pipeline.
+
+    `value` is what the corresponding ManageSieveClient method would have
+    returned, while `error` is the exception it would have raised, if any;
+    `response` is None when the command got no response at all.
+    """
+
+    def __init__(self, command, response=None, value=None, error=None):
+        self.command = command
+        self.response = response
+        self.value = value
+        self.error = error
+
+    @property
+    def is_ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "<PipelineResult(%r, %r, %r)>" % (self.command.name,
+                                                 self.response, self.error)
+
+
+class Pipeline(object):
+    """Send several commands in one write and collect their responses.
+
+    Commands are queued by calling the methods named after the ones of
+    ManageSieveClient and are sent when `execute()` is called; the server
+    processes them in order, so a failed command doesn't stop the following
+    ones.  If the server says BYE or the connection is lost, the commands
+    left get an error as their result.
+
+    Commands are sent ahead of their responses within a window of at most
+    `max_in_flight` commands and `max_in_flight_bytes` bytes: were they all
+    written first, a server blocked writing responses that are not read yet
+    would stop reading commands, and both sides would wait forever. A
+    command larger than the window is sent once the responses before it
+    have been read.
+    """
+    max_in_flight = 64
+    max_in_flight_bytes = 32768
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def _queue(self, command):
+        self.client._check_state(command.name)
+        self.commands.append(command)
+        return self
+
+    def capability(self):
+        return self._queue(self.client._capability_command())
+
+    def noop(self, tag=None):
+        return self._queue(self.client._noop_command(tag))
+
+    def list_scripts(self):
+        return self._queue(self.client._list_scripts_command())
+
+    def get_script(self, name, decode=True):
+        return self._queue(self.client._get_script_command(name, decode))
+
+    def put_script(self, name, data=None, path=None):
+        return self._queue(self.client._put_script_command(name, data, path))
+
+    def set_active(self, name):
+        return self._queue(self.client._set_active_command(name))
+
+    def delete_script(self, name):
+        return self._queue(self.client._delete_script_command(name))
+
+    def rename_script(self, old_name, new_name):
+        return self._queue(self.client._rename_script_command(old_name,
+                                                              new_name))
+
+    def have_space(self, name, size):
+        return self._queue(self.client._have_space_command(name, size))
+
+    def execute(self):
+        """Send the queued commands; return a list of PipelineResult."""
+        return list(self.iter_execute())
+
+    def iter_execute(self):
+        """Send the queued commands and yield a PipelineResult for each
+        command as soon as its response has been read.
+
+        Until the iteration is over, other commands of the client raise
+        InvalidState. When it is left early, the commands not sent yet are
+        dropped and the responses of the others are read and discarded; if
+        that fails the client is left `unusable`.
+        """
+        commands, self.commands = self.commands, []
+        client = self.client
+        if trace.isEnabledFor(logging.DEBUG):
+            trace.debug("Sending %d pipelined commands: %s", len(commands),
+                        _summarize([command.encode_head()
+                                    for command in commands]))
+
+        error = None
+        # the bytes sent for each command sent so far, and when
+        sizes = []
+        started = []
+        # the number of responses read
+        done = 0
+        client._reserve("the responses of a pipeline")
+        try:
+            for i, command in enumerate(commands):
+                if error is None:
+                    received = client._received
+                    try:
+                        if len(sizes) < len(commands):
+                            # nothing is pending when the window is empty
+                            client._arm(idle=len(sizes) == i)
+                            self._send(client.socket, commands, i, sizes,
+                                       started)
+                        received = client._received
+                        response = client._read_response()
+                    except socket.timeout:
+                        error = client._timed_out()
+                    except (socket.error, OSError), e:
+                        error = ConnectionError("Socket error: %s" % e)
+                        client._give_up(error)
+                    except Timeout, e:
+                        error = e
+                    except (ConnectionError, EOFFromServer,
+                            InvalidResponse), e:
+                        client._give_up(e)
+                        error = e
+                    if error is not None and i < len(sizes):
+                        client._record(command, started[i], sizes[i],
+                                       received, error=error)
+
+                if error is not None:
+                    yield PipelineResult(command, error=error)
+                    continue
+
+                # the latency of a pipelined command is the time from its
+                # being sent to its response
+                done = i + 1
+                client._record(command, started[i], sizes[i], received,
+                               response)
+                result = PipelineResult(command, response)
+                try:
+                    result.value = command.finish(response)
+                except ManageSieveClientError, e:
+                    result.error = e
+                if response.status == Response.BYE:
+                    error = ConnectionError("Server closed the connection: "
+                                            "%s" % response.text)
+                yield result
+        finally:
+            if error is None and done < len(sizes):
+                self._discard_responses(len(sizes) - done)
+            client._busy = None
+
+    def _send(self, sock, commands, first, sizes, started):
+        """Send the commands following those already sent as long as the
+        window allows, with as few writes as possible; commands with a
+        FileLiteral are streamed on their own.
+
+        `first` is the first command whose response hasn't been read; the
+        number of bytes sent for each command is appended to `sizes`, the
+        time it was sent to `started`.
+        """
+        in_flight = sum(sizes[first:])
+        pending = []
+        while len(sizes) < len(commands):
+            count = len(sizes) - first
+            if count >= self.max_in_flight:
+                break
+            command = commands[len(sizes)]
+            size = command.size()
+            if count and in_flight + size > self.max_in_flight_bytes:
+                break
+            if command.literal is None:
+                pending.append(command.encode())
+            else:
+                if pending:
+                    sock.sendall(''.join(pending))
+                    pending = []
+                command.send(sock)
+            sizes.append(size)
+            started.append(time.time())
+            in_flight += size
+        if pending:
+            sock.sendall(''.join(pending))
+
+    def _discard_responses(self, count):
+        """Read and drop the responses of `count` commands, so that the
+        session stays in step with the server."""
+        client = self.client
+        try:
+            for i in range(count):
+                client._read_response()
+        except socket.timeout:
+            client._timed_out()
+        except (socket.error, OSError), e:
+            client._give_up(ConnectionError("Socket error: %s" % e))
+        except ManageSieveClientError, e:
+            client._give_up(e)
+
+
+class ManageSieveProtocol(object):
+    """The protocol logic shared by the ManageSieve clients.
+
+    This class keeps the session state and the server capabilities, builds
+    the Command objects and parses the responses, but does no I/O: the
+    subclasses send the encoded commands and feed the data received from the
+    server to `self._parser`.
+    """
 
     COMMAND_STATES = {
         'STARTTLS': ('NONAUTH',),
@@ -163,61 +1003,92 @@ class ManageSieveClient(object):
         'LISTSCRIPTS': ('AUTH',),
         'HAVESPACE': ('AUTH',),
         'RENAMESCRIPT': ('AUTH',),
+        'NOOP': ('NONAUTH', 'AUTH'),
     }
 
+    # RFC 5804 clients send non-synchronizing literals, {n+}; servers
+    # predating it may only accept the {n} form. They never ask the client
+    # to wait for a continuation, so the data follows right away either way.
+    sync_literals = False
+
+    # A managesieve.sieve.Validator, checking scripts before PUTSCRIPT
+    validator = None
+
+    # A managesieve.scram.ScramKeyCache, to skip deriving the SCRAM keys
+    # again when logging in with the same password
+    scram_keys = None
+
     AUTH_PLAIN = "PLAIN"
     AUTH_LOGIN = "LOGIN"
+    AUTH_SCRAM_SHA_1 = "SCRAM-SHA-1"
+    AUTH_SCRAM_SHA_256 = "SCRAM-SHA-256"
     # authentication mechanisms currently supported
     # in order of preference
-    AUTHMECHS = [AUTH_PLAIN, AUTH_LOGIN]
-
-    def __init__(self, host, port, use_tls=True, keyfile=None, certfile=None):
-        self.host = host
-        self.port = port
-        self.use_tls = use_tls
-        self.keyfile = keyfile
-        self.certfile = certfile
+    AUTHMECHS = [AUTH_SCRAM_SHA_256, AUTH_SCRAM_SHA_1, AUTH_PLAIN, AUTH_LOGIN]
 
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.fd = self.socket.makefile('rw')
+    def __init__(self):
+        self._parser = ResponseParser()
 
         self.state = 'NONAUTH'
 
+        self.raw_capabilities = []
         self.capabilities = []
         self.tls_support = False
         self.login_mechs = []
         self.implementation = None
 
-
-    def connect(self):
-        self.socket.connect((self.host, self.port))
-        log.debug("Connected to remote server %s:%d" % (self.host, self.port))
-        response = self._read_response()
-        if response.status == Response.OK:
-            self._parse_capabilities(response.data)
-
-            if self.use_tls and self.tls_support:
-                response_tls = self.starttls(self.keyfile, self.certfile)
-        else:
+    def _greeting(self, response):
+        if response.status != Response.OK:
             raise InvalidResponse("Server responded with %s, expected OK; %r" %
                                   (response.status, response))
+        self._parse_capabilities(response.data)
+        return response
 
-    def authenticate(self, mechanism, *auth_objects):
+    def _login_mechanism(self, auth, user, password):
+        """Return the arguments of `authenticate()` for `login()`."""
+        for mechanism in self.AUTHMECHS:
+            if mechanism in self.login_mechs:
+                if mechanism == self.AUTH_LOGIN:
+                    auth_objects = [user, password]
+                else:
+                    auth_objects = [auth, user, password]
+                return [mechanism] + auth_objects
+        raise ManageSieveClientError("No matching authentication mechanism "
+                                     "found")
+
+    def _authenticate_command(self, mechanism, *auth_objects):
         mechanism = mechanism.upper()
         if not mechanism in self.login_mechs:
             raise ManageSieveClientError("Server doesn't allow %s "
                                          "authentication" % mechanism)
 
+        exchange = None
+        challenge = None
         if mechanism == self.AUTH_LOGIN:
             auth_objects = [self._sieve_name(binascii.b2a_base64(ao)[:-1])
                             for ao in auth_objects]
 
+        elif mechanism in (self.AUTH_SCRAM_SHA_1, self.AUTH_SCRAM_SHA_256):
+            from .scram import ScramClient
+            if len(auth_objects) < 3:
+                auth_objects = ('',) + tuple(auth_objects)
+            authzid, user, password = auth_objects
+            exchange = ScramClient(mechanism, user, password, authzid,
+                                   self.scram_keys)
+            auth_objects = [self._sieve_string(
+                binascii.b2a_base64(exchange.first())[:-1])]
+
+            def challenge(tokens):
+                data = self._sasl_decode(str(tokens[0]))
+                return self._sieve_string(
+                    binascii.b2a_base64(exchange.respond(data))[:-1])
+
         elif mechanism == self.AUTH_PLAIN:
             if len(auth_objects) < 3:
                 # assume authorization identity (authzid) is missing
                 # and these two authobjects are username and password
-                auth_objects.insert(0, '')
-            ao = '\0'.join(auth_objects)
+                auth_objects = ('',) + tuple(auth_objects)
+            ao = '\0'.join([a or '' for a in auth_objects])
             ao = binascii.b2a_base64(ao)[:-1]
             auth_objects = [ self._sieve_string(ao) ]
 
@@ -225,138 +1096,158 @@ class ManageSieveClient(object):
             raise ManageSieveClientError("Unsupported authentication: %s" %
                                          mechanism)
 
-        response = self._send_command("AUTHENTICATE",
-                                     self._sieve_name(mechanism),
-                                     *auth_objects)
-        if response.status == Response.OK:
-            log.debug("Authenticated")
-            self.state = "AUTH"
-        else:
-            log.error("Authentication failed")
-
-        return response
-
-    def login(self, auth, user, password):
-        for mechanism in self.AUTHMECHS:
-            if mechanism in self.login_mechs:
-                if mechanism == self.AUTH_LOGIN:
-                    auth_objects = [user, password]
-                else:
-                    auth_objects = [auth, user, password]
-                return self.authenticate(mechanism, *auth_objects)
-        raise ManageSieveClientError("No matching authentication mechanism "
-                                     "found")
+        def handler(response):
+            if response.status == Response.OK:
+                if exchange is not None and not exchange.done:
+                    # the server signature comes with OK, unless it was sent
+                    # as a last challenge
+                    code = response.code or ''
+                    if not code.upper().startswith('SASL '):
+                        from .scram import ScramError
+                        raise ScramError("The server sent no signature")
+                    exchange.verify(self._sasl_decode(code[5:]))
+                log.debug("Authenticated")
+                self.state = "AUTH"
+            else:
+                log.error("Authentication failed")
+            return response
+        return Command("AUTHENTICATE",
+                       (self._sieve_name(mechanism), auth_objects[0]),
+                       auth_objects[1:], handler=handler,
+                       challenge=challenge)
 
-    def logout(self):
-        self._send_command("LOGOUT")
-        self.fd.close()
-        self.socket.close()
+    def _sasl_decode(self, data):
+        try:
+            return binascii.a2b_base64(data)
+        except binascii.Error, e:
+            raise InvalidResponse("Invalid SASL data %r: %s" % (data, e))
+
+    def _starttls_command(self):
+        def handler(response):
+            if response.status != Response.OK:
+                raise InvalidResponse("Server responded %s at STARTTLS "
+                                      "command, expected OK; %r" %
+                                      (response.status, response))
+            return response
+        return Command("STARTTLS", handler=handler)
 
-    def starttls(self, keyfile=None, certfile=None):
-        response = self._send_command("STARTTLS")
-        if response.status == Response.OK:
-            ssl_obj = ssl_wrap_socket(self.socket, keyfile, certfile)
-            self.socket = SSLFakeSocket(self.socket, ssl_obj)
-            self.fd = SSLFakeFile(ssl_obj)
-            self._reset_capabilities()
-
-            # qui il server rimanda le capabilities...
-            response_tls = self._read_response()
-            # ma pare che alcuni server non lo facciano, quindi vanno richieste
-            # di nuovo
-            self.capability()
-            log.debug("Started TLS session")
-        else:
-            raise InvalidResponse("Server responded %s at STARTTLS command, "
-                                  "expected OK; %r" %
-                                  (response.status, response))
-        return response
+    def _logout_command(self):
+        def handler(response):
+            self.state = 'LOGOUT'
+            return response
+        return Command("LOGOUT", handler=handler)
 
-    def capability(self):
-        response = self._send_command("CAPABILITY")
-        if response.status == Response.OK:
+    def _capability_command(self):
+        def handler(response):
+            if response.status != Response.OK:
+                raise CommandFailed("CAPABILITY", response, response.text)
             self._parse_capabilities(response.data)
-        else:
-            raise CommandFailed("CAPABILITY", response, response.text)
-        return response
+            return response
+        return Command("CAPABILITY", handler=handler)
 
-    def list_scripts(self):
-        response = self._send_command('LISTSCRIPTS')
-        if response.status == Response.OK:
+    def _noop_command(self, tag=None):
+        if tag is not None:
+            tag = self._sieve_name(tag)
+        return Command("NOOP", (tag,))
+
+    def _list_scripts_command(self):
+        def handler(response):
+            if response.status != Response.OK:
+                raise CommandFailed("LISTSCRIPTS", response, response.text)
             scripts = []
-            for token in response.data:
-                if not len(token):
-                    continue
-                script_name = unicode(token[0], 'utf-8', 'replace')
-                script_active = True if len(token) > 1 else False
-                scripts.append((script_name, script_active))
+            for tokens in response.data:
+                if len(tokens):
+                    scripts.append(self._script_entry(tokens))
             return scripts
-        else:
-            raise CommandFailed("LISTSCRIPTS", response, response.text)
-
-    def get_script(self, name):
+        return Command("LISTSCRIPTS", handler=handler)
+
+    def _script_entry(self, tokens):
+        """Return the (name, active) pair of a LISTSCRIPTS data line."""
+        return tokens[0].decode('utf-8', 'replace'), len(tokens) > 1
+
+    def _get_script_command(self, name, decode=True):
+        def handler(response):
+            if response.status != Response.OK:
+                raise CommandFailed("GETSCRIPT", response, response.text)
+            script_data = response.data[0][0]
+            if not decode:
+                if not isinstance(script_data, bytearray):
+                    # small scripts may be sent as quoted strings
+                    script_data = bytearray(script_data)
+                return script_data
+            script_data = script_data.decode('utf-8', 'replace')
+            return script_data.rstrip(u"\n")
         name = name.encode('utf-8', 'replace')
-        response = self._send_command("GETSCRIPT", self._sieve_name(name))
-        if response.status != Response.OK:
-            raise CommandFailed("GETSCRIPT", response, response.text)
-        script_data = unicode(response.data[0], 'utf-8', 'replace')
-        script_data = script_data.rstrip(u"\n")
-        return script_data
-
-    def put_script(self, name, data):
+        return Command("GETSCRIPT", (self._sieve_name(name),),
+                       handler=handler)
+
+    def _put_script_command(self, name, data=None, path=None):
+        if hasattr(data, 'read') and not streamable(data):
+            data = data.read()
+        if self.validator is not None:
+            self._validate_script(name, data, path)
         name = name.encode('utf-8', 'replace')
         script_name = self._sieve_name(name)
-        script_data = self._sieve_string(data.encode('utf-8', 'replace'))
-        response = self._send_command("PUTSCRIPT", script_name, script_data)
-        if response.status != Response.OK:
-            raise CommandFailed("PUTSCRIPT", response, response.text)
+        if path is not None:
+            literal = FileLiteral(path=path, sync=self.sync_literals)
+            return Command("PUTSCRIPT", (script_name,), literal=literal)
+        if hasattr(data, 'read'):
+            return Command("PUTSCRIPT", (script_name,),
+                           literal=FileLiteral(data, sync=self.sync_literals))
+        if isinstance(data, unicode):
+            data = data.encode('utf-8', 'replace')
+        script_data = self._sieve_string(data)
+        return Command("PUTSCRIPT", (script_name, script_data))
+
+    def _validate_script(self, name, data, path):
+        """Check a script with the validator, against the SIEVE
+        capabilities of the server when known."""
+        extensions = self.capabilities or None
+        if path is not None:
+            self.validator.check_file(path, extensions)
+            return
+        if hasattr(data, 'read'):
+            position = data.tell()
+            script = data.read()
+            data.seek(position)
         else:
-            return response
+            script = data
+        try:
+            self.validator.check(script, extensions)
+        except ManageSieveClientError, e:
+            e.filename = name
+            raise
 
-    def set_active(self, name):
+    def _set_active_command(self, name):
         name = name.encode('utf-8', 'replace')
-        script_name = self._sieve_name(name)
-        response = self._send_command("SETACTIVE", script_name)
-        if response.status != Response.OK:
-            raise CommandFailed("PUTSCRIPT", response, response.text)
-        else:
-            return response
+        return Command("SETACTIVE", (self._sieve_name(name),))
 
-    def delete_script(self, name):
+    def _delete_script_command(self, name):
         name = name.encode('utf-8', 'replace')
-        script_name = self._sieve_name(name)
-        response = self._send_command("DELETESCRIPT", script_name)
-        if response.status != Response.OK:
-            raise CommandFailed("DELETESCRIPT", response, response.text)
-        else:
-            return response
+        return Command("DELETESCRIPT", (self._sieve_name(name),))
 
-    def rename_script(self, old_name, new_name):
-        old_name = old_name.encode('utf-8', 'replace')
-        new_name = new_name.encode('utf-8', 'replace')
-        old_name = self._sieve_name(old_name)
-        new_name = self._sieve_name(new_name)
-        response = self._send_command("RENAMESCRIPT", old_name, new_name)
-        if response.status != Response.OK:
-            raise CommandFailed("RENAMESCRIPT", response, response.text)
-        else:
-            return response
+    def _rename_script_command(self, old_name, new_name):
+        old_name = self._sieve_name(old_name.encode('utf-8', 'replace'))
+        new_name = self._sieve_name(new_name.encode('utf-8', 'replace'))
+        return Command("RENAMESCRIPT", (old_name, new_name))
 
-    def have_space(self, name, size):
+    def _have_space_command(self, name, size):
         name = name.encode('utf-8', 'replace')
-        script_name = self._sieve_name(name)
-        response = self._send_command("HAVESPACE", script_name, "%d" % size)
-        return response
+        # the response is returned as is, NO means there's no space
+        return Command("HAVESPACE", (self._sieve_name(name), "%d" % size),
+                       handler=lambda response: response)
 
     def _parse_capabilities(self, capabilities):
         if not capabilities:
             return
 
+        self.raw_capabilities = [[str(item) for item in cap]
+                                 for cap in capabilities]
         for cap in capabilities:
             if len(cap) >= 2:
-                name, value = cap[0:2]
+                name, value = str(cap[0]), str(cap[1])
             else:
-                name = cap[0]
+                name = str(cap[0])
                 value = None
 
             if name == "IMPLEMENTATION":
@@ -369,92 +1260,465 @@ class ManageSieveClient(object):
                 self.tls_support = True
 
         log.debug("Server capabilities: TLS=%r, login mechs=%r, SIEVE "
-                  "capabilities=%r, IMPLEMENTATION=%s" %
-                  (self.tls_support, self.login_mechs, self.capabilities,
-                   self.implementation))
+                  "capabilities=%r, IMPLEMENTATION=%s", self.tls_support,
+                  self.login_mechs, self.capabilities, self.implementation)
 
     def _sieve_name(self, name):
-        return '"%s"' % name
+        return self._sieve_string(name)
 
     def _sieve_string(self, string):
-        return '{%d+}\r\n%s' % (len(string), string)
+        """Encode a string argument: as a quoted string when possible, else
+        as a literal, returned as a (head, data) tuple for Command."""
+        if isinstance(string, unicode):
+            string = string.encode('utf-8')
+        if len(string) <= MAX_QUOTED and not _unquotable.search(string):
+            try:
+                string.decode('utf-8')
+            except UnicodeDecodeError:
+                pass
+            else:
+                return '"%s"' % (string.replace('\\', '\\\\')
+                                 .replace('"', '\\"'))
+        return self._sieve_literal(string)
+
+    def _sieve_literal(self, string):
+        return ('{%d%s}\r\n' % (len(string),
+                                 '' if self.sync_literals else '+'),
+                string)
 
     def _reset_capabilities(self):
+        self.raw_capabilities = []
         self.implementation = None
         self.login_mechs = []
         self.capabilities = []
         self.tls_support = False
-    
-    def _read_exactly(self, size):
+
+    def _check_state(self, name):
+        if self.state not in self.COMMAND_STATES[name]:
+            raise InvalidState("Command %s illegal in state %s" %
+                               (name, self.state))
+
+    def _next_response(self):
+        """Return the next Response from the parser, or None."""
+        response = self._parser.next_response()
+        if response is not None:
+            self._response_received(response)
+        return response
+
+    def _response_received(self, response):
+        if trace.isEnabledFor(logging.DEBUG):
+            trace.debug("Received response %r", response)
+        if response.status == Response.BYE:
+            # the server is closing the connection
+            self.state = 'LOGOUT'
+
+
+class ManageSieveClient(ManageSieveProtocol):
+    """A blocking ManageSieve client.
+
+    `connect_timeout` bounds the time taken by `connect()`, STARTTLS
+    included; `operation_timeout` bounds each command, from being sent to
+    its response; `timeout` bounds each read from and write to the socket.
+    `deadline()` bounds a series of calls. When a limit is exceeded Timeout
+    is raised and the connection is closed, as it can't be used any longer:
+    `unusable` is then set to the error. So it is after an InvalidResponse,
+    as the rest of the response can't be told from the next one.
+    """
+
+    def __init__(self, host, port, use_tls=True, keyfile=None, certfile=None,
+                 metrics=None, connect_timeout=None, timeout=None,
+                 operation_timeout=None):
+        ManageSieveProtocol.__init__(self)
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.keyfile = keyfile
+        self.certfile = certfile
+        # the commands sent are recorded in `metrics`, which may be shared
+        # with other clients
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._received = 0
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.operation_timeout = operation_timeout
+        self.unusable = None
+        # what is being read while a response is iterated over, keeping
+        # other commands out
+        self._busy = None
+        # absolute times of the deadlines in effect
+        self._deadlines = []
+        self._socket_timeout = None
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.fd = SocketFile(self.socket)
+
+    def connect(self):
+        with self.deadline(self.connect_timeout):
+            try:
+                self._arm()
+                self.socket.connect((self.host, self.port))
+            except socket.timeout:
+                raise self._timed_out()
+            # commands are written whole, don't let Nagle's algorithm hold
+            # back their last segment
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            log.debug("Connected to remote server %s:%d", self.host,
+                      self.port)
+            self._greeting(self._read_response())
+            if self.use_tls and self.tls_support:
+                response_tls = self.starttls(self.keyfile, self.certfile)
+
+    def authenticate(self, mechanism, *auth_objects):
+        return self._run(self._authenticate_command(mechanism, *auth_objects))
+
+    def login(self, auth, user, password):
+        return self.authenticate(*self._login_mechanism(auth, user, password))
+
+    def logout(self):
+        if self.unusable is None:
+            self._run(self._logout_command())
+        self.fd.close()
+        self.socket.close()
+
+    def starttls(self, keyfile=None, certfile=None):
+        response = self._run(self._starttls_command())
+        try:
+            self._arm()
+            ssl_obj = wrap_tls(self.socket, self.host, keyfile, certfile)
+        except socket.timeout:
+            raise self._timed_out()
+        except _SSLError, e:
+            if _tls_timeout(e) is None:
+                raise
+            raise self._timed_out()
+        self.socket = SSLFakeSocket(self.socket, ssl_obj)
+        self.fd = SSLFakeFile(ssl_obj)
+        self._reset_capabilities()
+
+        # the server sends its capabilities again once TLS is established;
+        # ask for them only if it didn't
+        capabilities = self._read_response()
+        self._parse_capabilities(capabilities.data)
+        if not capabilities.data:
+            self.capability()
+        log.debug("Started TLS session")
+        return response
+
+    @contextlib.contextmanager
+    def deadline(self, seconds):
+        """Bound the calls made within a `with` block to `seconds` in all::
+
+            with client.deadline(10):
+                client.put_script(u'rules', data)
+                client.set_active(u'rules')
+
+        Deadlines can be nested, the earliest one applies; a deadline of
+        None doesn't limit anything.
+        """
+        if seconds is None:
+            yield
+            return
+        deadline = time.time() + seconds
+        self._deadlines.append(deadline)
+        try:
+            yield
+        finally:
+            self._deadlines.remove(deadline)
+
+    def pipeline(self):
+        """Return a Pipeline for sending several commands at once."""
+        return Pipeline(self)
+
+    def capability(self):
+        return self._run(self._capability_command())
+
+    def noop(self, tag=None):
+        return self._run(self._noop_command(tag))
+
+    def list_scripts(self):
+        return self._run(self._list_scripts_command())
+
+    def iter_scripts(self):
+        """Yield the (name, active) pair of each script as soon as the
+        server lists it.
+
+        Unlike `list_scripts()` nothing is collected, so memory use doesn't
+        grow with the number of scripts. CommandFailed is raised at the end
+        if the server refuses the command. Until the iteration is over, other
+        commands raise InvalidState; when it is left early, the rest of the
+        list is read and discarded. `operation_timeout` doesn't apply, as
+        the time spent by the caller between entries would count against
+        it.
+        """
+        lines = self._iter_lines(self._list_scripts_command())
+        try:
+            for tokens in lines:
+                if len(tokens):
+                    yield self._script_entry(tokens)
+        finally:
+            for tokens in lines:
+                pass
+
+    def get_script(self, name, decode=True):
+        """Return the content of the script `name`.
+
+        The script is returned as unicode with trailing newlines removed; if
+        `decode` is False the raw bytes are returned untouched, as the
+        `bytearray` the script was read into.
+        """
+        return self._run(self._get_script_command(name, decode))
+
+    def put_script(self, name, data=None, path=None):
+        """Upload a script.
+
+        `data` is the script, as unicode, bytes or a binary file object; or
+        the script is read from the file at `path`. Regular files are
+        streamed, they are never loaded in memory as a whole; other file
+        objects, like pipes or gzip files, are read first.
+
+        With a `validator` set, the script is checked first; an invalid
+        script raises managesieve.sieve.SieveError and nothing is sent.
         """
-        Note that this method may call the underlying C function fread() more
-        than once in an effort to acquire as close to size bytes as possible.
-         """
-        return self.fd.read(size)
+        return self._run(self._put_script_command(name, data, path))
+
+    def set_active(self, name):
+        return self._run(self._set_active_command(name))
+
+    def delete_script(self, name):
+        return self._run(self._delete_script_command(name))
+
+    def rename_script(self, old_name, new_name):
+        return self._run(self._rename_script_command(old_name, new_name))
+
+    def have_space(self, name, size):
+        return self._run(self._have_space_command(name, size))
+
+    def _read_more(self):
+        """Receive more data from the server and pass it to the parser.
+
+        Literal data is received directly into the buffer preallocated by the
+        parser, looping over short reads unless a deadline applies.
+        """
+        self._arm()
+        view = self._parser.literal_buffer()
+        if view is not None:
+            try:
+                if self._deadlines:
+                    # a receive at a time, checking the deadline in between
+                    count = self.fd.readinto1(view)
+                    eof = not count
+                else:
+                    count = self.fd.readinto(view)
+                    eof = count < len(view)
+            except socket.timeout:
+                raise self._timed_out()
+            self._received += count
+            self._parser.literal_received(count)
+            if eof:
+                raise EOFFromServer("Connection closed while reading a "
+                                    "literal")
+        else:
+            try:
+                data = self.fd.read1(self.fd.bufsize)
+            except socket.timeout:
+                raise self._timed_out()
+            if not data:
+                raise EOFFromServer
+            self._received += len(data)
+            if trace.isEnabledFor(logging.DEBUG):
+                trace.debug("Read data: %s", _summarize(data))
+            self._parser.feed(data)
 
     def _read_response(self):
         """Read response data from server"""
-
-        log.debug("Waiting for response")
-        lines = []
         while True:
-            line = self.fd.readline()
-            if not line:
-                raise EOFFromServer
-            line = line.rstrip("\r\n")
-            log.debug("Read line: %r" % line)
-
-            stat_match = _response.match(line)
-            if stat_match:
-                resp = stat_match.groupdict()
-                # Read the response data: can be one of the multiple literal
-                # formats.
-                data = resp.get('data')
-                if data:
-                    data = self._read_text(data)
-                    if isinstance(data, list) or isinstance(data, tuple):
-                        data = data[0]
-                response = Response(resp.get('status'), resp.get('code'), data,
-                                             lines)
-                log.debug("Returning response %r" % response)
+            response = self._next_response()
+            if response is not None:
                 return response
-            else:
-                data = self._read_text(line)
-                lines.append(data)
-
-    def _read_text(self, data):
-        result = None
-
-        lit_match = _literal.match(data)
-        if data.startswith(' '):
-            raise InvalidResponse("Invalid data: unexpected white space")
-        elif data.startswith('"'):
-            result = shlex.split(data)
-        elif lit_match:
-            resp = lit_match.groupdict()
-            size = int(resp.get('size'))
-            buf = self._read_exactly(size)
-            log.debug("Appending buffer %r" % (buf,))
-            result = buf
+            self._read_more()
+
+    def _run(self, command):
+        """Send a Command, wait for its response and return its result."""
+        self._check_state(command.name)
+        if trace.isEnabledFor(logging.DEBUG):
+            trace.debug("Sending command: %s",
+                        _summarize(command.encode_head()))
+        start = time.time()
+        received = self._received
+        sent = 0
+        with self.deadline(self.operation_timeout):
+            try:
+                self._arm(idle=True)
+                sent = command.send(self.socket)
+                if command.challenge is not None:
+                    response = self._sasl_exchange(command)
+                else:
+                    response = self._read_response()
+            except socket.timeout:
+                error = self._timed_out()
+                self._record(command, start, sent, received, error=error)
+                raise error
+            except (socket.error, OSError), e:
+                error = ConnectionError("Socket error: %s" % e)
+                self._give_up(error)
+                self._record(command, start, sent, received, error=error)
+                raise error
+            except Timeout, e:
+                self._record(command, start, sent, received, error=e)
+                raise
+            except (ConnectionError, EOFFromServer, InvalidResponse), e:
+                # a literal was sent in part, the parser is left in the
+                # middle of a line, or the server is gone
+                self._give_up(e)
+                self._record(command, start, sent, received, error=e)
+                raise
+        self._record(command, start, sent, received, response)
+        return command.finish(response)
+
+    def _sasl_exchange(self, command):
+        """Answer the challenges sent by the server for `command` and return
+        its final Response.
+
+        If a challenge can't be answered, the exchange is cancelled with
+        "*" and the error raised once the server confirmed.
+        """
+        while True:
+            item = self._parser.next_item()
+            if item is None:
+                self._read_more()
+                continue
+            if isinstance(item, Response):
+                self._response_received(item)
+                return item
+            try:
+                reply = command.challenge(item)
+            except ManageSieveClientError:
+                self._arm()
+                self.socket.sendall('"*"\r\n')
+                self._read_response()
+                raise
+            if isinstance(reply, tuple):
+                reply = ''.join(reply)
+            self._arm()
+            self.socket.sendall(reply + '\r\n')
+
+    def _iter_lines(self, command):
+        """Send a Command and yield the data lines of its response as they
+        are received, then check its result."""
+        self._check_state(command.name)
+        if trace.isEnabledFor(logging.DEBUG):
+            trace.debug("Sending command: %s",
+                        _summarize(command.encode_head()))
+        start = time.time()
+        received = self._received
+        sent = 0
+        self._reserve("the response of %s" % command.name)
+        try:
+            self._arm(idle=True)
+            sent = command.send(self.socket)
+            while True:
+                item = self._parser.next_item()
+                if item is None:
+                    self._read_more()
+                elif isinstance(item, Response):
+                    break
+                else:
+                    yield item
+        except socket.timeout:
+            error = self._timed_out()
+            self._record(command, start, sent, received, error=error)
+            raise error
+        except (socket.error, OSError), e:
+            error = ConnectionError("Socket error: %s" % e)
+            self._give_up(error)
+            self._record(command, start, sent, received, error=error)
+            raise error
+        except Timeout, e:
+            self._record(command, start, sent, received, error=e)
+            raise
+        except (EOFFromServer, InvalidResponse), e:
+            self._give_up(e)
+            self._record(command, start, sent, received, error=e)
+            raise
+        finally:
+            self._busy = None
+        self._response_received(item)
+        self._record(command, start, sent, received, item)
+        command.finish(item)
+
+    def _check_state(self, name):
+        if self.unusable is not None:
+            raise ConnectionError("The connection is no longer usable: %s" %
+                                  self.unusable)
+        if self._busy is not None:
+            raise InvalidState("Command %s illegal while reading %s" %
+                               (name, self._busy))
+        ManageSieveProtocol._check_state(self, name)
+
+    def _reserve(self, what):
+        """Keep other commands out while `what` is read, until `_busy` is
+        reset."""
+        if self._busy is not None:
+            raise InvalidState("Can't read %s while reading %s" %
+                               (what, self._busy))
+        self._busy = what
+
+    def _arm(self, idle=False):
+        """Set the socket timeout to what is left before the earliest
+        deadline, or to `timeout`.
+
+        Raises Timeout if a deadline has passed; unless `idle` is true, that
+        is while nothing is pending on the connection, it can't be used any
+        longer.
+        """
+        timeout = self.timeout
+        if self._deadlines:
+            left = min(self._deadlines) - time.time()
+            if left <= 0:
+                if idle:
+                    raise Timeout("Deadline exceeded")
+                raise self._timed_out()
+            if timeout is None or left < timeout:
+                timeout = left
+        if timeout != self._socket_timeout:
+            self.socket.settimeout(timeout)
+            self._socket_timeout = timeout
+
+    def _timed_out(self):
+        """Close the connection after a timeout and return the Timeout
+        error to raise.
+
+        Whatever was pending may still arrive, so the connection can't be
+        used for other commands.
+        """
+        error = Timeout("Timed out talking to %s:%s" % (self.host, self.port))
+        self._give_up(error)
+        return error
+
+    def _give_up(self, error):
+        """Close a connection left out of step with the server by `error`;
+        `unusable` is set to it."""
+        self.unusable = error
+        self.state = 'LOGOUT'
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+
+    def _record(self, command, start, sent, received, response=None,
+                error=None):
+        """Add a command to the metrics; `start` is when it was sent and
+        `received` the byte count before its response."""
+        if error is not None:
+            code = error.__class__.__name__
+        elif response.status != Response.OK:
+            code = (response.code or response.status).split(' ', 1)[0]
         else:
-            result = data.split(' ', 1)
-            if len(result) == 1:
-                result.append('')
-
-        return result
+            code = None
+        self.metrics.record('%s:%s' % (self.host, self.port), command.name,
+                            time.time() - start, sent,
+                            self._received - received, code)
 
     def _send_command(self, name, arg1=None, arg2=None, *options):
-        if self.state not in self.COMMAND_STATES[name]:
-            raise InvalidState("Command %s illegal in state %s" %
-                               (name, self.state))
-        line = ' '.join(filter(None, (name, arg1, arg2)))
-        log.debug("Sending command: %r" % line)
-        try:
-            self.socket.send("%s\r\n" % line)
-            for option in options:
-                log.debug("Sending option: %s" % option)
-                self.socket.send("%s\r\n" % option)
-            response = self._read_response()
-        except (socket.error, OSError), e:
-            raise ConnectionError("Socket error: %s" % e)
-        return response
+        return self._run(Command(name, (arg1, arg2), options,
+                                 handler=lambda response: response))
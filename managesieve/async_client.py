@@ -0,0 +1,449 @@
+# -*- coding: utf-8 -*-
+"""
+    managesieve.async_client
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A non-blocking ManageSieve client, driven by an `asyncore` loop, for
+    talking to many servers from a single thread.
+
+    Commands are encoded and responses parsed by the same code used by
+    `ManageSieveClient`; only the transport differs.
+
+    :copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+    :license: GNU Public License v3 (GPLv3)
+"""
+import sys
+import errno
+import socket
+import asyncore
+import logging
+import collections
+from . import (ManageSieveProtocol, Response, ManageSieveClientError,
+               ConnectionError, EOFFromServer, InvalidState, ssl, wrap_tls,
+               trace, _summarize)
+
+
+log = logging.getLogger(__name__)
+
+# socket errors meaning that a non-blocking call should be retried later
+_retry_errors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# returned by a response handler when the operation needs more round trips
+_CONTINUE = object()
+
+
+def run(map=None, timeout=1.0):
+    """Run the `asyncore` loop until every client in `map` is closed.
+
+    poll() is used instead of select(), which can't wait on more than
+    FD_SETSIZE sockets.
+    """
+    asyncore.loop(timeout=timeout, use_poll=True, map=map)
+
+
+class Operation(object):
+    """The eventual outcome of a command of an AsyncManageSieveClient.
+
+    `result()` returns what the corresponding ManageSieveClient method would
+    have returned, or raises what it would have raised.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.done = False
+        self.value = None
+        self.error = None
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        """Call `callback(operation)` once the operation is done."""
+        if self.done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def result(self):
+        if not self.done:
+            raise InvalidState("Operation %s is not done yet" % self.name)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def _complete(self, value=None, error=None):
+        self.done = True
+        self.value = value
+        self.error = error
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.exception("Error in callback of %r", self)
+
+    def __repr__(self):
+        return "<Operation(%r, done=%r)>" % (self.name, self.done)
+
+
+class _Channel(asyncore.dispatcher):
+    """The asyncore side of an AsyncManageSieveClient."""
+
+    def __init__(self, client, map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.client = client
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return not self.connected or self.client._wants_write()
+
+    def handle_connect(self):
+        self.client._connected = True
+        log.debug("Connected to remote server %s:%d", self.client.host,
+                  self.client.port)
+
+    def handle_read(self):
+        self.client._handle_read()
+
+    def handle_write(self):
+        self.client._handle_write()
+
+    def handle_close(self):
+        self.client._abort(EOFFromServer("Connection closed by server"))
+
+    def handle_error(self):
+        error = sys.exc_info()[1]
+        log.debug("Error on connection to %s:%d: %s", self.client.host,
+                  self.client.port, error)
+        if not isinstance(error, ManageSieveClientError):
+            error = ConnectionError("Socket error: %s" % error)
+        self.client._abort(error)
+
+
+class AsyncManageSieveClient(ManageSieveProtocol):
+    """A ManageSieve client for `asyncore` loops.
+
+    Every command method queues the command and returns an Operation at
+    once; the commands of a client are sent one at a time, in order, while
+    the loop runs, so many clients can share a single thread::
+
+        sockets = {}
+        client = AsyncManageSieveClient('example.com', 4190, map=sockets)
+        client.connect()
+        client.login('', 'user', 'secret')
+        scripts = client.list_scripts()
+        client.logout()
+        run(sockets)
+        print scripts.result()
+
+    A command failing doesn't prevent the following ones from being sent.
+    SCRAM authentication, which needs several round trips, is not
+    supported.
+    """
+    bufsize = 16384
+    AUTHMECHS = [ManageSieveProtocol.AUTH_PLAIN,
+                 ManageSieveProtocol.AUTH_LOGIN]
+
+    def __init__(self, host, port, use_tls=True, keyfile=None, certfile=None,
+                 map=None):
+        ManageSieveProtocol.__init__(self)
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.keyfile = keyfile
+        self.certfile = certfile
+        self.map = map
+
+        self._channel = None
+        self._connected = False
+        self._handshaking = False
+        self._handshake_wants_write = False
+        self._outbuf = ''
+        self._outpos = 0
+        # (operation, handler) waiting for a response from the server
+        self._pending = None
+        self._queue = collections.deque()
+
+    # Commands
+
+    def connect(self):
+        """Connect to the server, starting TLS if requested and available."""
+        operation = Operation("CONNECT")
+        self._channel = _Channel(self, self.map)
+        self._pending = (operation,
+                         lambda response: self._on_greeting(operation,
+                                                            response))
+        self._channel.connect((self.host, self.port))
+        return operation
+
+    def starttls(self):
+        return self._enqueue("STARTTLS", self._start_starttls)
+
+    def authenticate(self, mechanism, *auth_objects):
+        return self._enqueue("AUTHENTICATE", self._start_command,
+                             self._authenticate_command, mechanism,
+                             *auth_objects)
+
+    def login(self, auth, user, password):
+        def build(auth, user, password):
+            # the mechanism is chosen once the capabilities are known
+            return self._authenticate_command(
+                *self._login_mechanism(auth, user, password))
+        return self._enqueue("AUTHENTICATE", self._start_command, build,
+                             auth, user, password)
+
+    def logout(self):
+        """Send LOGOUT and close the connection once the server replied."""
+        return self._enqueue("LOGOUT", self._start_logout)
+
+    def capability(self):
+        return self._enqueue("CAPABILITY", self._start_command,
+                             self._capability_command)
+
+    def noop(self, tag=None):
+        return self._enqueue("NOOP", self._start_command,
+                             self._noop_command, tag)
+
+    def list_scripts(self):
+        return self._enqueue("LISTSCRIPTS", self._start_command,
+                             self._list_scripts_command)
+
+    def get_script(self, name, decode=True):
+        return self._enqueue("GETSCRIPT", self._start_command,
+                             self._get_script_command, name, decode)
+
+    def put_script(self, name, data=None, path=None):
+        """Like ManageSieveClient.put_script(), but files are read in memory
+        as a whole when the command is sent."""
+        return self._enqueue("PUTSCRIPT", self._start_command,
+                             self._put_script_command, name, data, path)
+
+    def set_active(self, name):
+        return self._enqueue("SETACTIVE", self._start_command,
+                             self._set_active_command, name)
+
+    def delete_script(self, name):
+        return self._enqueue("DELETESCRIPT", self._start_command,
+                             self._delete_script_command, name)
+
+    def rename_script(self, old_name, new_name):
+        return self._enqueue("RENAMESCRIPT", self._start_command,
+                             self._rename_script_command, old_name, new_name)
+
+    def have_space(self, name, size):
+        return self._enqueue("HAVESPACE", self._start_command,
+                             self._have_space_command, name, size)
+
+    def close(self):
+        """Close the connection; queued operations fail."""
+        self._abort(ConnectionError("Connection closed"))
+
+    # Command sequencing
+
+    def _enqueue(self, name, start, *args):
+        operation = Operation(name)
+        self._queue.append((operation, start, args))
+        self._send_next()
+        return operation
+
+    def _send_next(self):
+        while self._pending is None and self._queue and self._connected \
+              and not self._handshaking:
+            operation, start, args = self._queue.popleft()
+            try:
+                start(operation, *args)
+            except ManageSieveClientError, e:
+                operation._complete(error=e)
+
+    def _send(self, operation, command, handler=None):
+        self._check_state(command.name)
+        if command.challenge is not None:
+            raise ManageSieveClientError("%s needs a SASL exchange, not "
+                                         "supported" % command.name)
+        data = command.encode()
+        if trace.isEnabledFor(logging.DEBUG):
+            trace.debug("Sending command to %s: %s", self.host,
+                        _summarize(data))
+        self._pending = (operation, handler or command.finish)
+        if self._outpos < len(self._outbuf):
+            self._outbuf = self._outbuf[self._outpos:] + data
+        else:
+            self._outbuf = data
+        self._outpos = 0
+        self._handle_write()
+
+    def _start_command(self, operation, build, *args):
+        self._send(operation, build(*args))
+
+    def _start_starttls(self, operation):
+        self._send(operation, self._starttls_command(),
+                   lambda response: self._on_starttls(operation, response))
+
+    def _start_logout(self, operation):
+        def handler(response):
+            self.close()
+            return command.finish(response)
+        command = self._logout_command()
+        self._send(operation, command, handler)
+
+    def _dispatch(self, response):
+        operation, handler = self._pending
+        self._pending = None
+        try:
+            value = handler(response)
+        except ManageSieveClientError, e:
+            operation._complete(error=e)
+        else:
+            if value is not _CONTINUE:
+                operation._complete(value)
+
+    # Connection and STARTTLS
+
+    def _on_greeting(self, operation, response):
+        self._greeting(response)
+        if self.use_tls and self.tls_support:
+            self._start_starttls(operation)
+            return _CONTINUE
+        return response
+
+    def _on_starttls(self, operation, response):
+        self._starttls_command().finish(response)
+        self._reset_capabilities()
+        # the server sends its capabilities again once TLS is established
+        self._pending = (operation,
+                         lambda caps: self._on_tls_capabilities(operation,
+                                                                response,
+                                                                caps))
+
+        sock = wrap_tls(self._channel.socket, self.host,
+                        self.keyfile, self.certfile,
+                        do_handshake_on_connect=False)
+        self._channel.del_channel()
+        self._channel.set_socket(sock, self.map)
+        self._handshaking = True
+        self._do_handshake()
+        return _CONTINUE
+
+    def _on_tls_capabilities(self, operation, response, capabilities):
+        log.debug("Started TLS session")
+        self._parse_capabilities(capabilities.data)
+        if capabilities.data:
+            return response
+
+        # no capabilities sent after TLS, ask for them
+        def handler(capabilities):
+            command.finish(capabilities)
+            return response
+        command = self._capability_command()
+        self._send(operation, command, handler)
+        return _CONTINUE
+
+    def _do_handshake(self):
+        try:
+            self._channel.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self._handshake_wants_write = False
+            return
+        except ssl.SSLWantWriteError:
+            self._handshake_wants_write = True
+            return
+        self._handshaking = False
+        self._handshake_wants_write = False
+        # data may be waiting inside the SSL object already
+        self._handle_read()
+        self._send_next()
+
+    # I/O
+
+    def _wants_write(self):
+        if self._handshaking:
+            return self._handshake_wants_write
+        return self._outpos < len(self._outbuf)
+
+    def _handle_write(self):
+        if not self._connected:
+            return
+        if self._handshaking:
+            self._do_handshake()
+            return
+        if self._outpos >= len(self._outbuf):
+            return
+        try:
+            sent = self._channel.socket.send(
+                memoryview(self._outbuf)[self._outpos:])
+        except socket.error, e:
+            if e.args[0] in _retry_errors:
+                return
+            raise
+        self._outpos += sent
+        if self._outpos >= len(self._outbuf):
+            self._outbuf = ''
+            self._outpos = 0
+
+    def _handle_read(self):
+        if self._handshaking:
+            self._do_handshake()
+            return
+        while self._channel is not None and not self._handshaking:
+            sock = self._channel.socket
+            view = self._parser.literal_buffer()
+            try:
+                if view is not None:
+                    count = sock.recv_into(view)
+                else:
+                    data = sock.recv(self.bufsize)
+                    count = len(data)
+            except ssl.SSLWantReadError:
+                return
+            except socket.error, e:
+                if e.args[0] in _retry_errors:
+                    return
+                raise
+
+            if not count:
+                self._abort(EOFFromServer("Connection closed by server"))
+                return
+            if view is not None:
+                self._parser.literal_received(count)
+            else:
+                if trace.isEnabledFor(logging.DEBUG):
+                    trace.debug("Read data from %s: %s", self.host,
+                                _summarize(data))
+                self._parser.feed(data)
+            self._process_responses()
+
+    def _process_responses(self):
+        while not self._handshaking:
+            response = self._next_response()
+            if response is None:
+                break
+            if self._pending is None:
+                log.warning("Unexpected response from %s: %r", self.host,
+                            response)
+                if response.status == Response.BYE:
+                    self._abort(ConnectionError("Server closed the "
+                                                "connection: %s" %
+                                                response.text))
+                    return
+                continue
+            self._dispatch(response)
+            if self.state == 'LOGOUT' and self._channel is not None:
+                self._abort(ConnectionError("Server closed the connection"))
+                return
+        self._send_next()
+
+    def _abort(self, error):
+        """Close the connection, failing the operations left."""
+        if self._channel is not None:
+            self._channel.close()
+            self._channel = None
+        self._connected = False
+        self.state = 'LOGOUT'
+        operations = [op for op, start, args in self._queue]
+        self._queue.clear()
+        if self._pending is not None:
+            operations.insert(0, self._pending[0])
+            self._pending = None
+        for operation in operations:
+            operation._complete(error=error)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+    managesieve.capabilities
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A persistent cache of server capabilities.
+
+    Tools that only need to know what a server supports can look it up here
+    instead of connecting; entries expire after `ttl` seconds::
+
+        cache = CapabilityCache()
+        if not cache.apply(client):
+            client.connect()
+            cache.store(client)
+
+    :copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+    :license: GNU Public License v3 (GPLv3)
+"""
+from __future__ import with_statement
+import os
+import json
+import time
+import errno
+import logging
+from .utils import cache_dir, file_lock, write_json
+
+
+log = logging.getLogger(__name__)
+
+
+def default_path():
+    return os.path.join(cache_dir(), 'capabilities.json')
+
+
+class CapabilityCache(object):
+    """Capabilities of servers, keyed by "host:port", in a JSON file.
+
+    Each entry holds the capability lines as sent by the server, e.g.
+    ``[["SASL", "PLAIN LOGIN"], ["STARTTLS"]]``, and when they were
+    received.
+    """
+
+    def __init__(self, path=None, ttl=3600):
+        self.path = path or default_path()
+        self.ttl = ttl
+
+    def get(self, host, port):
+        """Return the capability lines of a server, or None if unknown or
+        expired."""
+        entry = self._load().get(self._key(host, port))
+        if entry is None or time.time() - entry['time'] > self.ttl:
+            return None
+        return [[str(item) for item in cap] for cap in entry['data']]
+
+    def put(self, host, port, capabilities):
+        """Record the capability lines of a server; the file is locked
+        while it is updated, so any number of caches, threads or processes
+        can share it."""
+        with file_lock(self.path):
+            entries = self._load()
+            entries[self._key(host, port)] = {'time': time.time(),
+                                             'data': capabilities}
+            write_json(self.path, entries)
+
+    def apply(self, client):
+        """Set the capabilities of `client` from the cache.
+
+        Returns False if the server is not in the cache.
+        """
+        capabilities = self.get(client.host, client.port)
+        if capabilities is None:
+            return False
+        client._parse_capabilities(capabilities)
+        return True
+
+    def store(self, client):
+        """Save the capabilities last received by `client`."""
+        if client.raw_capabilities:
+            self.put(client.host, client.port, client.raw_capabilities)
+
+    def _key(self, host, port):
+        return '%s:%d' % (host, port)
+
+    def _load(self):
+        try:
+            with open(self.path) as fd:
+                entries = json.load(fd)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                log.warning("Can't read capability cache %s: %s",
+                            self.path, e)
+            return {}
+        except ValueError, e:
+            log.warning("Ignoring corrupted capability cache %s: %s",
+                        self.path, e)
+            return {}
+        now = time.time()
+        return dict((key, entry) for key, entry in entries.items()
+                    if now - entry['time'] <= self.ttl)
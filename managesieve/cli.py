@@ -11,65 +11,100 @@
 from __future__ import with_statement
 import os
 import sys
+import json
 import argparse
 import logging
-import codecs
+import socket
+import StringIO
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from config import parse_config_file
-from utils import exec_command
-from . import ManageSieveClient, CommandFailed
+from utils import exec_command, write_file
+from . import CommandFailed
+from .pool import ConnectionPool
+from .metrics import Metrics
+from .capabilities import CapabilityCache
+from .sieve import SieveError, Validator, minify_file
+from .scram import ScramKeyCache
+from . import sync
+from . import daemon
 
 
 log = logging.getLogger(__name__)
 
+# shared by every account, so each script is parsed once per run
+validator = Validator()
 
-def show_error(message):
-    sys.stderr.write("%s\n" % message)
+
+def show_error(message, stream=None):
+    if isinstance(message, unicode):
+        message = message.encode('utf-8', 'replace')
+    (stream or sys.stderr).write("%s\n" % message)
 
 
 class Client(object):
-    def __init__(self, args, sieve):
+    def __init__(self, args, sieve, out=None, err=None, account=None):
         self.args = args
         self.sieve = sieve
+        self.account = account
+        self.out = out or sys.stdout
+        self.err = err or sys.stderr
+        self.error = None
 
     def run(self):
+        """Run the command, returning the exit status."""
         fname = "cmd_%s" % self.args.cmd
         if hasattr(self, fname):
             fn = getattr(self, fname)
             try:
-                fn()
-            except CommandFailed, e:
-                show_error("ERROR: %s" % e)
-                sys.exit(1)
+                # commands may return an exit status
+                return fn() or 0
+            except (CommandFailed, SieveError), e:
+                self.error = "ERROR: %s" % e
+                show_error(self.error, self.err)
+                return 1
         else:
-            show_error("Invalid or unimplemented command: %s" % self.args.cmd)
-            sys.exit(1)
-        sys.exit(0)
+            self.error = "Invalid or unimplemented command: %s" % self.args.cmd
+            show_error(self.error, self.err)
+            return 1
 
-    def cmd_list(self):
-        scripts = self.sieve.list_scripts()
+    def echo(self, message):
+        if isinstance(message, unicode):
+            message = message.encode('utf-8', 'replace')
+        print >>self.out, message
 
-        for script, active in scripts:
-            print "%s%s" % ('* ' if active else '',
-                            script.encode('utf-8', 'replace'))
+    def cmd_list(self):
+        for script, active in self.sieve.iter_scripts():
+            self.echo(u"%s%s" % ('* ' if active else '', script))
 
     def cmd_get(self):
         script_name = unicode(self.args.name, 'utf-8', 'replace')
         data = self.sieve.get_script(script_name)
-        print data.encode('utf-8', 'replace')
+        self.echo(data)
+
+    def use_validator(self):
+        """Check scripts before uploading them, unless --no-validate."""
+        if getattr(self.args, 'no_validate', False):
+            self.sieve.validator = None
+        else:
+            self.sieve.validator = validator
 
     def cmd_put(self):
+        self.use_validator()
         if self.args.destfile:
             script_dest = self.args.destfile
         else:
             script_dest = os.path.basename(self.args.name)
 
         script_dest = unicode(script_dest, 'utf-8', 'replace')
-        data = None
-        with codecs.open(self.args.name, 'r', 'utf-8') as fd:
-            data = fd.read()
-
-        response = self.sieve.put_script(script_dest, data)
-        print response.text
+        if getattr(self.args, 'minify', False):
+            response = self.sieve.put_script(script_dest,
+                                             minify_file(self.args.name))
+        else:
+            response = self.sieve.put_script(script_dest,
+                                             path=self.args.name)
+        self.echo(response.text)
 
     def cmd_activate(self):
         if self.args.name:
@@ -77,48 +112,134 @@ class Client(object):
         else:
             script_name = u""
         response = self.sieve.set_active(script_name)
-        print response.text
+        self.echo(response.text)
 
     def cmd_delete(self):
         script_name = unicode(self.args.name, 'utf-8', 'replace')
         response = self.sieve.delete_script(script_name)
-        print response.text
+        self.echo(response.text)
 
     def cmd_rename(self):
         old_name = unicode(self.args.old_name, 'utf-8', 'replace')
         new_name = unicode(self.args.new_name, 'utf-8', 'replace')
         response = self.sieve.rename_script(old_name, new_name)
-        print response.text
+        self.echo(response.text)
 
     def cmd_have_space(self):
         script_name = unicode(self.args.name, 'utf-8', 'replace')
-        size = os.path.getsize(self.args.name)
+        if getattr(self.args, 'minify', False):
+            size = len(minify_file(self.args.name))
+        else:
+            size = os.path.getsize(self.args.name)
         response = self.sieve.have_space(script_name, size)
         if response.is_ok:
-            print "Server can accept %s: %s" % (self.args.name, response.text)
+            self.echo(u"Server can accept %s: %s" % (self.args.name,
+                                                    response.text))
         else:
-            print "Server does not have space for %s: %s" % (
-                self.args.name, response.text)
+            self.echo(u"Server does not have space for %s: %s" % (
+                self.args.name, response.text))
 
     def cmd_capability(self):
         response = self.sieve.capability()
         if response.is_ok:
-            capabilities = response.data
-            for cap in capabilities:
-                print ': '.join(cap[0:2])
+            if getattr(self.args, 'cached', False):
+                CapabilityCache().store(self.sieve)
+            self.show_capabilities(response.data)
         else:
-            print "Command failed: %s" % response.text
+            self.echo(u"Command failed: %s" % response.text)
+
+    def cmd_sync_push(self):
+        self.use_validator()
+        manifest = sync.Manifest(self.args.manifest)
+        activate = self.args.activate
+        if activate is not None:
+            activate = unicode(activate, 'utf-8', 'replace')
+        result = sync.push(self.sieve, self.args.directory, manifest,
+                           self.account, delete=self.args.delete,
+                           activate=activate, force=self.args.force,
+                           minify=getattr(self.args, 'minify', False))
+
+        for action, name, outcome in result.actions:
+            if outcome.is_ok:
+                self.echo(u"%s %s" % (action, name))
+            else:
+                show_error(u"ERROR: %s %s: %s" % (action, name,
+                                                  outcome.error), self.err)
+        if self.args.verbose:
+            for name in result.unchanged:
+                self.echo(u"unchanged %s" % name)
+        counts = dict((action, 0) for action in ('put', 'delete'))
+        for action, name, outcome in result.actions:
+            if outcome.is_ok and action in counts:
+                counts[action] += 1
+        self.echo(u"%d uploaded, %d deleted, %d unchanged, %d failed" % (
+            counts['put'], counts['delete'], len(result.unchanged),
+            len(result.failures)))
+        if result.failures:
+            self.error = "ERROR: %d commands failed" % len(result.failures)
+            return 1
+
+    def cmd_pull(self):
+        if not self.args.all and not self.args.names:
+            show_error("Give the names of the scripts to pull, or --all",
+                       self.err)
+            return 1
+        if not os.path.isdir(self.args.directory):
+            os.makedirs(self.args.directory)
+        names = None
+        if not self.args.all:
+            names = [unicode(name, 'utf-8', 'replace')
+                     for name in self.args.names]
+        result = sync.pull(self.sieve, self.args.directory, names,
+                           manifest=sync.Manifest(self.args.manifest),
+                           account=self.account)
+
+        for name, path, outcome in result.scripts:
+            if path is None:
+                show_error(u"ERROR: %s: %s" % (name, outcome.error),
+                           self.err)
+            else:
+                self.echo("%s%s" % ('* ' if name == result.active else '',
+                                    path))
+        if result.failures:
+            self.error = "ERROR: %d scripts not pulled" % len(result.failures)
+            return 1
+
+    def show_capabilities(self, capabilities):
+        for cap in capabilities:
+            self.echo(': '.join(cap[0:2]))
 
 
 def parse_cmdline():
     description = ("A command-line utility for interacting with remote "
                    "managesieve servers")
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('-c', '--config', required=True, metavar='FILENAME',
+    parser.add_argument('-c', '--config', metavar='FILENAME',
                         help="Specify a configuration file")
-    parser.add_argument('-a', '--account', required=True, metavar='NAME',
-                        help="Specify an account name from the " \
-                        "configuration file")
+    accounts = parser.add_mutually_exclusive_group()
+    accounts.add_argument('-a', '--account', metavar='NAME',
+                          help="Specify an account name from the " \
+                          "configuration file")
+    accounts.add_argument('--accounts', metavar='NAME[,NAME...]',
+                          help="Run the command on several accounts " \
+                          "concurrently")
+    accounts.add_argument('--all-accounts', action="store_true",
+                          help="Run the command on every account of the " \
+                          "configuration file concurrently")
+    parser.add_argument('-w', '--workers', type=int, default=8, metavar='N',
+                        help="Number of accounts processed at the same " \
+                        "time (default: %(default)s)")
+    parser.add_argument('--daemon', action="store_true",
+                        help="Run the command through the session daemon, " \
+                        "starting it if needed")
+    parser.add_argument('-t', '--timeout', type=float, metavar='SECONDS',
+                        help="Give up on a server that doesn't answer " \
+                        "within SECONDS, when connecting or waiting for a " \
+                        "response")
+    parser.add_argument('--metrics-file', metavar='FILENAME',
+                        help="Write the count, errors, bytes and latency " \
+                        "of the commands sent to FILENAME, in the " \
+                        "Prometheus text format")
     parser.add_argument('--debug', action="store_true",
                         help="Print debug output (verbose)")
     parser.add_argument('-v', '--verbose', action="store_true",
@@ -138,6 +259,11 @@ def parse_cmdline():
     cmd_put.add_argument('name', metavar='SCRIPT-NAME',
                          help="Absolute path to the file to be uploaded")
     cmd_put.add_argument('-d', '--destfile', help="dest file")
+    cmd_put.add_argument('--no-validate', action="store_true",
+                         help="Don't check the script before uploading it")
+    cmd_put.add_argument('--minify', action="store_true",
+                         help="Upload the script without its comments and " \
+                         "needless white space")
     cmd_put.set_defaults(cmd="put")
 
     cmd_get = subparsers.add_parser(
@@ -184,64 +310,428 @@ def parse_cmdline():
         help="Peform a HAVESPACE command for a local Sieve script")
     cmd_havespace.add_argument("name", metavar="FILENAME",
                                help="Absolute path of a local Sieve script")
+    cmd_havespace.add_argument("--minify", action="store_true",
+                               help="Check the size of the script as " \
+                               "uploaded with put --minify")
     cmd_havespace.set_defaults(cmd="have_space")
 
     cmd_capabilities = subparsers.add_parser(
         "capability",
         description="Request the server capability list",
         help="Request the server capability list")
+    cmd_capabilities.add_argument(
+        '--cached', action="store_true",
+        help="Use the capabilities seen in the last hour, if any, instead " \
+        "of connecting to the server")
     cmd_capabilities.set_defaults(cmd="capability")
 
+    cmd_sync = subparsers.add_parser(
+        "sync",
+        description="Synchronize the remote Sieve scripts with a local " \
+        "directory",
+        help="Synchronize the remote Sieve scripts with a local directory")
+    sync_commands = cmd_sync.add_subparsers(help="The sync operation")
+    cmd_sync_push = sync_commands.add_parser(
+        "push",
+        description="Upload the .sieve files of DIRECTORY that changed " \
+        "since the last push; scripts are named after their files, " \
+        "without the extension",
+        help="Upload the changed .sieve files of a directory")
+    cmd_sync_push.add_argument("directory", metavar="DIRECTORY",
+                               help="Directory containing the .sieve files")
+    cmd_sync_push.add_argument("--delete", action="store_true",
+                               help="Delete the remote scripts without a " \
+                               "local file")
+    cmd_sync_push.add_argument("--activate", metavar="SCRIPT-NAME",
+                               help="Activate this script at the end")
+    cmd_sync_push.add_argument("--force", action="store_true",
+                               help="Upload every script, changed or not")
+    cmd_sync_push.add_argument("--manifest", metavar="FILENAME",
+                               help="File recording what was pushed " \
+                               "(default: %s)" %
+                               sync.default_manifest_path())
+    cmd_sync_push.add_argument("--no-validate", action="store_true",
+                               help="Don't check the scripts before " \
+                               "uploading them")
+    cmd_sync_push.add_argument("--minify", action="store_true",
+                               help="Upload the scripts without their " \
+                               "comments and needless white space")
+    cmd_sync_push.set_defaults(cmd="sync_push")
+
+    cmd_pull = subparsers.add_parser(
+        "pull",
+        description="Download remote Sieve scripts to .sieve files in " \
+        "DIRECTORY, over a single connection",
+        help="Download remote Sieve scripts to a directory")
+    cmd_pull.add_argument("directory", metavar="DIRECTORY",
+                          help="Destination directory")
+    cmd_pull.add_argument("names", metavar="SCRIPT-NAME", nargs='*',
+                          help="Names of the remote scripts")
+    cmd_pull.add_argument("--all", action="store_true",
+                          help="Download every remote script")
+    cmd_pull.add_argument("--manifest", metavar="FILENAME",
+                          help="File recording the scripts on the server, " \
+                          "shared with sync push (default: %s)" %
+                          sync.default_manifest_path())
+    cmd_pull.set_defaults(cmd="pull")
+
+    cmd_daemon = subparsers.add_parser(
+        "daemon",
+        description="Keep authenticated sessions open for the commands run " \
+        "with --daemon",
+        help="Run the session daemon in the foreground")
+    cmd_daemon.add_argument('--idle-timeout', type=int, default=600,
+                            metavar='SECONDS',
+                            help="Exit after SECONDS without requests " \
+                            "(default: %(default)s)")
+    cmd_daemon.set_defaults(cmd="daemon")
+
+    cmd_validate = subparsers.add_parser(
+        "validate",
+        description="Check the syntax of Sieve scripts without connecting " \
+        "to a server, printing a JSON object per script; the exit status " \
+        "is 1 if a script is invalid",
+        help="Check the syntax of local Sieve scripts")
+    cmd_validate.add_argument("paths", metavar="PATH", nargs='+',
+                              help="Script, or directory searched " \
+                              "recursively for .sieve files")
+    cmd_validate.add_argument("-j", "--jobs", type=int, metavar='N',
+                              default=multiprocessing.cpu_count(),
+                              help="Number of processes checking scripts " \
+                              "(default: %(default)s)")
+    cmd_validate.add_argument("--extensions", metavar='NAME[,NAME...]',
+                              help="Report the scripts requiring other " \
+                              "extensions than these")
+    cmd_validate.add_argument("--errors-only", action="store_true",
+                              help="Print the invalid scripts only")
+    cmd_validate.set_defaults(cmd="validate")
+
     args = parser.parse_args()
+    if args.cmd == "validate":
+        return args
+    if not args.config:
+        parser.error("argument -c/--config is required")
+    if args.cmd != "daemon" and not (args.account or args.accounts or
+                                     args.all_accounts):
+        parser.error("one of the arguments -a/--account --accounts "
+                     "--all-accounts is required")
+    if args.daemon and (args.accounts or args.all_accounts):
+        parser.error("--daemon can only be used with -a/--account")
+    if args.daemon and args.metrics_file:
+        parser.error("--metrics-file can't be used with --daemon")
     return args
 
 
-def run_command(args, config):
-    general_config = config.get('general')
-    account_config = config.get(args.account)
-    if account_config is None:
-        show_error("Account configuration '%s' not found" % args.account)
-        sys.exit(1)
-
-    use_tls = True if account_config.get('remote.use_tls') else False
-    address = account_config.get('remote.host')
-    port = int(account_config.get('remote.port'))
-
-    sieve = ManageSieveClient(address, port, use_tls=use_tls)
-    sieve.connect()
-
-    username = account_config.get('remote.user')
-    auth_mech = account_config.get('remote.auth', '')
-    auth_name = account_config.get('remote.auth_name', None)
+def account_password(account_config, general_config):
+    """Return the password of an account.
 
+    The password submitted via stdin wins over the password command, which
+    wins over the password in the configuration file.
+    """
     general_password = general_config.get('password')
     password_command = account_config.get('remote.password_command')
 
-    # Use the password submitted via stdin if present
     if general_password:
-        password = general_password
-
-    # Try to execute the password command
+        return general_password
     elif password_command:
-        password = exec_command(password_command)
-
-    # Get the password from the config file
+        return exec_command(password_command)
     else:
-        password = account_config.get('remote.password')
+        return account_config.get('remote.password')
+
+
+def open_session(pool, account_config, general_config, timeout=None):
+    """Return an authenticated client for an account, taken from `pool`;
+    `timeout`, if given, replaces the timeouts of the pool."""
+    return pool.acquire(account_config.get('remote.host'),
+                        int(account_config.get('remote.port')),
+                        account_config.get('remote.user'),
+                        lambda: account_password(account_config,
+                                                 general_config),
+                        mechanism=account_config.get('remote.auth') or None,
+                        auth_name=account_config.get('remote.auth_name',
+                                                     None),
+                        use_tls=bool(account_config.get('remote.use_tls')),
+                        connect_timeout=timeout, timeout=timeout)
+
+
+def select_accounts(args, config):
+    """Return the names of the accounts the command must run on."""
+    if args.all_accounts:
+        return sorted(name for name, section in config.items()
+                      if name != 'general' and 'remote.host' in section)
+    elif args.accounts:
+        return [name.strip() for name in args.accounts.split(',')
+                if name.strip()]
+    return [args.account]
+
+
+def cached_capabilities(args, account_config):
+    """Return the cached capabilities of the server of an account if the
+    command can be answered from the cache, else None."""
+    if args.cmd != 'capability' or not getattr(args, 'cached', False):
+        return None
+    return CapabilityCache().get(account_config.get('remote.host'),
+                                 int(account_config.get('remote.port')))
+
+
+def run_account(args, config, name, pool):
+    """Run the command on the account `name`, collecting its output.
+
+    Returns a (name, status, output, errors, error) tuple, where `error`
+    summarizes what went wrong; errors are reported and not raised, so that
+    an account can't stop the others.
+    """
+    account_config = config.get(name)
+    if account_config is None:
+        error = "Account configuration '%s' not found" % name
+        return name, 1, '', error, error
+
+    out, err = StringIO.StringIO(), StringIO.StringIO()
+    capabilities = cached_capabilities(args, account_config)
+    if capabilities is not None:
+        Client(args, None, out=out).show_capabilities(capabilities)
+        return name, 0, out.getvalue(), '', None
 
     try:
-        if not auth_mech:
-            res = sieve.login(auth_mech, username, password)
+        # the pool of the session daemon is shared by commands with
+        # different timeouts
+        sieve = open_session(pool, account_config, config.get('general'),
+                             getattr(args, 'timeout', None))
+    except Exception, e:
+        error = "ERROR: %s" % e
+        return name, 1, '', error, error
 
-        elif auth_mech == 'LOGIN':
-            res = sieve.authenticate(auth_mech, username, password)
-        else:
-            res = sieve.authenticate(auth_mech, auth_name, username, password)
+    client = Client(args, sieve, out=out, err=err, account=name)
+    try:
+        status = client.run()
     except Exception, e:
-        raise
+        pool.release(sieve, discard=True)
+        error = "ERROR: %s" % e
+        show_error(error, err)
+        return name, 1, out.getvalue(), err.getvalue(), error
+    pool.release(sieve)
+    return name, status, out.getvalue(), err.getvalue(), client.error
+
+
+def run_accounts(args, config, names, metrics=None):
+    """Run the command on several accounts with a pool of worker threads.
+
+    The output of each account is printed as a whole, every line prefixed
+    with the name of the account, followed by a summary of the failures.
+    Returns the exit status.
+    """
+    timeout = getattr(args, 'timeout', None)
+    pool = ConnectionPool(max_size=0, metrics=metrics,
+                          connect_timeout=timeout, timeout=timeout)
+    workers = ThreadPool(max(1, min(args.workers, len(names))))
+    failures = []
+    try:
+        results = workers.imap(
+            lambda name: run_account(args, config, name, pool), names)
+        for name, status, output, errors, error in results:
+            for line in output.splitlines():
+                print "%s: %s" % (name, line)
+            for line in errors.splitlines():
+                show_error("%s: %s" % (name, line))
+            if status:
+                failures.append((name, error))
+    finally:
+        workers.close()
+        workers.join()
+
+    if failures:
+        show_error("%d of %d accounts failed:" % (len(failures), len(names)))
+        for name, error in failures:
+            show_error("  %s: %s" % (name, error))
+        return 1
+    return 0
+
+
+def run_command(args, config, pool=None, metrics=None):
+    if args.accounts or args.all_accounts:
+        names = select_accounts(args, config)
+        if not names:
+            show_error("No accounts found")
+            sys.exit(1)
+        sys.exit(run_accounts(args, config, names, metrics))
+
+    general_config = config.get('general')
+    account_config = config.get(args.account)
+    if account_config is None:
+        show_error("Account configuration '%s' not found" % args.account)
+        sys.exit(1)
 
-    client = Client(args, sieve)
-    client.run()
+    capabilities = cached_capabilities(args, account_config)
+    if capabilities is not None:
+        Client(args, None).show_capabilities(capabilities)
+        sys.exit(0)
+
+    if pool is None:
+        pool = ConnectionPool(max_size=1, metrics=metrics,
+                              connect_timeout=args.timeout,
+                              timeout=args.timeout)
+    sieve = open_session(pool, account_config, general_config)
+
+    client = Client(args, sieve, account=args.account)
+    try:
+        status = client.run()
+    finally:
+        pool.release(sieve)
+        pool.clear()
+    sys.exit(status)
+
+
+def _encode(value):
+    """JSON strings are unicode, the commands want utf-8 encoded values,
+    also in lists like the script names of `pull`."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_encode(item) for item in value]
+    return value
+
+
+class DaemonRunner(object):
+    """Run the commands sent to the session daemon.
+
+    Configuration files are parsed once, and again only when modified;
+    sessions are kept in `pool` between requests.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self._configs = {}
+        self._lock = threading.Lock()
+
+    def config(self, filename):
+        mtime = os.stat(filename).st_mtime
+        with self._lock:
+            cached = self._configs.get(filename)
+            if cached is None or cached[0] != mtime:
+                cached = (mtime, parse_config_file(filename))
+                self._configs[filename] = cached
+        return cached[1]
+
+    def __call__(self, request):
+        config = self.config(request['config'])
+        if request.get('password'):
+            config = dict(config)
+            config['general'] = dict(config['general'],
+                                     password=request['password'])
+        args = dict((key, _encode(value))
+                    for key, value in request['args'].items())
+        name, status, out, err, error = run_account(
+            argparse.Namespace(**args), config, request['account'],
+            self.pool)
+        return {'status': status, 'out': out, 'err': err}
+
+
+def serve_daemon(idle_timeout):
+    """Run the session daemon until idle for `idle_timeout` seconds."""
+    # sessions are opened again and again, don't derive the SCRAM keys of
+    # every login
+    pool = ConnectionPool(max_size=32, idle_timeout=idle_timeout,
+                          scram_keys=ScramKeyCache())
+    server = daemon.DaemonServer(DaemonRunner(pool), idle_timeout)
+    try:
+        server.serve_until_idle(on_poll=pool.prune)
+    finally:
+        pool.clear()
+
+
+def run_with_daemon(args, password):
+    """Send the command to the session daemon, returning the exit status."""
+    # the daemon doesn't share our working directory
+    if args.cmd in ('put', 'have_space'):
+        args.name = os.path.abspath(args.name)
+    elif args.cmd in ('sync_push', 'pull'):
+        args.directory = os.path.abspath(args.directory)
+        if args.manifest:
+            args.manifest = os.path.abspath(args.manifest)
+    request = {'config': os.path.abspath(args.config),
+               'account': args.account,
+               'args': vars(args),
+               'password': password}
+    reply = daemon.request_or_spawn(request, lambda: serve_daemon(600))
+    sys.stdout.write(reply['out'].encode('utf-8'))
+    sys.stderr.write(reply['err'].encode('utf-8'))
+    return reply['status']
+
+
+def script_files(paths):
+    """Yield the given files, and the .sieve files found in the given
+    directories and their subdirectories, in order."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(sync.SCRIPT_EXTENSION):
+                    yield os.path.join(directory, filename)
+
+
+def validate_file(path, extensions=None):
+    """Check a script file, returning the result as a dict for JSON."""
+    result = {'path': unicode(path, 'utf-8', 'replace'), 'valid': True}
+    try:
+        validator.check_file(path, extensions)
+    except SieveError, e:
+        result.update(valid=False, line=e.lineno, column=e.column,
+                      error=e.message)
+    except (IOError, OSError), e:
+        result.update(valid=False, error=unicode(e.strerror or str(e),
+                                                 'utf-8', 'replace'))
+    return result
+
+
+def _validate_file(job):
+    return validate_file(*job)
+
+
+def run_validate(args, out=None, err=None):
+    """Check the scripts of `args.paths`, in `args.jobs` processes.
+
+    A line of JSON is written to `out` per script, in order, as soon as it
+    is checked, and a summary to `err`. Returns 1 if a script is invalid, 0
+    otherwise.
+    """
+    out = out or sys.stdout
+    extensions = None
+    if args.extensions is not None:
+        extensions = [name.strip() for name in args.extensions.split(',')
+                      if name.strip()]
+    jobs = ((path, extensions) for path in script_files(args.paths))
+    pool = None
+    if args.jobs > 1:
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(_validate_file, jobs, chunksize=64)
+    else:
+        results = (validate_file(*job) for job in jobs)
+
+    count = invalid = 0
+    try:
+        for result in results:
+            count += 1
+            if not result['valid']:
+                invalid += 1
+            elif args.errors_only:
+                continue
+            out.write(json.dumps(result, sort_keys=True) + '\n')
+            out.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    show_error("%d scripts checked, %d invalid" % (count, invalid), err)
+    return 1 if invalid else 0
+
+
+def write_metrics_file(filename, metrics):
+    """Write `metrics` in the Prometheus text format, readable by other
+    users such as the node exporter textfile collector."""
+    write_file(filename, metrics.prometheus(), mode=0644, dir_mode=0755)
 
 
 def handle_stdin():
@@ -260,9 +750,31 @@ def main():
     args = parse_cmdline()
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
-    config = parse_config_file(args.config)
+    if args.cmd == 'validate':
+        sys.exit(run_validate(args))
+    if args.cmd == 'daemon':
+        try:
+            serve_daemon(args.idle_timeout)
+        except daemon.DaemonError, e:
+            show_error("ERROR: %s" % e)
+            sys.exit(1)
+        sys.exit(0)
+
     stdin_pw = handle_stdin()
+    if args.daemon:
+        try:
+            sys.exit(run_with_daemon(args, stdin_pw))
+        except (socket.error, daemon.DaemonError), e:
+            log.warning("Session daemon not available, running the command "
+                        "directly: %s", e)
+
+    config = parse_config_file(args.config)
     if stdin_pw:
         config['general']['password'] = stdin_pw
 
-    run_command(args, config)
+    metrics = Metrics() if args.metrics_file else None
+    try:
+        run_command(args, config, metrics=metrics)
+    finally:
+        if metrics is not None:
+            write_metrics_file(args.metrics_file, metrics)
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+    managesieve.daemon
+    ~~~~~~~~~~~~~~~~~~
+
+    A per-user daemon keeping authenticated sessions open between runs of
+    managesieve-cli.
+
+    The daemon listens on a unix socket inside a directory only its owner can
+    access. Each connection carries a single request, a JSON object on one
+    line, and gets a JSON reply back; what a request means is up to the
+    `runner` the daemon was started with. The daemon exits once it has been
+    idle for `idle_timeout` seconds.
+
+    :copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+    :license: GNU Public License v3 (GPLv3)
+"""
+import os
+import json
+import time
+import stat
+import errno
+import fcntl
+import socket
+import logging
+import tempfile
+import threading
+import SocketServer
+
+
+log = logging.getLogger(__name__)
+
+SOCKET_NAME = 'daemon.sock'
+LOCK_NAME = 'daemon.lock'
+
+
+class DaemonError(Exception): pass
+
+
+def runtime_dir():
+    """Return the private directory of the daemon, creating it if needed.
+
+    Refuses to use a directory that is not owned by the current user or that
+    can be accessed by anybody else.
+    """
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if base:
+        path = os.path.join(base, 'managesieve-cli')
+    else:
+        path = os.path.join(tempfile.gettempdir(),
+                            'managesieve-cli-%d' % os.getuid())
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 077):
+        raise DaemonError("Unsafe daemon directory: %s" % path)
+    return path
+
+
+def socket_path():
+    return os.path.join(runtime_dir(), SOCKET_NAME)
+
+
+def request(message, path=None, timeout=None):
+    """Send a request to the daemon and return its reply.
+
+    Raises socket.error if no daemon is listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path or socket_path())
+        sock.sendall(json.dumps(message) + '\n')
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+    if not chunks:
+        raise DaemonError("The daemon closed the connection")
+    return json.loads(''.join(chunks))
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            reply = self.server.runner(json.loads(self.rfile.readline()))
+        except Exception, e:
+            log.exception("Error serving a request")
+            reply = {'status': 1, 'out': '', 'err': "ERROR: %s\n" % e}
+        self.wfile.write(json.dumps(reply) + '\n')
+
+
+class DaemonServer(SocketServer.ThreadingMixIn,
+                   SocketServer.UnixStreamServer):
+    """Serve requests with `runner(request) -> reply` until idle."""
+    daemon_threads = True
+
+    def __init__(self, runner, idle_timeout=600, directory=None):
+        self.runner = runner
+        self.idle_timeout = idle_timeout
+        directory = directory or runtime_dir()
+        self.socket_path = os.path.join(directory, SOCKET_NAME)
+
+        # only one daemon per directory: whoever holds the lock owns the
+        # socket and may remove a stale one left by a crash
+        self._lockfile = open(os.path.join(directory, LOCK_NAME), 'w')
+        try:
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._lockfile.close()
+            raise DaemonError("A daemon is already running")
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self._active = 0
+        self._last_activity = time.time()
+        self._activity_lock = threading.Lock()
+        SocketServer.UnixStreamServer.__init__(self, self.socket_path,
+                                               _Handler)
+        os.chmod(self.socket_path, 0600)
+
+    def process_request(self, request, client_address):
+        with self._activity_lock:
+            self._active += 1
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def shutdown_request(self, request):
+        SocketServer.UnixStreamServer.shutdown_request(self, request)
+        with self._activity_lock:
+            self._active -= 1
+            self._last_activity = time.time()
+
+    def idle(self):
+        with self._activity_lock:
+            return (not self._active and
+                    time.time() - self._last_activity > self.idle_timeout)
+
+    def serve_until_idle(self, poll_interval=1.0, on_poll=None):
+        """Handle requests until idle for `idle_timeout` seconds.
+
+        `on_poll` is called every `poll_interval` seconds, e.g. to close
+        expired sessions.
+        """
+        self.timeout = poll_interval
+        try:
+            while not self.idle():
+                self.handle_request()
+                if on_poll is not None:
+                    on_poll()
+        finally:
+            self.server_close()
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+        self._lockfile.close()
+
+
+def spawn(serve):
+    """Run `serve()` in a detached background process."""
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        os.chdir('/')
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        serve()
+    except DaemonError:
+        pass
+    except Exception:
+        log.exception("Session daemon failed")
+        os._exit(1)
+    os._exit(0)
+
+
+def request_or_spawn(message, serve, wait=5.0):
+    """Send a request to the daemon, starting the daemon if needed."""
+    try:
+        return request(message)
+    except socket.error:
+        pass
+
+    spawn(serve)
+    deadline = time.time() + wait
+    while True:
+        try:
+            return request(message)
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+    managesieve.metrics
+    ~~~~~~~~~~~~~~~~~~~
+
+    Counters and latency histograms of the commands sent by the clients.
+
+    Every ManageSieveClient records, for each command it sends, the time to
+    its response, the bytes sent and received and the response code of the
+    failures; clients can share a `Metrics` to aggregate their numbers::
+
+        metrics = Metrics()
+        client = ManageSieveClient(host, port, metrics=metrics)
+        ...
+        print metrics.snapshot()
+        print metrics.prometheus()
+
+    :copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+    :license: GNU Public License v3 (GPLv3)
+"""
+from __future__ import with_statement
+import bisect
+import threading
+
+
+# upper bounds, in seconds, of the latency histogram buckets; the last
+# bucket counts what is slower than all of them
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, 30.0, 60.0)
+
+PERCENTILES = (50, 95, 99)
+
+
+class CommandStats(object):
+    """The numbers of one command sent to one server."""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = {}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_sum = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def record(self, elapsed, sent, received, error):
+        self.count += 1
+        self.bytes_sent += sent
+        self.bytes_received += received
+        self.latency_sum += elapsed
+        self.buckets[bisect.bisect_left(BUCKETS, elapsed)] += 1
+        if error is not None:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def percentile(self, percent):
+        """Estimate a latency percentile from the histogram, interpolating
+        inside the bucket where it falls."""
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            if count and seen + count >= rank:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-1]
+
+    def as_dict(self):
+        latency = dict(('p%d' % p, self.percentile(p)) for p in PERCENTILES)
+        latency['sum'] = self.latency_sum
+        return {'count': self.count,
+                'errors': dict(self.errors),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'latency': latency}
+
+
+class Metrics(object):
+    """Per server and per command statistics.
+
+    Recording is cheap: a lock, a few additions and a bisect on a short
+    tuple; percentiles are only estimated when a snapshot is taken.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (server, command name) -> CommandStats
+        self._stats = {}
+
+    def record(self, server, command, elapsed, sent=0, received=0,
+               error=None):
+        """Record a command sent to `server` ("host:port").
+
+        `elapsed` is the time in seconds from the command being sent to its
+        response; `error` is the response code (or status) of a failed
+        command, or a short description of what went wrong if there was no
+        response.
+        """
+        key = (server, command)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = CommandStats()
+            stats.record(elapsed, sent, received, error)
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self):
+        """Return the statistics as ``{server: {command: {...}}}``.
+
+        Each command has its `count`, its `errors` by response code, the
+        `bytes_sent` and `bytes_received`, and the `latency` percentiles
+        (`p50`, `p95`, `p99`) and `sum`, in seconds.
+        """
+        with self._lock:
+            items = [(key, stats.as_dict())
+                     for key, stats in self._stats.items()]
+        result = {}
+        for (server, command), stats in items:
+            result.setdefault(server, {})[command] = stats
+        return result
+
+    def prometheus(self, prefix='managesieve'):
+        """Return the statistics in the Prometheus text exposition format."""
+        with self._lock:
+            items = sorted((key, _copy(stats))
+                           for key, stats in self._stats.items())
+        lines = []
+
+        def metric(name, kind, help):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+
+        def sample(name, labels, value):
+            lines.append('%s_%s{%s} %s' % (
+                prefix, name, ','.join('%s="%s"' % (key, _escape(value))
+                                       for key, value in labels),
+                _number(value)))
+
+        metric('commands_total', 'counter', "Commands sent.")
+        for (server, command), stats in items:
+            sample('commands_total',
+                   [('server', server), ('command', command)], stats.count)
+        metric('command_errors_total', 'counter',
+               "Commands failed, by response code.")
+        for (server, command), stats in items:
+            for code, count in sorted(stats.errors.items()):
+                sample('command_errors_total',
+                       [('server', server), ('command', command),
+                        ('code', code)], count)
+        metric('sent_bytes_total', 'counter', "Bytes sent.")
+        for (server, command), stats in items:
+            sample('sent_bytes_total',
+                   [('server', server), ('command', command)],
+                   stats.bytes_sent)
+        metric('received_bytes_total', 'counter', "Bytes received.")
+        for (server, command), stats in items:
+            sample('received_bytes_total',
+                   [('server', server), ('command', command)],
+                   stats.bytes_received)
+        metric('command_duration_seconds', 'histogram',
+               "Time from a command being sent to its response.")
+        for (server, command), stats in items:
+            labels = [('server', server), ('command', command)]
+            total = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), stats.buckets):
+                total += count
+                sample('command_duration_seconds_bucket',
+                       labels + [('le', bound)], total)
+            sample('command_duration_seconds_sum', labels, stats.latency_sum)
+            sample('command_duration_seconds_count', labels, stats.count)
+        return '\n'.join(lines) + '\n'
+
+
+def _copy(stats):
+    copy = CommandStats()
+    copy.__dict__.update(stats.__dict__)
+    copy.errors = dict(stats.errors)
+    copy.buckets = list(stats.buckets)
+    return copy
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
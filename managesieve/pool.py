@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+"""
+    managesieve.pool
+    ~~~~~~~~~~~~~~~~
+
+    A pool of authenticated ManageSieveClient sessions.
+
+    Connecting, starting TLS and authenticating cost several round trips;
+    a pool keeps the sessions open once done with them and hands them out
+    again to whoever asks for the same server and user::
+
+        pool = ConnectionPool()
+        with pool.connection('example.com', 4190, 'user', 'secret') as sieve:
+            print sieve.list_scripts()
+
+    :copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+    :license: GNU Public License v3 (GPLv3)
+"""
+from __future__ import with_statement
+import time
+import logging
+import threading
+import contextlib
+from . import (ManageSieveClient, ManageSieveClientError, CommandFailed,
+               Response)
+
+
+log = logging.getLogger(__name__)
+
+
+class _Session(object):
+    """A pooled client and its timestamps."""
+
+    def __init__(self, key, client, now):
+        self.key = key
+        self.client = client
+        self.created = now
+        self.last_used = now
+
+
+class ConnectionPool(object):
+    """Keep authenticated sessions open for reuse.
+
+    Sessions are keyed by the server, the credentials and the TLS settings
+    they were opened with: (host, port, user, mechanism, auth_name,
+    use_tls, keyfile, certfile). An idle session is checked with NOOP
+    before being handed out again, and closed once it has been idle for
+    more than `idle_timeout` seconds or open for more than `max_lifetime`
+    seconds; at most `max_size` idle sessions are kept, the least recently
+    used ones are closed first.
+
+    The pool can be shared by several threads, a session is used by one
+    thread at a time. The clients it creates record their commands in
+    `metrics`, if given, instead of a Metrics of their own, and are given
+    the `connect_timeout`, `timeout` and `operation_timeout` of the pool; a
+    session that timed out is closed when released. With a ScramKeyCache as
+    `scram_keys`, new sessions authenticating with SCRAM reuse the keys
+    derived for the previous ones.
+    """
+    client_class = ManageSieveClient
+
+    def __init__(self, max_size=10, idle_timeout=300, max_lifetime=3600,
+                 metrics=None, connect_timeout=None, timeout=None,
+                 operation_timeout=None, scram_keys=None):
+        self.max_size = max_size
+        self.metrics = metrics
+        self.scram_keys = scram_keys
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.operation_timeout = operation_timeout
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self._lock = threading.Lock()
+        # key -> idle sessions, the most recently used last
+        self._idle = {}
+        # id(client) -> session handed out by acquire()
+        self._in_use = {}
+
+    def acquire(self, host, port, user, password, mechanism=None,
+                auth_name=None, use_tls=True, keyfile=None, certfile=None,
+                connect_timeout=None, timeout=None):
+        """Return an authenticated client, reusing an idle session if any.
+
+        With no `mechanism` the best one offered by the server is used, as
+        `ManageSieveClient.login()` does. `password` may be a function
+        returning the password, called only when a new session must be
+        authenticated. `connect_timeout` and `timeout`, when given, replace
+        those of the pool for this use of the session. Give the client back
+        with `release()`.
+        """
+        if connect_timeout is None:
+            connect_timeout = self.connect_timeout
+        if timeout is None:
+            timeout = self.timeout
+        key = (host, port, user, mechanism, auth_name, use_tls, keyfile,
+               certfile)
+        while True:
+            session = self._pop_idle(key)
+            if session is None:
+                break
+            session.client.timeout = timeout
+            if self._validate(session):
+                log.debug("Reusing session for %s@%s:%d", user, host, port)
+                return self._checkout(session)
+            self._close(session)
+
+        client = self.client_class(host, port, use_tls=use_tls,
+                                   keyfile=keyfile, certfile=certfile,
+                                   metrics=self.metrics,
+                                   connect_timeout=connect_timeout,
+                                   timeout=timeout,
+                                   operation_timeout=self.operation_timeout)
+        if self.scram_keys is not None:
+            client.scram_keys = self.scram_keys
+        try:
+            client.connect()
+            if callable(password):
+                password = password()
+            if not mechanism:
+                response = client.login(auth_name, user, password)
+            elif mechanism == 'LOGIN':
+                response = client.authenticate(mechanism, user, password)
+            else:
+                response = client.authenticate(mechanism, auth_name, user,
+                                               password)
+            if not response.is_ok:
+                raise CommandFailed("AUTHENTICATE", response,
+                                    "Authentication failed for %s" % user)
+        except Exception:
+            self._close_client(client)
+            raise
+        return self._checkout(_Session(key, client, time.time()))
+
+    def release(self, client, discard=False):
+        """Give back a client obtained from `acquire()`.
+
+        The session is closed instead of being kept if `discard` is true, if
+        the connection is no longer authenticated or if the session is too
+        old.
+        """
+        with self._lock:
+            session = self._in_use.pop(id(client), None)
+        if session is None:
+            raise ValueError("%r does not belong to this pool" % client)
+
+        now = time.time()
+        if (discard or client.state != 'AUTH' or
+                now - session.created > self.max_lifetime):
+            self._close(session)
+            return
+
+        session.last_used = now
+        evicted = []
+        with self._lock:
+            self._idle.setdefault(session.key, []).append(session)
+            evicted.extend(self._expired(now))
+            evicted.extend(self._overflow())
+        for session in evicted:
+            self._close(session)
+
+    @contextlib.contextmanager
+    def connection(self, *args, **kwargs):
+        """Acquire a client for the duration of a `with` block.
+
+        The session is discarded if the block raises an error.
+        """
+        client = self.acquire(*args, **kwargs)
+        try:
+            yield client
+        except:
+            self.release(client, discard=True)
+            raise
+        else:
+            self.release(client)
+
+    def prune(self):
+        """Close the idle sessions that expired."""
+        with self._lock:
+            evicted = self._expired(time.time())
+        for session in evicted:
+            self._close(session)
+
+    def clear(self):
+        """Log out of every idle session."""
+        with self._lock:
+            evicted = [session for sessions in self._idle.values()
+                       for session in sessions]
+            self._idle.clear()
+        for session in evicted:
+            self._close(session)
+
+    def __len__(self):
+        """The number of idle sessions."""
+        with self._lock:
+            return sum(len(sessions) for sessions in self._idle.values())
+
+    # The following methods must be called with the lock held
+
+    def _expired(self, now):
+        expired = []
+        for key, sessions in self._idle.items():
+            keep = []
+            for session in sessions:
+                if (now - session.last_used > self.idle_timeout or
+                        now - session.created > self.max_lifetime):
+                    expired.append(session)
+                else:
+                    keep.append(session)
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+        return expired
+
+    def _overflow(self):
+        sessions = sorted((session for sessions in self._idle.values()
+                           for session in sessions),
+                          key=lambda session: session.last_used)
+        overflow = sessions[:max(len(sessions) - self.max_size, 0)]
+        for session in overflow:
+            idle = self._idle[session.key]
+            idle.remove(session)
+            if not idle:
+                del self._idle[session.key]
+        return overflow
+
+    # Helpers
+
+    def _pop_idle(self, key):
+        with self._lock:
+            evicted = self._expired(time.time())
+            sessions = self._idle.get(key)
+            session = sessions.pop() if sessions else None
+            if sessions == []:
+                del self._idle[key]
+        for expired in evicted:
+            self._close(expired)
+        return session
+
+    def _checkout(self, session):
+        with self._lock:
+            self._in_use[id(session.client)] = session
+        return session.client
+
+    def _validate(self, session):
+        """Check with NOOP that the server is still there."""
+        try:
+            session.client.noop()
+        except CommandFailed, e:
+            # servers predating RFC 5804 don't know NOOP
+            return e.response.status == Response.NO
+        except ManageSieveClientError, e:
+            log.debug("Dropping stale session: %s", e)
+            return False
+        return session.client.state == 'AUTH'
+
+    def _close(self, session):
+        self._close_client(session.client)
+
+    def _close_client(self, client):
+        try:
+            if client.state != 'LOGOUT':
+                client.logout()
+        except ManageSieveClientError:
+            pass
+        finally:
+            client.socket.close()
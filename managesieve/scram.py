@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+    managesieve.scram
+    ~~~~~~~~~~~~~~~~~
+
+    SCRAM-SHA-1 and SCRAM-SHA-256 authentication (RFC 5802, RFC 7677).
+
+    The password never leaves the client and the server proves it knows it
+    too, but deriving the keys from the password takes thousands of HMAC
+    rounds; a `ScramKeyCache` keeps the derived keys so that reconnecting
+    skips that step::
+
+        ManageSieveClient.scram_keys = ScramKeyCache()
+
+    Passwords are used as UTF-8, without SASLprep normalization; channel
+    binding is not supported.
+
+    :copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+    :license: GNU Public License v3 (GPLv3)
+"""
+from __future__ import with_statement
+import os
+import hmac
+import hashlib
+import binascii
+import threading
+from collections import OrderedDict
+from . import ManageSieveClientError
+
+
+# mechanism -> hash function
+MECHANISMS = {
+    'SCRAM-SHA-1': 'sha1',
+    'SCRAM-SHA-256': 'sha256',
+}
+
+
+class ScramError(ManageSieveClientError):
+    """The SCRAM exchange failed, or the server could not prove it knows
+    the password."""
+
+
+def _b64encode(data):
+    return binascii.b2a_base64(data)[:-1]
+
+
+def _b64decode(data):
+    try:
+        return binascii.a2b_base64(data)
+    except binascii.Error, e:
+        raise ScramError("Invalid base64 data from server: %s" % e)
+
+
+def _saslname(name):
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return name.replace('=', '=3D').replace(',', '=2C')
+
+
+def _attributes(message):
+    """Return the {name: value} of the attributes of a server message."""
+    attributes = {}
+    for item in message.split(','):
+        if len(item) < 2 or item[1] != '=':
+            raise ScramError("Invalid SCRAM message: %r" % message)
+        attributes[item[0]] = item[2:]
+    return attributes
+
+
+def _xor(a, b):
+    return ''.join(chr(ord(x) ^ ord(y)) for x, y in zip(a, b))
+
+
+def derive_keys(hash_name, password, salt, iterations):
+    """Return the (ClientKey, ServerKey) of a password."""
+    salted = hashlib.pbkdf2_hmac(hash_name, password, salt, iterations)
+    digest = getattr(hashlib, hash_name)
+    return (hmac.new(salted, 'Client Key', digest).digest(),
+            hmac.new(salted, 'Server Key', digest).digest())
+
+
+class ScramKeyCache(object):
+    """ClientKey and ServerKey derived from passwords, for reuse.
+
+    Keys are kept in memory only, for at most `max_entries` logins, by
+    mechanism, user, salt and iteration count. Passwords are not kept: the
+    key of an entry includes an HMAC of the password with a secret of the
+    cache, so a changed password misses the cache. The keys are as good as
+    the password for logging in to that server, don't share a cache with
+    code you don't trust. `hits` and `misses` count the lookups.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._secret = os.urandom(32)
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def keys(self, hash_name, user, password, salt, iterations):
+        """Return the (ClientKey, ServerKey) of a password, deriving them
+        only if they are not in the cache."""
+        key = (hash_name, user, salt, iterations,
+               hmac.new(self._secret, password, hashlib.sha256).digest())
+        with self._lock:
+            keys = self._keys.pop(key, None)
+            if keys is not None:
+                self.hits += 1
+                self._keys[key] = keys
+                return keys
+            self.misses += 1
+        keys = derive_keys(hash_name, password, salt, iterations)
+        with self._lock:
+            self._keys[key] = keys
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+        return keys
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._keys)
+
+
+class ScramClient(object):
+    """The client side of a SCRAM exchange.
+
+    `first()` is the initial response of AUTHENTICATE; `respond()` answers
+    the server-first message with the client proof and then the
+    server-final message, checked with `verify()`, with an empty response.
+    `done` is true once the server signature was verified.
+    """
+
+    def __init__(self, mechanism, user, password, authzid=None,
+                 key_cache=None, nonce=None):
+        try:
+            self.hash_name = MECHANISMS[mechanism.upper()]
+        except KeyError:
+            raise ScramError("Unsupported SCRAM mechanism: %s" % mechanism)
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        self.user = user
+        self.password = password
+        self.key_cache = key_cache
+        self.nonce = nonce or _b64encode(os.urandom(18))
+        self.gs2_header = 'n,%s,' % ('a=' + _saslname(authzid)
+                                     if authzid else '')
+        self.client_first_bare = 'n=%s,r=%s' % (_saslname(user), self.nonce)
+        self.done = False
+        self._server_signature = None
+
+    def first(self):
+        """Return the client-first message."""
+        return self.gs2_header + self.client_first_bare
+
+    def respond(self, challenge):
+        """Return the response to a challenge of the server."""
+        if self._server_signature is None:
+            return self.final(challenge)
+        self.verify(challenge)
+        return ''
+
+    def final(self, server_first):
+        """Return the client-final message, with the client proof."""
+        attributes = _attributes(server_first)
+        if 'm' in attributes:
+            raise ScramError("Unsupported mandatory SCRAM extension")
+        try:
+            nonce = attributes['r']
+            salt = _b64decode(attributes['s'])
+            iterations = int(attributes['i'])
+        except (KeyError, ValueError):
+            raise ScramError("Invalid server-first message: %r" %
+                             server_first)
+        if not nonce.startswith(self.nonce) or nonce == self.nonce:
+            raise ScramError("The server nonce doesn't extend ours")
+        if iterations < 1:
+            raise ScramError("Invalid iteration count: %d" % iterations)
+
+        if self.key_cache is not None:
+            client_key, server_key = self.key_cache.keys(
+                self.hash_name, self.user, self.password, salt, iterations)
+        else:
+            client_key, server_key = derive_keys(self.hash_name,
+                                                 self.password, salt,
+                                                 iterations)
+        digest = getattr(hashlib, self.hash_name)
+        without_proof = 'c=%s,r=%s' % (_b64encode(self.gs2_header), nonce)
+        auth_message = ','.join([self.client_first_bare, server_first,
+                                 without_proof])
+        stored_key = digest(client_key).digest()
+        signature = hmac.new(stored_key, auth_message, digest).digest()
+        self._server_signature = hmac.new(server_key, auth_message,
+                                          digest).digest()
+        return '%s,p=%s' % (without_proof,
+                            _b64encode(_xor(client_key, signature)))
+
+    def verify(self, server_final):
+        """Check the server signature of the server-final message."""
+        if self._server_signature is None:
+            raise ScramError("Unexpected server-final message")
+        attributes = _attributes(server_final)
+        if 'e' in attributes:
+            raise ScramError("Authentication failed: %s" % attributes['e'])
+        if 'v' not in attributes or not hmac.compare_digest(
+                _b64decode(attributes['v']), self._server_signature):
+            raise ScramError("The server signature is invalid")
+        self.done = True
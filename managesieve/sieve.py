@@ -0,0 +1,607 @@
+# -*- coding: utf-8 -*-
+"""
+    managesieve.sieve
+    ~~~~~~~~~~~~~~~~~
+
+    A parser and validator of Sieve scripts (RFC 5228).
+
+    Finding a syntax error with the server costs a connection, an
+    authentication and a PUTSCRIPT; `Validator` finds most of them locally
+    and checks that the extensions a script requires are offered by the
+    server::
+
+        validator = Validator()
+        validator.check(data, client.capabilities)
+
+    The syntax is checked completely; commands and tests are checked
+    against the base language and the common extensions, not argument by
+    argument, so the server may still reject a script that passes.
+
+    :copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+    :license: GNU Public License v3 (GPLv3)
+"""
+from __future__ import with_statement
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from . import ManageSieveClientError
+
+
+# Tokens of RFC 5228 Section 8.1; "text:" must be tried before identifiers.
+_token = re.compile(r'''
+      (?P<space>[ \t\r\n]+)
+    | (?P<comment>\#[^\n]*|/\*)
+    | (?P<multiline>text:[ \t]*(?:\#[^\n]*)?\r?\n)
+    | (?P<quoted>")
+    | (?P<number>[0-9]+[KMGkmg]?(?![A-Za-z0-9_]))
+    | (?P<tag>:[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<special>[][(),;{}])
+''', re.X)
+_quoted = re.compile(r'"((?:[^"\\]|\\.)*)"', re.S)
+_quoted_escape = re.compile(r'\\(.)', re.S)
+_multiline_end = re.compile(r'^\.\r?(?:\n|\Z)', re.M)
+_dot_stuffed = re.compile(r'^\.\.', re.M)
+
+# Deeper nesting is rejected rather than risking the recursion limit.
+MAX_NESTING = 64
+
+# name -> extension(s) needed, None for the base language
+COMMANDS = {
+    'require': None, 'if': None, 'elsif': None, 'else': None,
+    'stop': None, 'keep': None, 'discard': None, 'redirect': None,
+    'fileinto': 'fileinto', 'reject': 'reject', 'ereject': 'ereject',
+    'vacation': 'vacation', 'setflag': 'imap4flags',
+    'addflag': 'imap4flags', 'removeflag': 'imap4flags',
+    'set': 'variables', 'notify': 'enotify', 'include': 'include',
+    'return': 'include', 'global': 'include', 'addheader': 'editheader',
+    'deleteheader': 'editheader', 'foreverypart': 'foreverypart',
+    'break': 'foreverypart', 'replace': 'replace', 'enclose': 'enclose',
+    'extracttext': 'extracttext', 'error': 'ihave',
+}
+TESTS = {
+    'address': None, 'allof': None, 'anyof': None, 'exists': None,
+    'false': None, 'true': None, 'header': None, 'not': None,
+    'size': None, 'envelope': 'envelope', 'body': 'body', 'date': 'date',
+    'currentdate': 'date', 'hasflag': 'imap4flags', 'string': 'variables',
+    'valid_notify_method': 'enotify',
+    'notify_method_capability': 'enotify', 'mailboxexists': 'mailbox',
+    'metadata': 'mboxmetadata', 'metadataexists': 'mboxmetadata',
+    'servermetadata': 'servermetadata',
+    'servermetadataexists': 'servermetadata', 'duplicate': 'duplicate',
+    'ihave': 'ihave', 'environment': 'environment',
+    'spamtest': ('spamtest', 'spamtestplus'),
+    'virustest': 'virustest', 'specialuse_exists': 'special-use',
+    'valid_ext_list': 'extlists',
+}
+TAGS = {
+    ':copy': 'copy', ':create': 'mailbox', ':flags': 'imap4flags',
+    ':regex': 'regex', ':value': 'relational', ':count': 'relational',
+    ':user': 'subaddress', ':detail': 'subaddress', ':index': 'index',
+    ':last': 'index', ':specialuse': 'special-use', ':list': 'extlists',
+}
+# commands followed by a block instead of ";"
+BLOCK_COMMANDS = frozenset(['if', 'elsif', 'else', 'foreverypart'])
+# comparators every implementation has (RFC 5228 Section 2.7.3)
+BUILTIN_COMPARATORS = frozenset(['i;octet', 'i;ascii-casemap'])
+
+KNOWN_EXTENSIONS = set(['encoded-character', 'comparator-i;ascii-numeric'])
+for _table in (COMMANDS, TESTS, TAGS):
+    for _extensions in _table.values():
+        if isinstance(_extensions, tuple):
+            KNOWN_EXTENSIONS.update(_extensions)
+        elif _extensions:
+            KNOWN_EXTENSIONS.add(_extensions)
+
+
+class SieveError(ManageSieveClientError):
+    """A script is invalid, or needs an extension the server lacks."""
+
+    def __init__(self, message, lineno=None, column=None, filename=None):
+        ManageSieveClientError.__init__(self, message)
+        self.message = message
+        self.lineno = lineno
+        self.column = column
+        self.filename = filename
+
+    def __str__(self):
+        where = []
+        if self.filename is not None:
+            filename = self.filename
+            if isinstance(filename, unicode):
+                filename = filename.encode('utf-8', 'replace')
+            where.append(filename)
+        if self.lineno is not None:
+            where.append("line %d, column %d" % (self.lineno, self.column))
+        message = self.message
+        if isinstance(message, unicode):
+            message = message.encode('utf-8', 'replace')
+        return ': '.join(where + [message])
+
+
+class Token(object):
+    """A token: its `kind`, its `value` and where it is in the script.
+
+    `kind` is one of 'identifier', 'tag', 'number', 'string' or 'special';
+    the value of strings is unescaped, numbers are ints with their
+    quantifier applied. `start` and `end` delimit the token in the source.
+    """
+    __slots__ = ('kind', 'value', 'start', 'end')
+
+    def __init__(self, kind, value, start, end):
+        self.kind = kind
+        self.value = value
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return "<Token %s %r at %d>" % (self.kind, self.value, self.start)
+
+
+class Node(object):
+    """A command or a test.
+
+    `arguments` holds the Tokens of the arguments, a list of Tokens for a
+    string list; `tests` the test or test list; `block` the commands of the
+    block, or None for a command ended by ";" and for tests.
+    """
+    __slots__ = ('name', 'arguments', 'tests', 'block', 'token')
+
+    def __init__(self, name, arguments, tests, block, token):
+        self.name = name
+        self.arguments = arguments
+        self.tests = tests
+        self.block = block
+        self.token = token
+
+    def __repr__(self):
+        return "<Node %s>" % self.name
+
+
+class Script(object):
+    """A parsed script: its top level `commands` and the extensions it
+    `requires`."""
+
+    def __init__(self, source, commands, requires):
+        self.source = source
+        self.commands = commands
+        self.requires = requires
+
+    def check_extensions(self, extensions):
+        """Raise SieveError if a required extension is not in
+        `extensions`."""
+        available = set(extensions)
+        for name, token in self.requires:
+            if name not in available:
+                raise _error(self.source, token.start,
+                             u'extension "%s" is not supported' % name)
+
+
+def _position(source, offset):
+    lineno = source.count(u'\n', 0, offset) + 1
+    column = offset - source.rfind(u'\n', 0, offset)
+    return lineno, column
+
+
+def _error(source, offset, message):
+    lineno, column = _position(source, offset)
+    return SieveError(message, lineno, column)
+
+
+def _decode(data):
+    if isinstance(data, unicode):
+        return data
+    data = str(data)
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError, e:
+        source = data[:e.start].decode('utf-8')
+        raise _error(source, len(source), u"invalid UTF-8")
+
+
+def tokenize(source):
+    """Return the list of Tokens of the unicode script `source`."""
+    tokens = []
+    match = _token.match
+    position = 0
+    end = len(source)
+    while position < end:
+        m = match(source, position)
+        if m is None:
+            raise _error(source, position, u"unexpected character %r" %
+                         source[position])
+        kind = m.lastgroup
+        if kind == 'space':
+            position = m.end()
+        elif kind == 'comment':
+            position = m.end()
+            if m.group() == u'/*':
+                close = source.find(u'*/', position)
+                if close < 0:
+                    raise _error(source, m.start(), u"unterminated comment")
+                position = close + 2
+        elif kind == 'quoted':
+            m = _quoted.match(source, position)
+            if m is None:
+                raise _error(source, position, u"unterminated string")
+            value = _quoted_escape.sub(r'\1', m.group(1))
+            tokens.append(Token('string', value, position, m.end()))
+            position = m.end()
+        elif kind == 'multiline':
+            body = m.end()
+            close = _multiline_end.search(source, body)
+            if close is None:
+                raise _error(source, position,
+                             u"unterminated multi-line string")
+            value = _dot_stuffed.sub(u'.', source[body:close.start()])
+            tokens.append(Token('string', value, position, close.end()))
+            position = close.end()
+        elif kind == 'number':
+            text = m.group()
+            value = int(text.rstrip(u'KMGkmg'))
+            if not text[-1].isdigit():
+                value <<= {'K': 10, 'M': 20, 'G': 30}[text[-1].upper()]
+            tokens.append(Token('number', value, position, m.end()))
+            position = m.end()
+        else:
+            value = m.group()
+            if kind != 'special':
+                value = value.lower()
+            tokens.append(Token(kind, value, position, m.end()))
+            position = m.end()
+    return tokens
+
+
+# tokens that run into each other unless separated by white space
+_WORDS = frozenset(['identifier', 'tag', 'number', 'string'])
+
+
+def minify(data):
+    """Return a script without its comments and needless white space.
+
+    Every token is kept as written, multi-line strings included, so the
+    script means the same; each top level command is put on a line of its
+    own, so that errors reported by the server still point somewhere.
+    Takes unicode or UTF-8 bytes, returns UTF-8 bytes.
+    """
+    source = _decode(data)
+    parts = []
+    previous = None
+    depth = 0
+    for token in tokenize(source):
+        if previous in _WORDS and token.kind in _WORDS:
+            parts.append(u' ')
+        text = source[token.start:token.end]
+        if token.kind == 'string' and text.startswith(u'text:'):
+            # drop the comment and spaces after "text:"
+            body = source.index(u'\n', token.start) + 1
+            newline = u'\r\n' if source[body - 2] == u'\r' else u'\n'
+            text = u'text:' + newline + source[body:token.end]
+        parts.append(text)
+        previous = token.kind
+        if token.kind == 'special':
+            if token.value == u'{':
+                depth += 1
+            elif token.value == u'}':
+                depth -= 1
+            if depth == 0 and token.value in (u';', u'}'):
+                parts.append(u'\r\n')
+                previous = None
+    return u''.join(parts).encode('utf-8')
+
+
+def minify_file(path):
+    """Return the minified script of the file at `path`."""
+    with open(path, 'rb') as fd:
+        data = fd.read()
+    try:
+        return minify(data)
+    except SieveError, e:
+        e.filename = path
+        raise
+
+
+class _Parser(object):
+    """Recursive descent parser of the grammar of RFC 5228 Section 8.2."""
+
+    def __init__(self, source):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.index = 0
+
+    def error(self, token, message):
+        offset = token.start if token is not None else len(self.source)
+        return _error(self.source, offset, message)
+
+    def peek(self):
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return None
+
+    def next(self, expected):
+        token = self.peek()
+        if token is None:
+            raise self.error(None, u"unexpected end of script, expected %s"
+                             % expected)
+        self.index += 1
+        return token
+
+    def special(self, token, value):
+        return (token is not None and token.kind == 'special' and
+                token.value == value)
+
+    def commands(self, depth=0):
+        if depth > MAX_NESTING:
+            raise self.error(self.peek(), u"blocks nested too deeply")
+        commands = []
+        while True:
+            token = self.peek()
+            if token is None or self.special(token, u'}'):
+                return commands
+            commands.append(self.command(depth))
+
+    def command(self, depth):
+        token = self.next(u"a command")
+        if token.kind != 'identifier':
+            raise self.error(token, u"expected a command, found %s" %
+                             _describe(token))
+        arguments, tests = self.arguments(depth)
+        end = self.next(u'";" or "{"')
+        block = None
+        if self.special(end, u'{'):
+            block = self.commands(depth + 1)
+            close = self.next(u'"}"')
+            if not self.special(close, u'}'):
+                raise self.error(close, u'expected "}"')
+        elif not self.special(end, u';'):
+            raise self.error(end, u'expected ";" or "{" after %s, found %s'
+                             % (token.value, _describe(end)))
+        return Node(token.value, arguments, tests, block, token)
+
+    def arguments(self, depth):
+        arguments = []
+        while True:
+            token = self.peek()
+            if token is None:
+                return arguments, []
+            if token.kind in ('string', 'number', 'tag'):
+                self.index += 1
+                arguments.append(token)
+            elif self.special(token, u'['):
+                self.index += 1
+                arguments.append(self.string_list())
+            else:
+                break
+        if token.kind == 'identifier':
+            return arguments, [self.test(depth)]
+        if self.special(token, u'('):
+            self.index += 1
+            tests = [self.test(depth)]
+            while True:
+                token = self.next(u'"," or ")"')
+                if self.special(token, u')'):
+                    return arguments, tests
+                if not self.special(token, u','):
+                    raise self.error(token, u'expected "," or ")" in test '
+                                     u'list, found %s' % _describe(token))
+                tests.append(self.test(depth))
+        return arguments, []
+
+    def string_list(self):
+        strings = []
+        while True:
+            token = self.next(u"a string")
+            if token.kind != 'string':
+                raise self.error(token, u"expected a string, found %s" %
+                                 _describe(token))
+            strings.append(token)
+            token = self.next(u'"," or "]"')
+            if self.special(token, u']'):
+                return strings
+            if not self.special(token, u','):
+                raise self.error(token, u'expected "," or "]" in string '
+                                 u'list, found %s' % _describe(token))
+
+    def test(self, depth):
+        if depth > MAX_NESTING:
+            raise self.error(self.peek(), u"tests nested too deeply")
+        token = self.next(u"a test")
+        if token.kind != 'identifier':
+            raise self.error(token, u"expected a test, found %s" %
+                             _describe(token))
+        arguments, tests = self.arguments(depth + 1)
+        return Node(token.value, arguments, tests, None, token)
+
+
+def _describe(token):
+    if token.kind == 'special':
+        return u'"%s"' % token.value
+    if token.kind == 'string':
+        return u"a string"
+    if token.kind == 'number':
+        return u"a number"
+    return u'%s "%s"' % (token.kind, token.value)
+
+
+class _Checker(object):
+    """Check the commands and tests of a parsed script."""
+
+    def __init__(self, source, requires):
+        self.source = source
+        self.required = set(name for name, token in requires)
+        # with extensions unknown to us, or tested for with "ihave", any
+        # command may be valid
+        self.lenient = ('ihave' in self.required or
+                        bool(self.required - KNOWN_EXTENSIONS))
+
+    def error(self, token, message):
+        return _error(self.source, token.start, message)
+
+    def need(self, token, extensions):
+        if extensions is None or self.lenient:
+            return
+        if not isinstance(extensions, tuple):
+            extensions = (extensions,)
+        if not self.required.intersection(extensions):
+            raise self.error(token, u'%s needs require "%s"' %
+                             (token.value, extensions[0]))
+
+    def commands(self, commands):
+        previous = None
+        for node in commands:
+            self.command(node, previous)
+            previous = node.name
+
+    def command(self, node, previous):
+        name = node.name
+        if name == 'require':
+            raise self.error(node.token, u"require must come before other "
+                             u"commands")
+        if name not in COMMANDS:
+            if not self.lenient:
+                raise self.error(node.token, u'unknown command "%s"' % name)
+        else:
+            self.need(node.token, COMMANDS[name])
+            if name in ('elsif', 'else') and previous not in ('if',
+                                                              'elsif'):
+                raise self.error(node.token, u"%s without if" % name)
+            if name in ('if', 'elsif') and len(node.tests) != 1:
+                raise self.error(node.token, u"%s needs one test" % name)
+            if name not in ('if', 'elsif') and node.tests:
+                raise self.error(node.tests[0].token, u"%s takes no test" %
+                                 name)
+            if name in BLOCK_COMMANDS and node.block is None:
+                raise self.error(node.token, u"%s needs a block" % name)
+            if name not in BLOCK_COMMANDS and node.block is not None:
+                raise self.error(node.token, u"%s takes no block" % name)
+        self.arguments(node.arguments)
+        for test in node.tests:
+            self.test(test)
+        if node.block is not None:
+            self.commands(node.block)
+
+    def test(self, node):
+        name = node.name
+        if name not in TESTS:
+            if not self.lenient:
+                raise self.error(node.token, u'unknown test "%s"' % name)
+        else:
+            self.need(node.token, TESTS[name])
+            if name in ('allof', 'anyof') and not node.tests:
+                raise self.error(node.token, u"%s needs a test list" % name)
+            if name == 'not' and len(node.tests) != 1:
+                raise self.error(node.token, u"not needs one test")
+            if name not in ('allof', 'anyof', 'not') and node.tests:
+                raise self.error(node.tests[0].token, u"%s takes no test" %
+                                 name)
+        self.arguments(node.arguments)
+        for test in node.tests:
+            self.test(test)
+
+    def arguments(self, arguments):
+        for i, token in enumerate(arguments):
+            if isinstance(token, list) or token.kind != 'tag':
+                continue
+            if token.value == ':comparator':
+                if i + 1 == len(arguments) or isinstance(arguments[i + 1],
+                                                         list) or \
+                        arguments[i + 1].kind != 'string':
+                    raise self.error(token, u":comparator needs a string")
+                comparator = arguments[i + 1].value.lower()
+                if comparator not in BUILTIN_COMPARATORS:
+                    self.need(token, u'comparator-' + comparator)
+            else:
+                self.need(token, TAGS.get(token.value))
+
+
+def parse(data):
+    """Parse and check a script, given as unicode or UTF-8 bytes.
+
+    Returns a Script; raises SieveError at the first error found.
+    """
+    source = _decode(data)
+    parser = _Parser(source)
+    commands = parser.commands()
+    token = parser.peek()
+    if token is not None:
+        raise parser.error(token, u'unexpected "}"')
+
+    requires = []
+    while commands and commands[0].name == 'require':
+        node = commands.pop(0)
+        if (len(node.arguments) != 1 or node.tests or
+                node.block is not None):
+            raise _error(source, node.token.start,
+                         u"require needs a string list")
+        strings = node.arguments[0]
+        if not isinstance(strings, list):
+            if strings.kind != 'string':
+                raise _error(source, strings.start,
+                             u"require needs a string list")
+            strings = [strings]
+        requires.extend((string.value, string) for string in strings)
+    _Checker(source, requires).commands(commands)
+    return Script(source, commands, requires)
+
+
+class Validator(object):
+    """Check scripts before they are uploaded.
+
+    Parsing results, and syntax errors, are kept by SHA-256 of the script
+    for the last `max_entries` scripts checked, so checking the same
+    scripts again, e.g. on every push of a directory, costs a hash. A
+    validator can be shared by several threads.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+
+    def check(self, data, extensions=None):
+        """Return the Script parsed from `data`, unicode or bytes.
+
+        Raises SieveError if the script is invalid or if `extensions`, the
+        SIEVE capabilities of the server, lack one it requires.
+        """
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        key = hashlib.sha256(data).digest()
+        with self._lock:
+            result = self._cache.pop(key, None)
+            if result is not None:
+                self._cache[key] = result
+        if result is None:
+            try:
+                result = parse(data)
+            except SieveError, e:
+                result = e
+            with self._lock:
+                self._cache[key] = result
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        if isinstance(result, SieveError):
+            # a copy, the caller may set the file name
+            raise SieveError(result.message, result.lineno, result.column)
+        if extensions:
+            result.check_extensions(extensions)
+        return result
+
+    def check_file(self, path, extensions=None):
+        """Check the script in the file at `path`."""
+        with open(path, 'rb') as fd:
+            data = fd.read()
+        try:
+            return self.check(data, extensions)
+        except SieveError, e:
+            e.filename = path
+            raise
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+    managesieve.sync
+    ~~~~~~~~~~~~~~~~
+
+    Keep the scripts of an account in sync with a local directory.
+
+    `push()` uploads the `.sieve` files of a directory, skipping the ones
+    whose content didn't change since the last push according to a
+    `Manifest` of content hashes; `pull()` downloads scripts to `.sieve`
+    files.
+
+    :copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+    :license: GNU Public License v3 (GPLv3)
+"""
+from __future__ import with_statement
+import os
+import json
+import errno
+import hashlib
+import logging
+import threading
+from .utils import cache_dir, file_lock, write_json
+from .sieve import minify_file
+
+
+log = logging.getLogger(__name__)
+
+SCRIPT_EXTENSION = '.sieve'
+
+# The number of scripts `pull()` asks for in a pipeline; each batch is
+# written to disk before the next is sent.
+PULL_BATCH_SIZE = 256
+
+
+def default_manifest_path():
+    return os.path.join(cache_dir(), 'sync-manifest.json')
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class Manifest(object):
+    """The content hashes of the scripts last pushed to each account, in a
+    JSON file: ``{account: {script name: sha256 hex digest}}``.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_manifest_path()
+
+    def scripts(self, account):
+        """Return the {name: digest} of the scripts pushed to `account`."""
+        return self._load().get(account, {})
+
+    def update(self, account, pushed=None, deleted=()):
+        """Record the scripts pushed to and deleted from `account`.
+
+        `pushed` maps script names to digests; other accounts are left
+        untouched. The file is locked while it is updated, so concurrent
+        pushes and pulls to different accounts can share the same manifest
+        file, from any number of Manifest objects, threads or processes.
+        """
+        with file_lock(self.path):
+            manifest = self._load()
+            scripts = manifest.setdefault(account, {})
+            scripts.update(pushed or {})
+            for name in deleted:
+                scripts.pop(name, None)
+            write_json(self.path, manifest)
+
+    def _load(self):
+        try:
+            with open(self.path) as fd:
+                return json.load(fd)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+
+
+class LocalScript(object):
+    """A script file of the directory being pushed."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(65536), ''):
+                sha.update(chunk)
+        self.digest = sha.hexdigest()
+
+
+def local_scripts(directory):
+    """Return the {name: LocalScript} of the `.sieve` files of `directory`;
+    the name of a script is its file name without the extension."""
+    scripts = {}
+    for filename in sorted(os.listdir(directory)):
+        base, ext = os.path.splitext(filename)
+        path = os.path.join(directory, filename)
+        if ext == SCRIPT_EXTENSION and os.path.isfile(path):
+            name = unicode(base, 'utf-8', 'replace')
+            scripts[name] = LocalScript(name, path)
+    return scripts
+
+
+class PushResult(object):
+    """The outcome of `push()`.
+
+    `actions` lists an (action, name, PipelineResult) tuple for each command
+    sent, action being one of 'put', 'delete' or 'activate'; `unchanged`
+    lists the scripts that were not uploaded.
+    """
+
+    def __init__(self):
+        self.actions = []
+        self.unchanged = []
+
+    @property
+    def failures(self):
+        return [(action, name, result) for action, name, result
+                in self.actions if not result.is_ok]
+
+
+def push(client, directory, manifest, account, delete=False, activate=None,
+         force=False, minify=False):
+    """Upload the scripts of `directory` that changed since the last push.
+
+    Scripts missing on the server are uploaded even if the manifest says
+    they didn't change; with `force` every script is. With `delete` the
+    remote scripts without a local file are deleted; `activate` names the
+    script to make active once the others are in place. With `minify` the
+    scripts are uploaded without their comments and needless white space;
+    the manifest still records the digest of the local files.
+
+    All the commands are sent in a single pipeline after one LISTSCRIPTS.
+    If the client has a validator, every script is checked first, and
+    nothing is sent if one is invalid.
+    """
+    scripts = local_scripts(directory)
+    if client.validator is not None:
+        extensions = client.capabilities or None
+        for name in sorted(scripts):
+            client.validator.check_file(scripts[name].path, extensions)
+    pushed = manifest.scripts(account)
+    remote = dict(client.iter_scripts())
+    current = [name for name, active in remote.items() if active]
+    current = current[0] if current else None
+
+    result = PushResult()
+    pipeline = client.pipeline()
+    actions = []
+    for name in sorted(scripts):
+        script = scripts[name]
+        if force or name not in remote or pushed.get(name) != script.digest:
+            if minify:
+                pipeline.put_script(name, minify_file(script.path))
+            else:
+                pipeline.put_script(name, path=script.path)
+            actions.append(('put', name))
+        else:
+            result.unchanged.append(name)
+
+    stale = sorted(name for name in remote if name not in scripts) \
+        if delete else []
+    # the active script can't be deleted, unless another one is activated
+    # first
+    for name in stale:
+        if name != current:
+            pipeline.delete_script(name)
+            actions.append(('delete', name))
+    if activate is not None and activate != current:
+        pipeline.set_active(activate)
+        actions.append(('activate', activate))
+        if current in stale:
+            pipeline.delete_script(current)
+            actions.append(('delete', current))
+
+    if not actions:
+        return result
+
+    uploaded = {}
+    deleted = []
+    for (action, name), outcome in zip(actions, pipeline.iter_execute()):
+        result.actions.append((action, name, outcome))
+        if not outcome.is_ok:
+            log.debug("%s %s failed: %s", action, name, outcome.error)
+        elif action == 'put':
+            uploaded[name] = scripts[name].digest
+        elif action == 'delete':
+            deleted.append(name)
+    manifest.update(account, uploaded, deleted)
+    return result
+
+
+def script_filename(name):
+    """Return the file name of the script `name`, or None if the name can't
+    be used as a file name."""
+    if (not name or name.startswith('.') or '/' in name or '\0' in name or
+            (os.altsep and os.altsep in name)):
+        return None
+    return name.encode('utf-8') + SCRIPT_EXTENSION
+
+
+class PullResult(object):
+    """The outcome of `pull()`.
+
+    `scripts` lists a (name, path, PipelineResult) tuple for each script,
+    path being None if the script was not written; `active` is the name of
+    the active script.
+    """
+
+    def __init__(self):
+        self.scripts = []
+        self.active = None
+
+    @property
+    def failures(self):
+        return [(name, result) for name, path, result in self.scripts
+                if path is None]
+
+
+def pull(client, directory, names=None, manifest=None, account=None,
+         batch_size=PULL_BATCH_SIZE):
+    """Download scripts to `.sieve` files in `directory`.
+
+    With no `names` every script is downloaded. LISTSCRIPTS is sent once,
+    then the GETSCRIPT commands in pipelines of `batch_size` scripts; each
+    script is written as soon as it has been received, replacing the file
+    atomically. If a `manifest` is given the scripts are recorded as pushed
+    to `account`, so that a later `push()` skips them.
+    """
+    result = PullResult()
+    remote = []
+    for name, active in client.iter_scripts():
+        remote.append(name)
+        if active:
+            result.active = name
+    if names is None:
+        names = remote
+
+    pulled = {}
+    for start in range(0, len(names), batch_size):
+        batch = names[start:start + batch_size]
+        pipeline = client.pipeline()
+        for name in batch:
+            pipeline.get_script(name, decode=False)
+
+        for name, outcome in zip(batch, pipeline.iter_execute()):
+            filename = script_filename(name)
+            path = None
+            if not outcome.is_ok:
+                log.debug("GETSCRIPT %s failed: %s", name, outcome.error)
+            elif filename is None:
+                outcome.error = ValueError("Can't save script %r to a file" %
+                                           name)
+            else:
+                path = os.path.join(directory, filename)
+                _write_file(path, outcome.value)
+                pulled[name] = digest(outcome.value)
+            result.scripts.append((name, path, outcome))
+
+    if manifest is not None and pulled:
+        manifest.update(account, pulled)
+    return result
+
+
+def _write_file(path, data):
+    # write to a temporary file created like the final one, so that the
+    # umask applies, then rename it over the old file
+    tmp = os.path.join(os.path.dirname(path), '.%s.%d.%d.tmp' % (
+        os.path.basename(path), os.getpid(), threading.current_thread().ident))
+    try:
+        with open(tmp, 'wb') as fd:
+            fd.write(data)
+        os.rename(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
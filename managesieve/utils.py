@@ -11,8 +11,18 @@
 from __future__ import with_statement
 import re
 import os
+import json
+import errno
+import tempfile
+import threading
+import contextlib
 import subprocess
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 _cfg_line = re.compile(r'\s+=\s+')
 
 def read_config_defaults(filename, parser):
@@ -35,3 +45,78 @@ def exec_command(cmdline):
                                      stderr=subprocess.STDOUT)
     lines = output.split("\n")
     return lines[0]
+
+
+def cache_dir():
+    """Return the directory where managesieve-cli keeps its caches."""
+    base = (os.environ.get('XDG_CACHE_HOME') or
+            os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'managesieve-cli')
+
+
+def write_file(filename, data, mode=0600, dir_mode=0700):
+    """Atomically replace `filename` with `data`.
+
+    The file gets the permissions `mode` and its parent directory, if
+    missing, is created with `dir_mode`: both readable by the user only
+    unless told otherwise. The data is written to a new file renamed over
+    the old one, so readers never see a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    _make_dirs(directory, dir_mode)
+    fd, name = tempfile.mkstemp(dir=directory,
+                                prefix='.%s' % os.path.basename(filename))
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'w') as tmp:
+            tmp.write(data)
+        os.rename(name, filename)
+    except:
+        os.unlink(name)
+        raise
+
+
+def write_json(filename, obj):
+    """Atomically replace `filename` with `obj` as JSON, like
+    `write_file()`."""
+    write_file(filename, json.dumps(obj))
+
+
+def _make_dirs(directory, mode):
+    try:
+        os.makedirs(directory, mode)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+# filename -> the lock of the threads updating it
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def file_lock(filename):
+    """Hold a lock on `filename` for the duration of a `with` block, so
+    that its read-modify-write cycles don't overlap.
+
+    The lock is shared by every thread using the same file, whatever the
+    object they go through, and taken with flock() on ``filename.lock``
+    for other processes; not on the file itself, as `write_file()` replaces
+    it.
+    """
+    filename = os.path.abspath(filename)
+    with _file_locks_lock:
+        lock = _file_locks.setdefault(filename, threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        _make_dirs(os.path.dirname(filename), 0700)
+        fd = os.open(filename + '.lock', os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            # closing the descriptor releases the flock
+            os.close(fd)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+End to end benchmarks of ManageSieveClient against the in-process server of
+sieveserver.py, over the loopback interface.
+
+Measures the time to connect (STARTTLS with --tls) and authenticate,
+LISTSCRIPTS with 10k entries, GETSCRIPT and PUTSCRIPT from 1KB to 5MB and
+the number of commands per second, sequential and pipelined. The results are
+written as JSON, labelled with the version being measured, so that runs on
+different checkouts can be compared::
+
+    $ PYTHONPATH=. python test/bench_loopback.py --tls -o results.json
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+from __future__ import with_statement
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import managesieve
+from sieveserver import SieveServer, TLSSieveServer
+
+USER = 'user'
+PASSWORD = 'secret'
+
+SIZES = [('1KB', 1024), ('64KB', 64 * 1024), ('1MB', 1024 * 1024),
+         ('5MB', 5 * 1024 * 1024)]
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+def summarize(samples):
+    """Return the statistics of a list of durations, in milliseconds."""
+    samples = sorted(samples)
+    count = len(samples)
+
+    def percentile(percent):
+        return samples[min(count - 1, int(count * percent / 100.0))] * 1000
+
+    return {'count': count,
+            'min_ms': samples[0] * 1000,
+            'mean_ms': sum(samples) / count * 1000,
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'max_ms': samples[-1] * 1000}
+
+
+def measure(fn, repeat):
+    """Run `fn` `repeat` times and return the list of durations."""
+    samples = []
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        samples.append(time.time() - start)
+    return samples
+
+
+def make_script(size):
+    return ('# generated\r\n' * (size // 13 + 1))[:size]
+
+
+class Bench(object):
+    """The server under test and a client logged in to it."""
+
+    def __init__(self, server, use_tls, repeat):
+        self.server = server
+        self.use_tls = use_tls
+        self.repeat = repeat
+        self.client = self.connect()
+
+    def connect(self):
+        host, port = self.server.address
+        client = managesieve.ManageSieveClient(host, port,
+                                               use_tls=self.use_tls)
+        client.connect()
+        client.login('PLAIN', USER, PASSWORD)
+        return client
+
+    def close(self):
+        self.client.logout()
+
+
+@benchmark
+def connect(bench):
+    """Connect, STARTTLS when enabled, authenticate and log out."""
+    samples = measure(lambda: bench.connect().logout(), bench.repeat * 4)
+    return summarize(samples)
+
+
+@benchmark
+def listscripts_10k(bench):
+    mailbox = bench.server.mailbox(USER)
+    saved = dict(mailbox.scripts)
+    mailbox.scripts.update(('generated-script-%05d' % i, 'keep;\r\n')
+                           for i in range(10000))
+    try:
+        samples = measure(bench.client.list_scripts, bench.repeat)
+    finally:
+        mailbox.scripts.clear()
+        mailbox.scripts.update(saved)
+    result = summarize(samples)
+    result['entries_per_second'] = 10000 / min(samples)
+    return result
+
+
+def _transfer(samples, size):
+    result = summarize(samples)
+    result['bytes'] = size
+    result['mb_per_second'] = size / min(samples) / (1024 * 1024)
+    return result
+
+
+@benchmark
+def getscript(bench):
+    results = {}
+    for label, size in SIZES:
+        name = u'get-%s' % label
+        bench.server.mailbox(USER).scripts[str(name)] = make_script(size)
+        samples = measure(lambda: bench.client.get_script(name, decode=False),
+                          bench.repeat)
+        results[label] = _transfer(samples, size)
+    return results
+
+
+@benchmark
+def putscript(bench):
+    results = {}
+    for label, size in SIZES:
+        name = u'put-%s' % label
+        data = make_script(size)
+        samples = measure(lambda: bench.client.put_script(name, data),
+                          bench.repeat)
+        results[label] = _transfer(samples, size)
+    return results
+
+
+@benchmark
+def commands_per_second(bench, count=2000):
+    client = bench.client
+    start = time.time()
+    for i in range(count):
+        client.noop()
+    sequential = count / (time.time() - start)
+
+    pipeline = client.pipeline()
+    for i in range(count):
+        pipeline.noop()
+    start = time.time()
+    for result in pipeline.iter_execute():
+        pass
+    pipelined = count / (time.time() - start)
+    return {'commands': count, 'sequential': sequential,
+            'pipelined': pipelined}
+
+
+def version_label():
+    """Describe the checkout being measured."""
+    directory = os.path.dirname(os.path.abspath(managesieve.__file__))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'], cwd=directory,
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(names, use_tls, repeat):
+    if use_tls:
+        server = TLSSieveServer(users={USER: PASSWORD})
+        if server.certfile is None:
+            server.stop()
+            raise SystemExit("openssl is needed to create a certificate "
+                             "for --tls")
+    else:
+        server = SieveServer(users={USER: PASSWORD})
+    results = {}
+    with server:
+        bench = Bench(server, use_tls, repeat)
+        try:
+            for fn in BENCHMARKS:
+                if not names or fn.__name__ in names:
+                    print >>sys.stderr, "Running %s..." % fn.__name__
+                    results[fn.__name__] = fn(bench)
+        finally:
+            bench.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('names', metavar='BENCHMARK', nargs='*',
+                        help="Benchmarks to run (default: all of %s)" %
+                        ', '.join(fn.__name__ for fn in BENCHMARKS))
+    parser.add_argument('--tls', action='store_true',
+                        help="Use STARTTLS with a self-signed certificate")
+    parser.add_argument('-r', '--repeat', type=int, default=10,
+                        help="Runs of each measure (default: %(default)s)")
+    parser.add_argument('-l', '--label', default=None,
+                        help="Name of the version being measured (default: "
+                        "git describe)")
+    parser.add_argument('-o', '--output', metavar='FILENAME',
+                        help="Write the JSON results to FILENAME instead of "
+                        "stdout")
+    args = parser.parse_args()
+
+    report = {'label': args.label or version_label(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'tls': args.tls,
+              'repeat': args.repeat,
+              'time': time.time(),
+              'results': run(args.names, args.tls, args.repeat)}
+    data = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(data)
+    else:
+        sys.stdout.write(data)
+
+
+if __name__ == '__main__':
+    main()
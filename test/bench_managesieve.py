@@ -0,0 +1,530 @@
+#!/usr/bin/env python
+"""
+Micro benchmarks for the managesieve client.
+
+Run with::
+
+    $ PYTHONPATH=. python test/bench_managesieve.py [BENCHMARK ...]
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+from __future__ import with_statement
+import os
+import re
+import sys
+import time
+import shlex
+import codecs
+import logging
+import tempfile
+import StringIO
+import managesieve
+
+CRLF = '\r\n'
+
+BENCHMARKS = []
+
+
+def benchmark(fn):
+    BENCHMARKS.append(fn)
+    return fn
+
+
+def timeit(fn, repeat=5):
+    """Return the best wall clock time of `repeat` runs of `fn`."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, old, new):
+    print "%-40s old: %8.4fs  new: %8.4fs  (x%.1f)" % (name, old, new,
+                                                      old / max(new, 1e-9))
+
+
+class FakeSSLObject(object):
+    """Serve canned data like a SSLObject, one TLS record per read."""
+
+    def __init__(self, data, record_size=16384):
+        self.data = data
+        self.record_size = record_size
+        self.pos = 0
+
+    def read(self, size):
+        size = min(size, self.record_size)
+        data = self.data[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def recv_into(self, view):
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+
+class UnbufferedSSLFakeFile:
+    """The SSLFakeFile implementation shipped up to 0.4.4."""
+
+    def __init__(self, sslobj):
+        self.sslobj = sslobj
+
+    def readline(self):
+        str = ""
+        chr = None
+        while chr != "\n":
+            chr = self.sslobj.read(1)
+            str += chr
+        return str
+
+    def read(self, size=0):
+        if size == 0:
+            return ''
+        else:
+            return self.sslobj.read(size)
+
+
+class RegexParser(object):
+    """The regex and shlex based response reader shipped up to 0.4.4."""
+
+    _response = re.compile(r'''
+                           (?P<status>
+                           OK | NO | BYE
+                           )
+
+                           (?: \s \(
+                               (?P<code>.*)
+                               \)
+                           )?
+
+                           (?: \s
+                           (?P<data>.*)
+                           )?
+                           ''', re.VERBOSE)
+    _literal = re.compile(r'\{(?P<size>\d+)\+?\}$')
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def read_response(self):
+        lines = []
+        while True:
+            line = self.fd.readline()
+            line = line.rstrip("\r\n")
+            stat_match = self._response.match(line)
+            if stat_match:
+                resp = stat_match.groupdict()
+                data = resp.get('data')
+                if data:
+                    data = self._read_text(data)
+                    if isinstance(data, list) or isinstance(data, tuple):
+                        data = data[0]
+                return (resp.get('status'), resp.get('code'), data, lines[:])
+            else:
+                lines.append(self._read_text(line))
+
+    def _read_text(self, data):
+        lit_match = self._literal.match(data)
+        if data.startswith('"'):
+            return shlex.split(data)
+        elif lit_match:
+            return self.fd.read(int(lit_match.group('size')))
+        result = data.split(' ', 1)
+        if len(result) == 1:
+            result.append('')
+        return result
+
+
+def make_listscripts(count):
+    lines = ['"generated-script-%05d"' % i for i in range(count)]
+    return CRLF.join(lines) + CRLF + 'OK "Listscripts completed."' + CRLF
+
+
+def make_getscript(size):
+    script = ('# generated\r\n' * (size // 13 + 1))[:size]
+    return '{%d}%s%s%sOK "Getscript completed."%s' % (len(script), CRLF,
+                                                      script, CRLF, CRLF)
+
+
+def _read_lines(cls, data):
+    def run():
+        fd = cls(FakeSSLObject(data))
+        while True:
+            line = fd.readline()
+            if line.startswith('OK'):
+                break
+    return run
+
+
+def _read_literal(cls, data):
+    def run():
+        fd = cls(FakeSSLObject(data))
+        header = fd.readline()
+        size = int(header[1:header.index('}')])
+        chunks = []
+        while size:
+            chunk = fd.read(size)
+            chunks.append(chunk)
+            size -= len(chunk)
+        # what Response and get_script() used to do with the literal
+        script = ''.join(chunks)[:]
+        unicode(script, 'utf-8', 'replace').rstrip(u"\n")
+        fd.readline()
+        fd.readline()
+    return run
+
+
+def _readinto_literal(cls, data):
+    def run():
+        fd = cls(FakeSSLObject(data))
+        header = fd.readline()
+        buf = bytearray(int(header[1:header.index('}')]))
+        fd.readinto(buf)
+        fd.readline()
+        fd.readline()
+    return run
+
+
+@benchmark
+def tls_listscripts():
+    data = make_listscripts(10000)
+    old = timeit(_read_lines(UnbufferedSSLFakeFile, data), repeat=1)
+    new = timeit(_read_lines(managesieve.SSLFakeFile, data))
+    report("TLS readline, LISTSCRIPTS 10k entries", old, new)
+
+
+@benchmark
+def tls_getscript():
+    data = make_getscript(4 * 1024 * 1024)
+    old = timeit(_read_literal(UnbufferedSSLFakeFile, data))
+    new = timeit(_readinto_literal(managesieve.SSLFakeFile, data))
+    report("TLS read, GETSCRIPT 4MB literal (raw)", old, new)
+
+
+def _regex_parse(data, count):
+    def run():
+        fd = StringIO.StringIO(data)
+        parser = RegexParser(fd)
+        for i in range(count):
+            parser.read_response()
+    return run
+
+
+def _incremental_parse(data, count, chunk=16384):
+    def run():
+        parser = managesieve.ResponseParser()
+        for i in range(0, len(data), chunk):
+            parser.feed(data[i:i + chunk])
+            while parser.next_response() is not None:
+                pass
+    return run
+
+
+@benchmark
+def parse_listscripts():
+    data = make_listscripts(10000)
+    old = timeit(_regex_parse(data, 1))
+    new = timeit(_incremental_parse(data, 1))
+    report("parse, LISTSCRIPTS 10k entries", old, new)
+
+
+@benchmark
+def parse_capability():
+    response = CRLF.join([
+        '"IMPLEMENTATION" "Dovecot Pigeonhole"',
+        '"SIEVE" "fileinto reject envelope encoded-character vacation '
+        'subaddress comparator-i;ascii-numeric relational regex imap4flags '
+        'copy include variables body enotify environment mailbox date"',
+        '"NOTIFY" "mailto"',
+        '"SASL" "PLAIN LOGIN"',
+        '"STARTTLS"',
+        '"VERSION" "1.0"',
+        'OK "Dovecot ready."']) + CRLF
+    data = response * 2000
+    old = timeit(_regex_parse(data, 2000))
+    new = timeit(_incremental_parse(data, 2000))
+    report("parse, 2000 CAPABILITY responses", old, new)
+
+
+class NullSocket(object):
+    """A socket discarding what is sent, like SSLFakeSocket would."""
+
+    def sendall(self, data):
+        pass
+
+
+def _put_script_legacy(path):
+    def run():
+        # what cmd_put and put_script did up to 0.4.4
+        with codecs.open(path, 'r', 'utf-8') as fd:
+            data = fd.read()
+        data = data.encode('utf-8', 'replace')
+        literal = '{%d+}\r\n%s' % (len(data), data)
+        command = 'PUTSCRIPT "%s" %s' % ('script', literal)
+        NullSocket().sendall('%s\r\n' % command)
+    return run
+
+
+def _put_script_streamed(path):
+    def run():
+        client = managesieve.ManageSieveProtocol()
+        command = client._put_script_command(u'script', path=path)
+        command.send(NullSocket())
+    return run
+
+
+@benchmark
+def put_script_file():
+    path = tempfile.mktemp(suffix='.sieve')
+    with open(path, 'wb') as fd:
+        fd.write(make_getscript(16 * 1024 * 1024))
+    try:
+        old = timeit(_put_script_legacy(path))
+        new = timeit(_put_script_streamed(path))
+    finally:
+        os.unlink(path)
+    report("PUTSCRIPT 16MB file over TLS", old, new)
+
+
+class ReplaySocket(object):
+    """A socket receiving canned data."""
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def recv(self, size):
+        data = self.data[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def recv_into(self, view):
+        data = self.recv(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+
+class EagerTraceClient(managesieve.ManageSieveClient):
+    """Protocol tracing as done up to 0.4.4: messages are formatted, with
+    the whole data, whether the logger is enabled or not."""
+    log = logging.getLogger('managesieve')
+
+    def _next_response(self):
+        response = self._parser.next_response()
+        if response is not None:
+            self.log.debug("Returning response %r" % (
+                (response.status, response.code, response.text,
+                 response.data),))
+        return response
+
+    def _read_more(self):
+        self._arm()
+        view = self._parser.literal_buffer()
+        if view is not None:
+            count = self.fd.readinto(view)
+            self._received += count
+            self._parser.literal_received(count)
+        else:
+            data = self.fd.read1(self.fd.bufsize)
+            self._received += len(data)
+            self.log.debug("Read data: %r" % data)
+            self._parser.feed(data)
+
+    def _read_response(self):
+        self.log.debug("Waiting for response")
+        return managesieve.ManageSieveClient._read_response(self)
+
+
+class UntracedClient(managesieve.ManageSieveClient):
+    """The client without any protocol tracing."""
+
+    def _next_response(self):
+        return self._parser.next_response()
+
+    def _read_more(self):
+        self._arm()
+        view = self._parser.literal_buffer()
+        if view is not None:
+            count = self.fd.readinto(view)
+            self._received += count
+            self._parser.literal_received(count)
+        else:
+            data = self.fd.read1(self.fd.bufsize)
+            self._received += len(data)
+            self._parser.feed(data)
+
+
+def _read_responses(cls, data, count):
+    def run():
+        client = cls('localhost', 0)
+        client.socket.close()
+        client.fd = managesieve.SocketFile(ReplaySocket(data))
+        for i in range(count):
+            client._read_response()
+    return run
+
+
+@benchmark
+def trace_disabled():
+    count = 20000
+    data = (('OK "Done."' + CRLF) * count + make_getscript(4 * 1024 * 1024) +
+            make_listscripts(10000))
+    count += 2
+    logger = logging.getLogger('managesieve')
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    try:
+        eager = timeit(_read_responses(EagerTraceClient, data, count))
+        new = timeit(_read_responses(managesieve.ManageSieveClient, data,
+                                     count))
+        untraced = timeit(_read_responses(UntracedClient, data, count))
+    finally:
+        logger.setLevel(level)
+    report("read responses, DEBUG disabled", eager, new)
+    report("read responses, no tracing vs disabled", untraced, new)
+
+
+def _replay_client(data):
+    client = managesieve.ManageSieveClient('localhost', 0)
+    client.socket.close()
+    client.socket = NullSocket()
+    client.fd = managesieve.SocketFile(ReplaySocket(data))
+    client.state = 'AUTH'
+    return client
+
+
+@benchmark
+def iter_scripts():
+    data = make_listscripts(100000)
+    old = timeit(lambda: _replay_client(data).list_scripts()[0])
+    # keep the iterators, or the rest of the list is read when they are
+    # garbage collected
+    iterators = []
+
+    def first_entry():
+        iterators.append(_replay_client(data).iter_scripts())
+        return iterators[-1].next()
+
+    new = timeit(first_entry)
+    del iterators[:]
+    report("LISTSCRIPTS 100k entries, first entry", old, new)
+    old = timeit(lambda: len(_replay_client(data).list_scripts()))
+    new = timeit(lambda: sum(1 for entry in
+                             _replay_client(data).iter_scripts()))
+    report("LISTSCRIPTS 100k entries, all entries", old, new)
+
+
+class LegacyResponse(object):
+    """The Response shipped up to 0.4.4."""
+    OK = "OK"
+
+    def __init__(self, status, code, text, data):
+        self.status = status
+        self.code = code
+        if text is not None:
+            self.text = unicode(text, 'utf-8', 'replace')
+            self.text = self._clean_string(self.text)
+        else:
+            self.text = text
+        self.data = data[:]
+
+    @property
+    def is_ok(self):
+        return self.status == self.OK
+
+    def _clean_string(self, string):
+        string = string.replace(u"\r\n", u"\n")
+        string = string.rstrip(u"\n")
+        return string
+
+
+def _check_status(cls, count):
+    def run():
+        for i in xrange(count):
+            cls('OK', None, 'Putscript completed.', []).is_ok
+    return run
+
+
+def _size(response):
+    size = sys.getsizeof(response)
+    if hasattr(response, '__dict__'):
+        size += sys.getsizeof(response.__dict__)
+    return size
+
+
+@benchmark
+def response_status_only():
+    count = 200000
+    old = timeit(_check_status(LegacyResponse, count))
+    new = timeit(_check_status(managesieve.Response, count))
+    report("%dk responses, status checked only" % (count // 1000), old, new)
+    old = _size(LegacyResponse('OK', None, 'Done.', []))
+    new = _size(managesieve.Response('OK', None, 'Done.', []))
+    print "%-40s old: %8d   new: %8d   (x%.1f)" % (
+        "bytes per Response object", old, new, float(old) / new)
+
+
+SIEVE_SCRIPT = '''require ["fileinto", "imap4flags", "vacation"];
+# sort the mailing lists
+if header :contains "list-id" "<dev.lists.example.com>" {
+    fileinto "INBOX.dev";
+    stop;
+} elsif allof (header :is "x-spam-flag" "YES", size :over 10K) {
+    addflag "\\\\Seen";
+    fileinto "Junk";
+    stop;
+}
+vacation :days 7 :subject "Away" text:
+I am away until %d.
+.
+;
+'''.replace('\n', CRLF)
+
+
+@benchmark
+def validate_scripts():
+    from managesieve.sieve import Validator
+    scripts = [SIEVE_SCRIPT % i for i in range(500)]
+    validator = Validator()
+
+    def run():
+        for script in scripts:
+            validator.check(script, ['fileinto', 'imap4flags', 'vacation'])
+
+    old = timeit(lambda: (validator.clear(), run()))
+    new = timeit(run)
+    report("%d scripts validated, cached" % len(scripts), old, new)
+
+
+@benchmark
+def scram_keys():
+    from managesieve.scram import ScramClient, ScramKeyCache
+    server_first = ('r=rOprNGfwEbeRWgbNEkqO%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0,'
+                    's=W22ZaJ0SNY7soEsUEjb6gQ==,i=4096')
+    cache = ScramKeyCache()
+    count = 20
+
+    def run(key_cache):
+        for i in range(count):
+            ScramClient('SCRAM-SHA-256', 'user', 'pencil',
+                        nonce='rOprNGfwEbeRWgbNEkqO',
+                        key_cache=key_cache).final(server_first)
+
+    old = timeit(lambda: run(None))
+    new = timeit(lambda: run(cache))
+    report("%d SCRAM-SHA-256 logins, cached keys" % count, old, new)
+
+
+def main(names):
+    for fn in BENCHMARKS:
+        if not names or fn.__name__ in names:
+            fn()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+"""
+An in-process ManageSieve server for tests and benchmarks.
+
+The server keeps the scripts of its users in memory and implements enough of
+RFC 5804 to exercise the client: CAPABILITY, STARTTLS (when given a
+certificate), AUTHENTICATE with PLAIN, LOGIN and, when enabled in
+`mechanisms`, SCRAM-SHA-1 and SCRAM-SHA-256, the script management
+commands, NOOP and LOGOUT. ShapingSieveServer adds delays, throttling,
+partial writes, dropped connections and BYE responses on demand.
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import os
+import ssl
+import hmac
+import time
+import socket
+import hashlib
+import shutil
+import tempfile
+import binascii
+import threading
+import subprocess
+import SocketServer
+import managesieve
+
+CRLF = '\r\n'
+
+
+def quote(string):
+    return '"%s"' % string.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def literal(data):
+    return '{%d}%s%s' % (len(data), CRLF, data)
+
+
+def make_certificate(directory):
+    """Create a self-signed certificate with `openssl` in `directory`.
+
+    Returns the (certfile, keyfile) pair, or None if openssl is missing.
+    """
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['openssl', 'req', '-x509', '-nodes',
+                                   '-newkey', 'rsa:2048', '-days', '1',
+                                   '-subj', '/CN=localhost',
+                                   '-keyout', keyfile, '-out', certfile],
+                                  stdout=devnull, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return certfile, keyfile
+
+
+class Mailbox(object):
+    """The scripts of a user."""
+
+    def __init__(self):
+        self.scripts = {}
+        self.active = None
+
+
+class SieveHandler(SocketServer.BaseRequestHandler):
+
+    def setup(self):
+        self.server.connections.add(self.request)
+        self.sock = self.request
+        self.parser = managesieve.ResponseParser()
+        self.user = None
+        self.tls = False
+
+    def handle(self):
+        try:
+            self.serve()
+        except socket.error:
+            # the client went away, ssl.SSLError is a socket.error too
+            pass
+        finally:
+            self.server.connections.discard(self.request)
+
+    def serve(self):
+        self.send_capabilities('OK "ManageSieve test server ready."')
+        while True:
+            line = self.read_line()
+            if line is None or not line:
+                return
+            name = str(line[0]).upper()
+            with self.server.lock:
+                self.server.commands.append(name)
+            if self.run_command(name, [str(arg) for arg in line[1:]]) is False:
+                return
+
+    def run_command(self, name, args):
+        """Run a command; returns False when the connection must be
+        closed."""
+        method = getattr(self, 'cmd_%s' % name.lower(), None)
+        if method is None:
+            self.send('NO "Unknown command %s"' % name)
+            return
+        if name not in ('CAPABILITY', 'STARTTLS', 'AUTHENTICATE',
+                        'NOOP', 'LOGOUT') and self.user is None:
+            self.send('NO "Authenticate first."')
+            return
+        return method(*args)
+
+    # I/O
+
+    def read_line(self):
+        while True:
+            item = self.parser.next_item()
+            if item is not None:
+                return item
+            data = self.sock.recv(65536)
+            if not data:
+                return None
+            self.parser.feed(data)
+
+    def send(self, data):
+        self.sock.sendall(data + CRLF)
+
+    def send_capabilities(self, status='OK'):
+        server = self.server
+        lines = ['"IMPLEMENTATION" "managesieve test server"',
+                 '"SIEVE" %s' % quote(' '.join(server.extensions)),
+                 '"SASL" %s' % quote(' '.join(server.mechanisms)),
+                 '"VERSION" "1.0"']
+        if server.certfile and not self.tls:
+            lines.append('"STARTTLS"')
+        self.send(CRLF.join(lines + [status]))
+
+    @property
+    def mailbox(self):
+        return self.server.mailbox(self.user)
+
+    # Commands
+
+    def cmd_capability(self):
+        self.send_capabilities()
+
+    def cmd_noop(self, tag=None):
+        if tag is not None:
+            self.send('OK (TAG %s) "Done"' % quote(tag))
+        else:
+            self.send('OK "NOOP completed"')
+
+    def cmd_logout(self):
+        self.send('OK "Logout completed."')
+        return False
+
+    def cmd_starttls(self):
+        if not self.server.certfile or self.tls:
+            self.send('NO "TLS not available."')
+            return
+        self.send('OK "Begin TLS negotiation now."')
+        self.sock = ssl.wrap_socket(self.sock, server_side=True,
+                                    certfile=self.server.certfile,
+                                    keyfile=self.server.keyfile)
+        self.tls = True
+        self.send_capabilities()
+
+    def cmd_authenticate(self, mechanism, initial=None):
+        mechanism = mechanism.upper()
+        if self.user is not None:
+            self.send('NO "Already authenticated."')
+            return
+        if mechanism not in self.server.mechanisms:
+            self.send('NO "Unsupported mechanism."')
+            return
+        if mechanism.startswith('SCRAM-'):
+            self.user = self.scram(mechanism, initial)
+            return
+        if mechanism == 'PLAIN':
+            if initial is None:
+                self.send('""')
+                initial = str(self.read_line()[0])
+            authzid, user, password = binascii.a2b_base64(initial).split('\0')
+        elif mechanism == 'LOGIN':
+            if initial is None:
+                self.send(quote(binascii.b2a_base64('Username:')[:-1]))
+                initial = str(self.read_line()[0])
+            user = binascii.a2b_base64(initial)
+            self.send(quote(binascii.b2a_base64('Password:')[:-1]))
+            password = binascii.a2b_base64(str(self.read_line()[0]))
+        else:
+            self.send('NO "Unsupported mechanism."')
+            return
+        if self.server.users.get(user) != password:
+            self.send('NO "Authentication failed."')
+            return
+        self.user = user
+        self.send('OK "Logged in."')
+
+    def scram(self, mechanism, initial):
+        """Run a SCRAM exchange; return the user, or None on failure."""
+        digest = {'SCRAM-SHA-1': hashlib.sha1,
+                  'SCRAM-SHA-256': hashlib.sha256}[mechanism]
+        b64 = lambda data: binascii.b2a_base64(data)[:-1]
+        if initial is None:
+            self.send('""')
+            initial = str(self.read_line()[0])
+        client_first_bare = binascii.a2b_base64(initial).split(',', 2)[2]
+        attributes = dict(item.split('=', 1)
+                          for item in client_first_bare.split(','))
+        user = attributes['n'].replace('=2C', ',').replace('=3D', '=')
+        nonce = attributes['r'] + binascii.b2a_hex(os.urandom(8))
+        # a fixed salt per user, as if the password had been set once
+        salt = hashlib.sha1(user).digest()
+        server_first = 'r=%s,s=%s,i=%d' % (nonce, b64(salt),
+                                           self.server.scram_iterations)
+        self.send(quote(b64(server_first)))
+
+        response = str(self.read_line()[0])
+        if response == '*':
+            self.send('NO "Authentication cancelled."')
+            return None
+        without_proof, proof = binascii.a2b_base64(response).rsplit(',p=', 1)
+        password = self.server.users.get(user)
+        if password is None or not without_proof.endswith(',r=' + nonce):
+            self.send('NO "Authentication failed."')
+            return None
+        salted = hashlib.pbkdf2_hmac(digest().name, password, salt,
+                                     self.server.scram_iterations)
+        client_key = hmac.new(salted, 'Client Key', digest).digest()
+        auth_message = ','.join([client_first_bare, server_first,
+                                 without_proof])
+        signature = hmac.new(digest(client_key).digest(), auth_message,
+                             digest).digest()
+        proof = binascii.a2b_base64(proof)
+        if ''.join(chr(ord(a) ^ ord(b))
+                   for a, b in zip(proof, signature)) != client_key:
+            self.send('NO "Authentication failed."')
+            return None
+        server_key = hmac.new(salted, 'Server Key', digest).digest()
+        server_final = 'v=' + b64(hmac.new(server_key, auth_message,
+                                           digest).digest())
+        if self.server.scram_final_in_code:
+            self.send('OK (SASL %s) "Logged in."' % quote(b64(server_final)))
+        else:
+            self.send(quote(b64(server_final)))
+            if str(self.read_line()[0]) != '':
+                self.send('NO "Authentication failed."')
+                return None
+            self.send('OK "Logged in."')
+        return user
+
+    def cmd_listscripts(self):
+        mailbox = self.mailbox
+        lines = []
+        with self.server.lock:
+            for name in sorted(mailbox.scripts):
+                if name == mailbox.active:
+                    lines.append('%s ACTIVE' % quote(name))
+                else:
+                    lines.append(quote(name))
+        lines.append('OK "Listscripts completed."')
+        self.send(CRLF.join(lines))
+
+    def cmd_getscript(self, name):
+        with self.server.lock:
+            data = self.mailbox.scripts.get(name)
+        if data is None:
+            self.send('NO (NONEXISTENT) "There is no script by that name"')
+        else:
+            self.send(literal(data) + CRLF + 'OK "Getscript completed."')
+
+    def cmd_putscript(self, name, data):
+        if len(data) > self.server.max_script_size:
+            self.send('NO (QUOTA/MAXSIZE) "Quota exceeded"')
+            return
+        with self.server.lock:
+            self.mailbox.scripts[name] = data
+        self.send('OK "Putscript completed."')
+
+    def cmd_havespace(self, name, size):
+        if int(size) > self.server.max_script_size:
+            self.send('NO (QUOTA/MAXSIZE) "Quota exceeded"')
+        else:
+            self.send('OK "Putscript would succeed."')
+
+    def cmd_setactive(self, name):
+        mailbox = self.mailbox
+        with self.server.lock:
+            if name and name not in mailbox.scripts:
+                self.send('NO (NONEXISTENT) "There is no script by that '
+                          'name"')
+                return
+            mailbox.active = name or None
+        self.send('OK "Setactive completed."')
+
+    def cmd_deletescript(self, name):
+        mailbox = self.mailbox
+        with self.server.lock:
+            if name not in mailbox.scripts:
+                self.send('NO (NONEXISTENT) "There is no script by that '
+                          'name"')
+                return
+            if name == mailbox.active:
+                self.send('NO (ACTIVE) "You may not delete an active '
+                          'script"')
+                return
+            del mailbox.scripts[name]
+        self.send('OK "Deletescript completed."')
+
+    def cmd_renamescript(self, old_name, new_name):
+        mailbox = self.mailbox
+        with self.server.lock:
+            if old_name not in mailbox.scripts:
+                self.send('NO (NONEXISTENT) "There is no script by that '
+                          'name"')
+                return
+            if new_name in mailbox.scripts:
+                self.send('NO (ALREADYEXISTS) "A script with that name '
+                          'already exists"')
+                return
+            mailbox.scripts[new_name] = mailbox.scripts.pop(old_name)
+            if mailbox.active == old_name:
+                mailbox.active = new_name
+        self.send('OK "Renamescript completed."')
+
+
+class Shaping(object):
+    """How a ShapingSieveServer degrades its service.
+
+    `delays` maps command names to the seconds waited before running them,
+    the '*' entry applying to the others; responses are sent at most
+    `bandwidth` bytes per second, in writes of at most `chunk_size` bytes.
+    The connection is closed without a response when one of the `drop`
+    commands is received, after `truncate[name]` bytes of the response of
+    the command `name`, or after a BYE response with the text `bye[name]`.
+    Every setting can be changed while the server runs.
+    """
+
+    def __init__(self, delays=None, bandwidth=None, chunk_size=None,
+                 drop=(), truncate=None, bye=None):
+        self.delays = delays or {}
+        self.bandwidth = bandwidth
+        self.chunk_size = chunk_size
+        self.drop = set(drop)
+        self.truncate = truncate or {}
+        self.bye = bye or {}
+
+    def delay(self, name):
+        return self.delays.get(name, self.delays.get('*', 0))
+
+
+class _Closed(Exception):
+    """Raised to close the connection in the middle of a response."""
+
+
+class ShapingHandler(SieveHandler):
+    """A SieveHandler applying the Shaping of its server."""
+
+    def serve(self):
+        try:
+            SieveHandler.serve(self)
+        except _Closed:
+            pass
+
+    def run_command(self, name, args):
+        shaping = self.server.shaping
+        delay = shaping.delay(name)
+        if delay:
+            time.sleep(delay)
+        if name in shaping.drop:
+            return False
+        if name in shaping.bye:
+            self.send('BYE %s' % quote(shaping.bye[name]))
+            return False
+        self.command = name
+        return SieveHandler.run_command(self, name, args)
+
+    def send(self, data):
+        shaping = self.server.shaping
+        data += CRLF
+        limit = shaping.truncate.get(getattr(self, 'command', None))
+        if limit is not None:
+            data = data[:limit]
+        chunk_size = shaping.chunk_size or len(data)
+        for i in range(0, len(data), chunk_size):
+            chunk = data[i:i + chunk_size]
+            self.sock.sendall(chunk)
+            if shaping.bandwidth:
+                time.sleep(float(len(chunk)) / shaping.bandwidth)
+        if limit is not None:
+            raise _Closed
+
+
+class SieveServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """A threaded ManageSieve server listening on a random loopback port.
+
+    Use it as a context manager, or call `start()` and `stop()`::
+
+        with SieveServer(users={'user': 'secret'}) as server:
+            client = ManageSieveClient(*server.address, use_tls=False)
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+    extensions = ['fileinto', 'reject', 'envelope', 'vacation', 'imap4flags',
+                  'copy', 'include', 'variables', 'body', 'relational',
+                  'regex', 'subaddress']
+    max_script_size = 64 * 1024 * 1024
+    mechanisms = ['PLAIN', 'LOGIN']
+    scram_iterations = 4096
+    # whether the SCRAM server-final message comes with OK, or as a last
+    # challenge
+    scram_final_in_code = True
+
+    def __init__(self, users=None, certfile=None, keyfile=None,
+                 handler=SieveHandler):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0), handler)
+        self.users = users or {'user': 'secret'}
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.lock = threading.RLock()
+        self.mailboxes = {}
+        self.connections = set()
+        # names of the commands received, in order
+        self.commands = []
+        self._thread = None
+
+    @property
+    def address(self):
+        return self.server_address
+
+    def mailbox(self, user):
+        with self.lock:
+            return self.mailboxes.setdefault(user, Mailbox())
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for sock in list(self.connections):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class ShapingSieveServer(SieveServer):
+    """A SieveServer slowed down and made to fail as told by its `shaping`,
+    for testing how the client copes with slow or broken servers::
+
+        server = ShapingSieveServer(Shaping(delays={'GETSCRIPT': 0.5}))
+    """
+
+    def __init__(self, shaping=None, users=None, certfile=None, keyfile=None,
+                 handler=ShapingHandler):
+        SieveServer.__init__(self, users, certfile, keyfile, handler)
+        self.shaping = shaping or Shaping()
+
+
+class TLSSieveServer(SieveServer):
+    """A SieveServer offering STARTTLS with a temporary self-signed
+    certificate; `certfile` is None when openssl is not available."""
+
+    def __init__(self, users=None, handler=SieveHandler):
+        self.tempdir = tempfile.mkdtemp()
+        certfile, keyfile = make_certificate(self.tempdir) or (None, None)
+        SieveServer.__init__(self, users, certfile, keyfile, handler)
+
+    def stop(self):
+        SieveServer.stop(self)
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+
+class TLSShapingSieveServer(TLSSieveServer):
+    """A ShapingSieveServer offering STARTTLS, like TLSSieveServer."""
+
+    def __init__(self, shaping=None, users=None):
+        TLSSieveServer.__init__(self, users, ShapingHandler)
+        self.shaping = shaping or Shaping()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Unit tests for managesieve.async_client
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import unittest
+import managesieve
+from managesieve.async_client import AsyncManageSieveClient, run
+from sieveserver import SieveServer, TLSSieveServer
+
+USERS = dict(('user%d' % i, 'secret%d' % i) for i in range(20))
+
+
+class AsyncClientTest(unittest.TestCase):
+    server_class = SieveServer
+
+    def setUp(self):
+        self.server = self.server_class(users=USERS).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def client(self, sockets, use_tls=False):
+        host, port = self.server.address
+        return AsyncManageSieveClient(host, port, use_tls=use_tls,
+                                      map=sockets)
+
+    def test_many_clients(self):
+        sockets = {}
+        results = []
+        for user, password in sorted(USERS.items()):
+            client = self.client(sockets)
+            client.connect()
+            client.login('', user, password)
+            client.put_script(u'rules', u'# %s\r\nkeep;\r\n' % user)
+            client.set_active(u'rules')
+            scripts = client.list_scripts()
+            script = client.get_script(u'rules')
+            client.logout()
+            results.append((user, scripts, script))
+        run(sockets)
+
+        self.assertEqual(sockets, {})
+        for user, scripts, script in results:
+            self.assertEqual(scripts.result(), [(u'rules', True)])
+            self.assertEqual(script.result(), u'# %s\r\nkeep;\r' % user)
+
+    def test_errors_are_per_operation(self):
+        sockets = {}
+        client = self.client(sockets)
+        connected = client.connect()
+        denied = client.list_scripts()
+        client.authenticate('PLAIN', '', 'user1', 'secret1')
+        missing = client.get_script(u'missing')
+        space = client.have_space(u'big', 1024 * 1024 * 1024)
+        client.put_script(u'small', u'keep;')
+        scripts = client.list_scripts()
+        client.logout()
+        run(sockets)
+
+        self.assertEqual(connected.result().status, 'OK')
+        self.assertRaises(managesieve.InvalidState, denied.result)
+        self.assertRaises(managesieve.CommandFailed, missing.result)
+        self.assertEqual(missing.error.response.code, 'NONEXISTENT')
+        self.assertEqual(space.result().code, 'QUOTA/MAXSIZE')
+        self.assertEqual(scripts.result(), [(u'small', False)])
+
+    def test_connection_refused(self):
+        host, port = self.server.address
+        self.server.stop()
+        self.server = self.server_class().start()
+        sockets = {}
+        client = AsyncManageSieveClient(host, port, use_tls=False,
+                                        map=sockets)
+        connected = client.connect()
+        scripts = client.list_scripts()
+        run(sockets)
+        self.assertRaises(managesieve.ConnectionError, connected.result)
+        self.assertRaises(managesieve.ConnectionError, scripts.result)
+
+
+class AsyncTLSClientTest(AsyncClientTest):
+    server_class = TLSSieveServer
+
+    def setUp(self):
+        AsyncClientTest.setUp(self)
+        if self.server.certfile is None:
+            self.skipTest("openssl is not available")
+
+    def client(self, sockets, use_tls=True):
+        return AsyncClientTest.client(self, sockets, use_tls)
+
+    def test_starttls(self):
+        sockets = {}
+        client = self.client(sockets)
+        connected = client.connect()
+        client.login('', 'user2', 'secret2')
+        scripts = client.list_scripts()
+        client.logout()
+        run(sockets)
+        self.assertEqual(connected.result().text,
+                         u'Begin TLS negotiation now.')
+        self.assertEqual(client.login_mechs, ['PLAIN', 'LOGIN'])
+        self.assertFalse(client.tls_support)
+        self.assertEqual(scripts.result(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Unit tests for managesieve.capabilities
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+import threading
+import managesieve
+from managesieve.capabilities import CapabilityCache
+from sieveserver import SieveServer
+
+logging.getLogger('managesieve').addHandler(logging.NullHandler())
+
+
+class CapabilityCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'cache', 'capabilities.json')
+        self.cache = CapabilityCache(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_put_and_get(self):
+        self.assertEqual(self.cache.get('example.com', 4190), None)
+        self.cache.put('example.com', 4190, [['SASL', 'PLAIN'],
+                                             ['STARTTLS']])
+        cache = CapabilityCache(self.path)
+        self.assertEqual(cache.get('example.com', 4190),
+                         [['SASL', 'PLAIN'], ['STARTTLS']])
+        self.assertEqual(cache.get('example.com', 2000), None)
+        self.assertEqual(os.stat(os.path.dirname(self.path)).st_mode & 0777,
+                         0700)
+
+    def test_ttl(self):
+        self.cache.put('example.com', 4190, [['STARTTLS']])
+        self.assertEqual(CapabilityCache(self.path, ttl=-1).get(
+            'example.com', 4190), None)
+
+    def test_corrupted_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as fd:
+            fd.write('{"truncated')
+        self.assertEqual(self.cache.get('example.com', 4190), None)
+        self.cache.put('example.com', 4190, [['STARTTLS']])
+        self.assertEqual(self.cache.get('example.com', 4190), [['STARTTLS']])
+
+    def test_concurrent_puts(self):
+        # each session stores the capabilities through its own cache
+        def put(n):
+            for port in range(20):
+                CapabilityCache(self.path).put('host%d' % n, port,
+                                               [['STARTTLS']])
+        threads = [threading.Thread(target=put, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for n in range(8):
+            for port in range(20):
+                self.assertEqual(self.cache.get('host%d' % n, port),
+                                 [['STARTTLS']])
+
+    def test_store_and_apply(self):
+        with SieveServer() as server:
+            host, port = server.address
+            client = managesieve.ManageSieveClient(host, port, use_tls=False)
+            client.connect()
+            client.logout()
+        self.cache.store(client)
+
+        client = managesieve.ManageSieveClient(host, port, use_tls=False)
+        self.assertTrue(self.cache.apply(client))
+        self.assertEqual(client.login_mechs, ['PLAIN', 'LOGIN'])
+        self.assertEqual(client.implementation, 'managesieve test server')
+        self.assertTrue('fileinto' in client.capabilities)
+        client.socket.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
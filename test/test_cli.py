@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""Unit tests for managesieve.cli
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import os
+import sys
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+import unittest
+import StringIO
+from managesieve import cli
+from managesieve.metrics import Metrics
+from managesieve.utils import write_json
+from sieveserver import SieveServer
+
+# keep the "No handlers could be found" warning out of the captured stderr
+logging.getLogger('managesieve').addHandler(logging.NullHandler())
+
+USERS = dict(('user%d' % i, 'secret%d' % i) for i in range(6))
+
+
+def make_args(cmd, **kwargs):
+    args = dict(account=None, accounts=None, all_accounts=False, workers=3,
+                cmd=cmd)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+class MultiAccountTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SieveServer(users=USERS).start()
+        host, port = self.server.address
+        self.config = {'general': {}}
+        for user, password in USERS.items():
+            self.config[user] = {'remote.host': host,
+                                 'remote.port': str(port),
+                                 'remote.user': user,
+                                 'remote.password': password}
+            mailbox = self.server.mailbox(user)
+            mailbox.scripts['%s-rules' % user] = 'keep;'
+            mailbox.active = '%s-rules' % user
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        self.server.stop()
+
+    def run_accounts(self, args):
+        names = cli.select_accounts(args, self.config)
+        status = cli.run_accounts(args, self.config, names)
+        return status, sys.stdout.getvalue(), sys.stderr.getvalue()
+
+    def test_all_accounts(self):
+        status, out, err = self.run_accounts(make_args('list',
+                                                       all_accounts=True))
+        self.assertEqual(status, 0)
+        self.assertEqual(err, '')
+        self.assertEqual(out.splitlines(),
+                         ['user%d: * user%d-rules' % (i, i)
+                          for i in range(6)])
+
+    def test_failures_summary(self):
+        self.config['user1']['remote.password'] = 'wrong'
+        status, out, err = self.run_accounts(
+            make_args('get', accounts='user0,user1,missing',
+                      name='user0-rules'))
+        self.assertEqual(status, 1)
+        self.assertEqual(out.splitlines(), ['user0: keep;'])
+        lines = err.splitlines()
+        self.assertTrue(lines[0].startswith('user1: ERROR: '))
+        self.assertEqual(lines[1], "missing: Account configuration 'missing' "
+                         "not found")
+        self.assertEqual(lines[2], '2 of 3 accounts failed:')
+        self.assertTrue(lines[3].startswith('  user1: ERROR: '))
+
+    def test_command_failure(self):
+        status, out, err = self.run_accounts(
+            make_args('get', accounts='user2,user3', name='user2-rules'))
+        self.assertEqual(status, 1)
+        self.assertEqual(out.splitlines(), ['user2: keep;'])
+        self.assertTrue(err.startswith('user3: ERROR: '))
+
+    def test_put_minify(self):
+        fd, path = tempfile.mkstemp(suffix='.sieve')
+        try:
+            os.write(fd, '/* generated */\nkeep;\n')
+            os.close(fd)
+            status, out, err = self.run_accounts(
+                make_args('put', accounts='user1', name=path,
+                          destfile='rules', minify=True))
+            self.assertEqual(status, 0)
+            self.assertEqual(self.server.mailbox('user1').scripts['rules'],
+                             'keep;\r\n')
+        finally:
+            os.unlink(path)
+
+    def test_invalid_script(self):
+        fd, path = tempfile.mkstemp(suffix='.sieve')
+        try:
+            os.write(fd, 'require "fileinto";\nfileinto "a"\n')
+            os.close(fd)
+            args = make_args('put', accounts='user4,user5', name=path,
+                             destfile='rules', no_validate=False)
+            status, out, err = self.run_accounts(args)
+            self.assertEqual(status, 1)
+            self.assertTrue(err.startswith('user4: ERROR: %s: line 3, '
+                                           'column 1: ' % path))
+            self.assertFalse('rules' in self.server.mailbox('user4').scripts)
+
+            args.no_validate = True
+            status, out, err = self.run_accounts(args)
+            self.assertTrue('rules' in self.server.mailbox('user4').scripts)
+        finally:
+            os.unlink(path)
+
+
+class ValidateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, data in [('a.sieve', 'keep;\n'),
+                           ('b/c.sieve', 'require "regex";\nkeep;\n'),
+                           ('b/d.sieve', 'keep;\nstop\n'),
+                           ('b/notes.txt', 'not a script')]:
+            path = os.path.join(self.directory, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.mkdir(os.path.dirname(path))
+            with open(path, 'w') as fd:
+                fd.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def validate(self, **kwargs):
+        args = dict(paths=[self.directory], jobs=1, extensions=None,
+                    errors_only=False)
+        args.update(kwargs)
+        out, err = StringIO.StringIO(), StringIO.StringIO()
+        status = cli.run_validate(argparse.Namespace(**args), out, err)
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        for result in results:
+            result['path'] = os.path.relpath(result['path'], self.directory)
+        return status, results, err.getvalue()
+
+    def test_validate(self):
+        for jobs in (1, 2):
+            status, results, err = self.validate(jobs=jobs)
+            self.assertEqual(status, 1)
+            self.assertEqual(results, [
+                {'path': 'a.sieve', 'valid': True},
+                {'path': 'b/c.sieve', 'valid': True},
+                {'path': 'b/d.sieve', 'valid': False, 'line': 3,
+                 'column': 1, 'error': 'unexpected end of script, expected '
+                 '";" or "{"'}])
+            self.assertEqual(err, '3 scripts checked, 1 invalid\n')
+
+    def test_extensions(self):
+        status, results, err = self.validate(
+            paths=[os.path.join(self.directory, 'b', 'c.sieve')],
+            extensions='fileinto, vacation')
+        self.assertEqual(status, 1)
+        self.assertEqual(results[0]['error'],
+                         'extension "regex" is not supported')
+
+    def test_errors_only(self):
+        os.unlink(os.path.join(self.directory, 'b', 'd.sieve'))
+        status, results, err = self.validate(errors_only=True,
+                                             paths=[self.directory,
+                                                    'missing.sieve'])
+        self.assertEqual(status, 1)
+        self.assertEqual([result['path'] for result in results],
+                         [os.path.relpath('missing.sieve', self.directory)])
+        status, results, err = self.validate(errors_only=True)
+        self.assertEqual((status, results), (0, []))
+
+
+
+class MetricsFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.umask = os.umask(022)
+
+    def tearDown(self):
+        os.umask(self.umask)
+        shutil.rmtree(self.tempdir)
+
+    def test_readable_by_other_users(self):
+        path = os.path.join(self.tempdir, 'textfile', 'sieve.prom')
+        cli.write_metrics_file(path, Metrics())
+        self.assertEqual(os.stat(path).st_mode & 0777, 0644)
+        self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0777,
+                         0755)
+
+    def test_caches_are_private(self):
+        path = os.path.join(self.tempdir, 'cache', 'manifest.json')
+        write_json(path, {})
+        self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+        self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0777,
+                         0700)
+
+if __name__ == "__main__":
+    unittest.main()
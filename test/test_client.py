@@ -0,0 +1,711 @@
+#!/usr/bin/env python
+"""Unit tests for the managesieve client transport and protocol handling.
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import os
+import ssl
+import gzip
+import socket
+import shutil
+import logging
+import tempfile
+import unittest
+import contextlib
+import StringIO
+import managesieve
+from sieveserver import SieveServer, TLSSieveServer, SieveHandler
+
+CRLF = '\r\n'
+
+
+class FakeSSLObject(object):
+    """Serve canned data like a SSLObject, at most `chunk` bytes per read."""
+
+    def __init__(self, data, chunk=16384):
+        self.data = data
+        self.chunk = chunk
+        self.pos = 0
+        self.reads = 0
+        self.written = []
+
+    def read(self, size):
+        self.reads += 1
+        size = min(size, self.chunk)
+        data = self.data[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+    def recv_into(self, view):
+        data = self.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        # accept at most 3 bytes per call to exercise partial writes
+        data = memoryview(data)[:3].tobytes()
+        self.written.append(data)
+        return len(data)
+
+
+class FakeSocket(object):
+    """A socket replaying canned server data, `chunk` bytes per recv."""
+
+    def __init__(self, data, chunk=16384):
+        self.sslobj = FakeSSLObject(data, chunk)
+        self.sent = []
+
+    def recv(self, size):
+        return self.sslobj.read(size)
+
+    def recv_into(self, view):
+        return self.sslobj.recv_into(view)
+
+    def send(self, data):
+        # the client may reuse the buffer it sent from
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        self.sent.append(str(data))
+        return len(data)
+
+    sendall = send
+
+    def close(self):
+        pass
+
+
+def make_client(data, chunk=16384, state='AUTH'):
+    client = managesieve.ManageSieveClient('localhost', 4190)
+    client.socket = FakeSocket(data, chunk)
+    client.fd = managesieve.SocketFile(client.socket)
+    client.state = state
+    return client
+
+
+class SSLFakeFileTest(unittest.TestCase):
+
+    def test_readline(self):
+        lines = ['"script%d"%s' % (i, CRLF) for i in range(1000)]
+        sslobj = FakeSSLObject(''.join(lines) + 'OK' + CRLF, chunk=100)
+        fd = managesieve.SSLFakeFile(sslobj)
+        for line in lines:
+            self.assertEqual(fd.readline(), line)
+        self.assertEqual(fd.readline(), 'OK' + CRLF)
+        self.assertEqual(fd.readline(), '')
+        self.assertTrue(sslobj.reads < 200)
+
+    def test_readline_without_newline_at_eof(self):
+        fd = managesieve.SSLFakeFile(FakeSSLObject('OK' + CRLF + 'BYE', 4))
+        self.assertEqual(fd.readline(), 'OK' + CRLF)
+        self.assertEqual(fd.readline(), 'BYE')
+        self.assertEqual(fd.readline(), '')
+
+    def test_read_mixed_with_readline(self):
+        script = 'require "fileinto";' + CRLF + 'keep;' + CRLF
+        data = '{%d}%s%s%sOK%s' % (len(script), CRLF, script, CRLF, CRLF)
+        fd = managesieve.SSLFakeFile(FakeSSLObject(data, chunk=7))
+        self.assertEqual(fd.readline(), '{%d}%s' % (len(script), CRLF))
+        self.assertEqual(fd.read(len(script)), script)
+        self.assertEqual(fd.readline(), CRLF)
+        self.assertEqual(fd.readline(), 'OK' + CRLF)
+        self.assertEqual(fd.read(0), '')
+
+    def test_read_short_at_eof(self):
+        fd = managesieve.SSLFakeFile(FakeSSLObject('abc', chunk=2))
+        self.assertEqual(fd.read(10), 'abc')
+        self.assertEqual(fd.read(10), '')
+
+
+class SSLFakeSocketTest(unittest.TestCase):
+
+    def test_sendall_partial_writes(self):
+        sslobj = FakeSSLObject('')
+        sock = managesieve.SSLFakeSocket(None, sslobj)
+        self.assertEqual(sock.send('LISTSCRIPTS' + CRLF), 13)
+        self.assertEqual(''.join(sslobj.written), 'LISTSCRIPTS' + CRLF)
+
+
+class EncoderTest(unittest.TestCase):
+
+    def sent(self, method, *args, **kwargs):
+        client = make_client('OK' + CRLF)
+        client.sync_literals = kwargs.get('sync_literals', False)
+        getattr(client, method)(*args)
+        self.assertEqual(len(client.socket.sent), 1)
+        return client.socket.sent[0]
+
+    def test_quoted_escapes(self):
+        self.assertEqual(self.sent('delete_script', u'a "b" \\ c'),
+                         'DELETESCRIPT "a \\"b\\" \\\\ c"' + CRLF)
+        self.assertEqual(self.sent('delete_script', u'caf\xe9'),
+                         'DELETESCRIPT "caf\xc3\xa9"' + CRLF)
+
+    def test_literals(self):
+        self.assertEqual(self.sent('delete_script', u'a\r\nb'),
+                         'DELETESCRIPT {4+}' + CRLF + 'a\r\nb' + CRLF)
+        name = u'x' * (managesieve.MAX_QUOTED + 1)
+        self.assertEqual(self.sent('delete_script', name),
+                         'DELETESCRIPT {%d+}%s%s%s' % (len(name), CRLF, name,
+                                                       CRLF))
+
+    def test_small_script_is_quoted(self):
+        self.assertEqual(self.sent('put_script', u'a', u'keep;'),
+                         'PUTSCRIPT "a" "keep;"' + CRLF)
+        self.assertEqual(self.sent('put_script', u'a', '\xff'),
+                         'PUTSCRIPT "a" {1+}' + CRLF + '\xff' + CRLF)
+
+    def test_sync_literals(self):
+        self.assertEqual(self.sent('put_script', u'a', u'keep;\r\n',
+                                   sync_literals=True),
+                         'PUTSCRIPT "a" {7}' + CRLF + 'keep;' + CRLF + CRLF)
+
+
+class ListScriptsTest(unittest.TestCase):
+
+    def test_list_scripts(self):
+        data = CRLF.join(['"first"', '{6}', 'second ACTIVE', '"th\\"ird"',
+                          'OK "Listscripts completed."']) + CRLF
+        client = make_client(data, chunk=5)
+        self.assertEqual(client.list_scripts(), [(u'first', False),
+                                                 (u'second', True),
+                                                 (u'th"ird', False)])
+        self.assertEqual(client.socket.sent, ['LISTSCRIPTS' + CRLF])
+
+    def test_list_scripts_failure(self):
+        client = make_client('NO "Nope."' + CRLF)
+        self.assertRaises(managesieve.CommandFailed, client.list_scripts)
+
+    def test_iter_scripts(self):
+        data = CRLF.join(['"first"', '{6}', 'second ACTIVE', '"th\\"ird"',
+                          'OK "Listscripts completed."']) + CRLF
+        client = make_client(data, chunk=5)
+        scripts = client.iter_scripts()
+        self.assertEqual(scripts.next(), (u'first', False))
+        # the first entry is returned as soon as it has been received
+        self.assertEqual(client.socket.sslobj.pos, 10)
+        self.assertEqual(list(scripts), [(u'second', True),
+                                         (u'th"ird', False)])
+        self.assertEqual(client.socket.sent, ['LISTSCRIPTS' + CRLF])
+
+    def test_iter_scripts_left_early(self):
+        data = CRLF.join(['"a"', '"b"', '"c"', 'OK', 'OK "NOOP"']) + CRLF
+        client = make_client(data, chunk=3)
+        for name, active in client.iter_scripts():
+            break
+        self.assertEqual(client.noop().text, u'NOOP')
+
+    def test_no_command_while_iterating(self):
+        data = CRLF.join(['"s1"', '"s2"', 'OK', '{4}', 'keep', 'OK']) + CRLF
+        client = make_client(data, chunk=3)
+        scripts = client.iter_scripts()
+        scripts.next()
+        self.assertRaises(managesieve.InvalidState, client.get_script,
+                          u's3')
+        self.assertRaises(managesieve.InvalidState, client.pipeline().noop)
+        self.assertEqual(list(scripts), [(u's2', False)])
+        self.assertEqual(client.get_script(u's3'), u'keep')
+
+    def test_iter_scripts_failure(self):
+        client = make_client('NO "Nope."' + CRLF)
+        self.assertRaises(managesieve.CommandFailed, list,
+                          client.iter_scripts())
+
+
+class GetScriptTest(unittest.TestCase):
+    script = 'require "fileinto";\r\nif true {\r\n  keep;\r\n}\r\n' * 50
+
+    def response(self):
+        return '{%d}%s%s%sOK "Getscript completed."%s' % (
+            len(self.script), CRLF, self.script, CRLF, CRLF)
+
+    def test_get_script(self):
+        client = make_client(self.response(), chunk=100)
+        data = client.get_script(u'test')
+        self.assertEqual(client.socket.sent, ['GETSCRIPT "test"' + CRLF])
+        self.assertEqual(data, unicode(self.script).rstrip(u'\n'))
+        self.assertTrue(isinstance(data, unicode))
+
+    def test_get_script_raw(self):
+        client = make_client(self.response(), chunk=7)
+        data = client.get_script(u'test', decode=False)
+        self.assertTrue(isinstance(data, bytearray))
+        self.assertEqual(data, self.script)
+
+    def test_get_script_eof_in_literal(self):
+        client = make_client(self.response()[:500])
+        self.assertRaises(managesieve.EOFFromServer, client.get_script,
+                          u'test')
+        # the rest of the literal may still come, the session is over
+        self.assertTrue(isinstance(client.unusable,
+                                   managesieve.EOFFromServer))
+
+
+class InvalidResponseTest(unittest.TestCase):
+    data = CRLF.join(['"a" (unbalanced', 'OK', 'OK']) + CRLF
+
+    def assertUnusable(self, client):
+        self.assertTrue(isinstance(client.unusable,
+                                   managesieve.InvalidResponse))
+        self.assertEqual(client.state, 'LOGOUT')
+        self.assertRaises(managesieve.ConnectionError, client.noop)
+
+    def test_command(self):
+        client = make_client(self.data)
+        self.assertRaises(managesieve.InvalidResponse, client.list_scripts)
+        self.assertUnusable(client)
+
+    def test_iter_scripts(self):
+        client = make_client(self.data)
+        self.assertRaises(managesieve.InvalidResponse, list,
+                          client.iter_scripts())
+        self.assertUnusable(client)
+
+    def test_pipeline(self):
+        client = make_client(self.data)
+        results = client.pipeline().list_scripts().noop().execute()
+        self.assertTrue(isinstance(results[0].error,
+                                   managesieve.InvalidResponse))
+        self.assertTrue(results[1].error is results[0].error)
+        self.assertUnusable(client)
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class ProtocolTraceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = ListHandler()
+        self.logger = logging.getLogger('managesieve.protocol')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(logging.NOTSET)
+
+    def test_literals_are_summarized(self):
+        script = 'keep;\r\n' * 1000
+        client = make_client('{%d}%s%s%sOK%s' % (len(script), CRLF, script,
+                                                 CRLF, CRLF))
+        client.get_script(u'test', decode=False)
+        self.assertEqual(self.handler.messages[0],
+                         "Sending command: 'GETSCRIPT \"test\"\\r\\n'")
+        self.assertTrue(self.handler.messages[-1].startswith(
+            "Received response <Response('OK', None, None, "
+            "[[bytearray(b'keep;"))
+        self.assertTrue(self.handler.messages[-1].endswith(
+            "... (7000 bytes)]])>"))
+        for message in self.handler.messages:
+            self.assertTrue(len(message) < 1000, message)
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_deploy(self):
+        client = make_client(CRLF.join(['OK', 'OK "Putscript completed."',
+                                        'OK "Setactive completed."']) + CRLF)
+        pipeline = client.pipeline()
+        pipeline.have_space(u'rules', 7)
+        pipeline.put_script(u'rules', u'keep;\r\n')
+        pipeline.set_active(u'rules')
+        results = pipeline.execute()
+
+        self.assertEqual(client.socket.sent,
+                         ['HAVESPACE "rules" 7' + CRLF +
+                          'PUTSCRIPT "rules" {7+}' + CRLF + 'keep;' + CRLF +
+                          CRLF + 'SETACTIVE "rules"' + CRLF])
+        self.assertEqual([r.command.name for r in results],
+                         ['HAVESPACE', 'PUTSCRIPT', 'SETACTIVE'])
+        self.assertTrue(all(r.is_ok for r in results))
+        self.assertEqual(results[1].value.text, u'Putscript completed.')
+        self.assertEqual(len(pipeline), 0)
+
+    def test_failure_in_the_middle(self):
+        client = make_client(CRLF.join(['"a"', 'OK', 'NO "No such script."',
+                                        '{4}', 'keep', 'OK']) + CRLF)
+        results = client.pipeline().list_scripts().get_script(u'b') \
+                                   .get_script(u'c').execute()
+        self.assertEqual(results[0].value, [(u'a', False)])
+        self.assertTrue(isinstance(results[1].error,
+                                   managesieve.CommandFailed))
+        self.assertEqual(results[1].response.text, u'No such script.')
+        self.assertEqual(results[2].value, u'keep')
+
+    def test_bye_in_the_middle(self):
+        client = make_client(CRLF.join(['OK', 'BYE "Shutting down."']) +
+                             CRLF)
+        pipeline = client.pipeline()
+        for name in (u'a', u'b', u'c'):
+            pipeline.delete_script(name)
+        results = pipeline.execute()
+        self.assertTrue(results[0].is_ok)
+        self.assertEqual(results[1].response.status, 'BYE')
+        self.assertTrue(isinstance(results[1].error,
+                                   managesieve.CommandFailed))
+        self.assertEqual(results[2].response, None)
+        self.assertTrue(isinstance(results[2].error,
+                                   managesieve.ConnectionError))
+        self.assertEqual(client.state, 'LOGOUT')
+
+    def test_eof_in_the_middle(self):
+        client = make_client('OK' + CRLF)
+        results = client.pipeline().delete_script(u'a') \
+                                   .delete_script(u'b').execute()
+        self.assertTrue(results[0].is_ok)
+        self.assertTrue(isinstance(results[1].error,
+                                   managesieve.EOFFromServer))
+
+    def test_invalid_state(self):
+        client = make_client('', state='NONAUTH')
+        self.assertRaises(managesieve.InvalidState,
+                          client.pipeline().list_scripts)
+
+    def test_window(self):
+        client = make_client(('OK' + CRLF) * 5)
+        pipeline = client.pipeline()
+        pipeline.max_in_flight = 2
+        for name in (u'a', u'b', u'c', u'd', u'e'):
+            pipeline.delete_script(name)
+        self.assertTrue(all(result.is_ok for result in pipeline.execute()))
+        # the next command is sent as soon as a response has been read
+        self.assertEqual(client.socket.sent,
+                         ['DELETESCRIPT "a"\r\nDELETESCRIPT "b"\r\n',
+                          'DELETESCRIPT "c"\r\n', 'DELETESCRIPT "d"\r\n',
+                          'DELETESCRIPT "e"\r\n'])
+
+    def test_large_command_waits(self):
+        client = make_client(('OK' + CRLF) * 3)
+        pipeline = client.pipeline()
+        pipeline.max_in_flight_bytes = 1000
+        pipeline.noop().put_script(u'big', u'#' * 2000).noop()
+        sent = client.socket.sent
+        results = pipeline.iter_execute()
+        results.next()
+        self.assertEqual(sent, ['NOOP\r\n'])
+        results.next()
+        self.assertEqual(len(sent), 2)
+        self.assertTrue(sent[1].startswith('PUTSCRIPT "big" {2000+}'))
+        self.assertEqual(len(list(results)), 1)
+        self.assertEqual(sent[2], 'NOOP\r\n')
+
+    def test_left_early(self):
+        client = make_client(CRLF.join(['"s1"', 'OK', '"s2"', 'OK', 'OK',
+                                        '"s3"', 'OK']) + CRLF)
+        pipeline = client.pipeline()
+        pipeline.get_script(u's1').get_script(u's2').noop()
+        for result in pipeline.iter_execute():
+            break
+        self.assertEqual(result.value, u's1')
+        # the responses left were read, the session is still in step
+        self.assertEqual(client.get_script(u's3'), u's3')
+        self.assertTrue(client.unusable is None)
+
+    def test_no_command_while_iterating(self):
+        client = make_client(CRLF.join(['OK', 'OK', 'OK "NOOP"']) + CRLF)
+        results = client.pipeline().delete_script(u'a') \
+                                   .delete_script(u'b').iter_execute()
+        results.next()
+        self.assertRaises(managesieve.InvalidState, client.noop)
+        self.assertRaises(managesieve.InvalidState, list,
+                          client.iter_scripts())
+        results.close()
+        self.assertEqual(client.noop().text, u'NOOP')
+
+    def test_left_early_on_lost_connection(self):
+        client = make_client(CRLF.join(['"s1"', 'OK', '{10}']) + CRLF)
+        pipeline = client.pipeline()
+        pipeline.get_script(u's1').get_script(u's2')
+        for result in pipeline.iter_execute():
+            break
+        self.assertTrue(isinstance(client.unusable,
+                                   managesieve.EOFFromServer))
+        self.assertRaises(managesieve.ConnectionError, client.noop)
+
+
+class PutScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'rules.sieve')
+        self.script = ''.join('# line %d\r\n' % i for i in range(100))
+        with open(self.path, 'wb') as fd:
+            fd.write(self.script)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        managesieve.FileLiteral.chunk_size = 65536
+
+    def test_data(self):
+        for data in (u'keep; # \xe8\r\n', 'keep; # \xc3\xa8\r\n',
+                     StringIO.StringIO('keep; # \xc3\xa8\r\n')):
+            client = make_client('OK' + CRLF)
+            client.put_script(u'rules', data)
+            self.assertEqual(''.join(client.socket.sent),
+                             'PUTSCRIPT "rules" {12+}\r\n'
+                             'keep; # \xc3\xa8\r\n\r\n')
+
+    def test_path_is_streamed(self):
+        managesieve.FileLiteral.chunk_size = 100
+        client = make_client('OK' + CRLF)
+        client.put_script(u'rules', path=self.path)
+        sent = client.socket.sent
+        head = 'PUTSCRIPT "rules" {%d+}\r\n' % len(self.script)
+        self.assertEqual(''.join(sent), head + self.script + CRLF)
+        # the data is sent in chunks, with head and tail in the first and
+        # last one
+        self.assertTrue(len(sent) > 5)
+        self.assertTrue(sent[0].startswith(head))
+        self.assertTrue(sent[-1].endswith(CRLF))
+        self.assertTrue(max(len(data) for data in sent) <=
+                        len(head) + 100 + len(CRLF))
+
+    def test_file_object_from_its_position(self):
+        client = make_client('OK' + CRLF)
+        with open(self.path, 'rb') as fd:
+            fd.read(10)
+            client.put_script(u'rules', fd)
+            self.assertFalse(fd.closed)
+        self.assertEqual(''.join(client.socket.sent),
+                         'PUTSCRIPT "rules" {%d+}\r\n%s\r\n' %
+                         (len(self.script) - 10, self.script[10:]))
+
+    def test_file_shrinking_while_sent(self):
+        client = make_client('OK' + CRLF)
+        command = client._put_script_command(u'rules', path=self.path)
+        with open(self.path, 'wb') as fd:
+            fd.write('keep;')
+        self.assertRaises(managesieve.ConnectionError, client._run, command)
+        self.assertTrue(command.literal.fd.closed)
+        # part of the literal was sent, the session can't go on
+        self.assertTrue(client.unusable is not None)
+        self.assertRaises(managesieve.ConnectionError, client.noop)
+
+    def test_file_shrinking_in_a_pipeline(self):
+        client = make_client('OK' + CRLF)
+        pipeline = client.pipeline().noop().put_script(u'rules',
+                                                       path=self.path)
+        with open(self.path, 'wb') as fd:
+            fd.write('keep;')
+        results = pipeline.execute()
+        self.assertTrue(isinstance(results[1].error,
+                                   managesieve.ConnectionError))
+        self.assertTrue(client.unusable is results[1].error)
+
+    def test_file_objects_that_are_not_streamed(self):
+        gzipped = os.path.join(self.tempdir, 'rules.sieve.gz')
+        with contextlib.closing(gzip.open(gzipped, 'wb')) as fd:
+            fd.write(self.script)
+        read, write = os.pipe()
+        os.write(write, 'keep;\r\n')
+        os.close(write)
+        expected = [self.script, 'keep;\r\n']
+        for data in (gzip.open(gzipped, 'rb'), os.fdopen(read, 'rb')):
+            client = make_client('OK' + CRLF)
+            with contextlib.closing(data):
+                client.put_script(u'rules', data)
+            script = expected.pop(0)
+            self.assertEqual(''.join(client.socket.sent),
+                             'PUTSCRIPT "rules" {%d+}\r\n%s\r\n' %
+                             (len(script), script))
+
+    def test_path_opened_when_sent(self):
+        client = make_client(('OK' + CRLF) * 300)
+        pipeline = client.pipeline()
+        for i in range(300):
+            pipeline.put_script(u'rules%d' % i, path=self.path)
+        # queued scripts don't hold a file descriptor each
+        self.assertTrue(all(command.literal.fd is None
+                            for command in pipeline.commands))
+        commands = pipeline.commands
+        self.assertTrue(all(result.is_ok for result in pipeline.execute()))
+        self.assertTrue(all(command.literal.fd.closed
+                            for command in commands))
+
+    def test_pipeline(self):
+        client = make_client('OK' + CRLF + 'OK' + CRLF + 'OK' + CRLF)
+        results = client.pipeline().put_script(u'a', path=self.path) \
+                                   .set_active(u'a').list_scripts().execute()
+        self.assertTrue(all(result.is_ok for result in results))
+        self.assertEqual(client.socket.sent[-1],
+                         'SETACTIVE "a"\r\nLISTSCRIPTS\r\n')
+
+
+class NoTLSCapabilitiesHandler(SieveHandler):
+    """A server that doesn't send its capabilities after STARTTLS."""
+
+    def send_capabilities(self, status='OK'):
+        if self.tls and 'CAPABILITY' not in self.server.commands:
+            self.send(status)
+        else:
+            SieveHandler.send_capabilities(self, status)
+
+
+class ServerTest(unittest.TestCase):
+    """Run the client against the in-process test server."""
+    server_class = SieveServer
+    use_tls = False
+
+    def setUp(self):
+        self.server = self.server_class().start()
+        host, port = self.server.address
+        self.client = managesieve.ManageSieveClient(host, port,
+                                                    use_tls=self.use_tls)
+
+    def tearDown(self):
+        self.client.socket.close()
+        self.server.stop()
+
+    def test_session(self):
+        client = self.client
+        client.connect()
+        self.assertEqual(client.login('', 'user', 'secret').status, 'OK')
+        client.put_script(u'rules', u'keep;\r\n')
+        client.set_active(u'rules')
+        self.assertEqual(client.list_scripts(), [(u'rules', True)])
+        self.assertEqual(client.get_script(u'rules'), u'keep;\r')
+        client.logout()
+
+    def test_validator(self):
+        from managesieve.sieve import SieveError, Validator
+        client = self.client
+        client.connect()
+        client.login('', 'user', 'secret')
+        client.validator = Validator()
+        client.put_script(u'rules', 'require "fileinto"; keep;')
+        for script in ('keep', 'require "duplicate"; keep;'):
+            self.assertRaises(SieveError, client.put_script, u'bad', script)
+        try:
+            client.pipeline().put_script(u'bad', StringIO.StringIO('keep'))
+        except SieveError, e:
+            self.assertEqual(str(e), 'bad: line 1, column 5: unexpected '
+                             'end of script, expected ";" or "{"')
+        else:
+            self.fail("invalid script accepted")
+        self.assertEqual(client.list_scripts(), [(u'rules', False)])
+        client.logout()
+
+    def test_nodelay(self):
+        self.client.connect()
+        sock = getattr(self.client.socket, 'realsock', self.client.socket)
+        self.assertTrue(sock.getsockopt(socket.IPPROTO_TCP,
+                                        socket.TCP_NODELAY))
+        self.client.logout()
+
+    def test_metrics(self):
+        client = self.client
+        client.connect()
+        client.login('', 'user', 'secret')
+        client.put_script(u'rules', u'keep;\r\n')
+        self.assertRaises(managesieve.CommandFailed, client.get_script,
+                          u'missing')
+        pipeline = client.pipeline()
+        pipeline.get_script(u'rules').get_script(u'missing')
+        pipeline.execute()
+
+        host, port = self.server.address
+        stats = client.metrics.snapshot()['%s:%d' % (host, port)]
+        self.assertEqual(stats['PUTSCRIPT']['count'], 1)
+        self.assertEqual(stats['PUTSCRIPT']['errors'], {})
+        self.assertEqual(stats['PUTSCRIPT']['bytes_sent'],
+                         len('PUTSCRIPT "rules" {7+}\r\nkeep;\r\n\r\n'))
+        self.assertEqual(stats['GETSCRIPT']['count'], 3)
+        self.assertEqual(stats['GETSCRIPT']['errors'], {'NONEXISTENT': 2})
+        self.assertEqual(stats['GETSCRIPT']['bytes_received'],
+                         len('{7}\r\nkeep;\r\n\r\nOK "Getscript completed."\r\n') +
+                         2 * len('NO (NONEXISTENT) '
+                                 '"There is no script by that name"\r\n'))
+        self.assertTrue(stats['AUTHENTICATE']['latency']['p99'] > 0)
+        client.logout()
+
+    def test_put_script_path(self):
+        path = os.path.join(os.path.dirname(__file__), 'large.sieve')
+        script = ''.join('# line %d\r\n' % i for i in range(100000))
+        try:
+            with open(path, 'wb') as fd:
+                fd.write(script)
+            client = self.client
+            client.connect()
+            client.login('', 'user', 'secret')
+            client.put_script(u'large', path=path)
+            client.logout()
+        finally:
+            os.unlink(path)
+        self.assertEqual(self.server.mailbox('user').scripts['large'],
+                         script)
+
+    def test_login_mechanism(self):
+        client = self.client
+        client.connect()
+        response = client.authenticate('LOGIN', 'user', 'secret')
+        self.assertEqual(response.status, 'OK')
+        self.assertEqual(client.state, 'AUTH')
+
+
+class TLSServerTest(ServerTest):
+    server_class = TLSSieveServer
+    use_tls = True
+
+    def setUp(self):
+        ServerTest.setUp(self)
+        if self.server.certfile is None:
+            self.skipTest("openssl is not available")
+
+    def test_starttls(self):
+        self.client.connect()
+        self.assertTrue(isinstance(self.client.socket,
+                                   managesieve.SSLFakeSocket))
+        self.assertFalse(self.client.tls_support)
+        self.assertEqual(self.client.login_mechs, ['PLAIN', 'LOGIN'])
+        # the capabilities sent after STARTTLS are used as they are
+        self.assertEqual(self.server.commands, ['STARTTLS'])
+
+    def test_capabilities_missing_after_starttls(self):
+        self.server.stop()
+        self.server = TLSSieveServer(handler=NoTLSCapabilitiesHandler).start()
+        host, port = self.server.address
+        self.client = managesieve.ManageSieveClient(host, port)
+        self.client.connect()
+        self.assertEqual(self.server.commands, ['STARTTLS', 'CAPABILITY'])
+        self.assertEqual(self.client.login_mechs, ['PLAIN', 'LOGIN'])
+
+    def test_shared_ssl_context(self):
+        self.assertTrue(managesieve.get_ssl_context() is
+                        managesieve.get_ssl_context())
+        client_cert = managesieve.get_ssl_context(self.server.keyfile,
+                                                  self.server.certfile)
+        self.assertFalse(client_cert is managesieve.get_ssl_context())
+        self.assertTrue(client_cert is
+                        managesieve.get_ssl_context(self.server.keyfile,
+                                                    self.server.certfile))
+
+        wrapped = []
+
+        class Context(ssl.SSLContext):
+            def wrap_socket(self, sock, *args, **kwargs):
+                wrapped.append(kwargs.get('server_hostname'))
+                return ssl.SSLContext.wrap_socket(self, sock, *args, **kwargs)
+
+        default = managesieve.get_ssl_context()
+        managesieve.set_ssl_context(Context(ssl.PROTOCOL_SSLv23))
+        try:
+            host, port = self.server.address
+            for i in range(2):
+                client = managesieve.ManageSieveClient(host, port)
+                client.connect()
+                client.logout()
+        finally:
+            managesieve.set_ssl_context(default)
+        self.assertEqual(wrapped, [host, host])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Unit tests for managesieve.daemon
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+from managesieve import cli, daemon
+from managesieve.pool import ConnectionPool
+from sieveserver import SieveServer
+
+logging.getLogger('managesieve').addHandler(logging.NullHandler())
+
+CONFIG = """\
+[account test]
+remote.host = %(host)s
+remote.port = %(port)d
+remote.user = user
+remote.password_command = echo called >> %(calls)s; echo secret
+"""
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SieveServer(users={'user': 'secret'}).start()
+        self.tempdir = tempfile.mkdtemp()
+        os.chmod(self.tempdir, 0700)
+        self.calls = os.path.join(self.tempdir, 'calls')
+        self.config = os.path.join(self.tempdir, 'config.cfg')
+        host, port = self.server.address
+        with open(self.config, 'w') as fd:
+            fd.write(CONFIG % dict(host=host, port=port, calls=self.calls))
+
+        self.pool = ConnectionPool()
+        self.daemon = daemon.DaemonServer(cli.DaemonRunner(self.pool),
+                                          idle_timeout=0.5,
+                                          directory=self.tempdir)
+        self.thread = threading.Thread(target=self.daemon.serve_until_idle,
+                                       args=(0.05, self.pool.prune))
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.join()
+        self.pool.clear()
+        self.server.stop()
+        shutil.rmtree(self.tempdir)
+
+    def request(self, cmd, **args):
+        args['cmd'] = cmd
+        return daemon.request({'config': self.config, 'account': 'test',
+                               'args': args, 'password': None},
+                              path=self.daemon.socket_path)
+
+    def test_sessions_are_reused(self):
+        script = os.path.join(self.tempdir, 'rules.sieve')
+        with open(script, 'w') as fd:
+            fd.write('keep;\r\n')
+        reply = self.request('put', name=script, destfile=None)
+        self.assertEqual(reply['status'], 0)
+        reply = self.request('activate', name='rules.sieve')
+        self.assertEqual(reply['status'], 0)
+        reply = self.request('list')
+        self.assertEqual(reply, {'status': 0, 'out': '* rules.sieve\n',
+                                 'err': ''})
+        # the password command ran for the first session only
+        with open(self.calls) as fd:
+            self.assertEqual(fd.read(), 'called\n')
+        self.assertEqual(len(self.pool), 1)
+
+    def test_timeout_is_applied(self):
+        for timeout in (7.5, 2.5):
+            self.assertEqual(self.request('list', timeout=timeout)['status'],
+                             0)
+            session, = [session for sessions in self.pool._idle.values()
+                        for session in sessions]
+            self.assertEqual(session.client.timeout, timeout)
+        self.assertEqual(session.client.connect_timeout, 7.5)
+
+    def test_pull_names(self):
+        self.server.mailbox('user').scripts['r\xc3\xa8gles'] = 'keep;\r\n'
+        directory = os.path.join(self.tempdir, 'pulled')
+        reply = self.request('pull', directory=directory, all=False,
+                             names=[u'r\xe8gles'], manifest=None)
+        self.assertEqual(reply['status'], 0, reply)
+        self.assertEqual(os.listdir(directory),
+                         [u'r\xe8gles.sieve'.encode('utf-8')])
+
+    def test_errors_are_returned(self):
+        reply = self.request('get', name='missing')
+        self.assertEqual(reply['status'], 1)
+        self.assertTrue(reply['err'].startswith('ERROR: '))
+
+    def test_exits_when_idle(self):
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(os.path.exists(self.daemon.socket_path))
+
+    def test_single_instance(self):
+        self.assertRaises(daemon.DaemonError, daemon.DaemonServer,
+                          None, directory=self.tempdir)
+
+
+if __name__ == "__main__":
+    unittest.main()
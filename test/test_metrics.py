@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""Unit tests for managesieve.metrics
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import unittest
+from managesieve.metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        for i in range(100):
+            self.metrics.record('example.com:4190', 'GETSCRIPT',
+                                0.002 if i < 90 else 3.0, 20, 100)
+        self.metrics.record('example.com:4190', 'PUTSCRIPT', 0.02, 1000, 30,
+                            'QUOTA/MAXSIZE')
+
+    def test_snapshot(self):
+        stats = self.metrics.snapshot()['example.com:4190']
+        self.assertEqual(sorted(stats), ['GETSCRIPT', 'PUTSCRIPT'])
+        getscript = stats['GETSCRIPT']
+        self.assertEqual(getscript['count'], 100)
+        self.assertEqual(getscript['bytes_sent'], 2000)
+        self.assertEqual(getscript['bytes_received'], 10000)
+        self.assertEqual(getscript['errors'], {})
+        latency = getscript['latency']
+        self.assertTrue(0.001 < latency['p50'] <= 0.0025)
+        self.assertTrue(2.5 < latency['p95'] <= 5.0)
+        self.assertTrue(latency['p95'] <= latency['p99'] <= 5.0)
+        self.assertAlmostEqual(latency['sum'], 90 * 0.002 + 10 * 3.0)
+        self.assertEqual(stats['PUTSCRIPT']['errors'], {'QUOTA/MAXSIZE': 1})
+
+    def test_empty(self):
+        self.assertEqual(Metrics().snapshot(), {})
+
+    def test_prometheus(self):
+        lines = self.metrics.prometheus().splitlines()
+        labels = 'server="example.com:4190",command="GETSCRIPT"'
+        self.assertTrue('# TYPE managesieve_commands_total counter' in lines)
+        self.assertTrue('managesieve_commands_total{%s} 100' % labels
+                        in lines)
+        self.assertTrue('managesieve_command_errors_total{server="example.com'
+                        ':4190",command="PUTSCRIPT",code="QUOTA/MAXSIZE"} 1'
+                        in lines)
+        self.assertTrue('managesieve_command_duration_seconds_bucket'
+                        '{%s,le="0.0025"} 90' % labels in lines)
+        self.assertTrue('managesieve_command_duration_seconds_bucket'
+                        '{%s,le="+Inf"} 100' % labels in lines)
+        self.assertTrue('managesieve_command_duration_seconds_count{%s} 100'
+                        % labels in lines)
+
+
+if __name__ == "__main__":
+    unittest.main()
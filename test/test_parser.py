@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Unit tests for managesieve.ResponseParser
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import unittest
+import managesieve
+from managesieve import ResponseParser, Response, InvalidResponse
+
+CRLF = '\r\n'
+
+
+def parse(data, chunk=None):
+    """Feed `data` to a new parser, `chunk` bytes at a time."""
+    parser = ResponseParser()
+    responses = []
+    chunk = chunk or len(data)
+    for i in range(0, len(data), chunk):
+        parser.feed(data[i:i + chunk])
+        while True:
+            response = parser.next_response()
+            if response is None:
+                break
+            responses.append(response)
+    return responses
+
+
+class ResponseParserTest(unittest.TestCase):
+
+    def test_status_only(self):
+        for status in (Response.OK, Response.NO, Response.BYE):
+            response, = parse(status + CRLF)
+            self.assertEqual(response.status, status)
+            self.assertEqual(response.code, None)
+            self.assertEqual(response.text, None)
+            self.assertEqual(response.data, [])
+
+    def test_code_and_text(self):
+        response, = parse('NO (QUOTA/MAXSIZE) "Script is too big."' + CRLF)
+        self.assertEqual(response.status, Response.NO)
+        self.assertEqual(response.code, 'QUOTA/MAXSIZE')
+        self.assertEqual(response.text, u'Script is too big.')
+
+    def test_code_with_arguments(self):
+        response, = parse('OK (SASL "dj1ybmRzZXJ2ZXI=")' + CRLF)
+        self.assertEqual(response.code, 'SASL dj1ybmRzZXJ2ZXI=')
+        self.assertEqual(response.text, None)
+
+    def test_quoted_escapes(self):
+        response, = parse(r'"a \"quoted\" \\ name"' + CRLF + 'OK' + CRLF)
+        self.assertEqual(response.data, [['a "quoted" \\ name']])
+
+    def test_capability(self):
+        data = CRLF.join(['"IMPLEMENTATION" "Dovecot Pigeonhole"',
+                          '"SASL" "PLAIN LOGIN"',
+                          '"STARTTLS"',
+                          'OK "Ready."']) + CRLF
+        response, = parse(data, chunk=3)
+        self.assertEqual(response.data, [['IMPLEMENTATION',
+                                          'Dovecot Pigeonhole'],
+                                         ['SASL', 'PLAIN LOGIN'],
+                                         ['STARTTLS']])
+        self.assertEqual(response.text, u'Ready.')
+
+    def test_literal_in_the_middle_of_a_line(self):
+        data = ('"first"' + CRLF + '{6}' + CRLF + 'second ACTIVE' + CRLF +
+                'OK' + CRLF)
+        for chunk in (1, 2, 5, len(data)):
+            response, = parse(data, chunk)
+            self.assertEqual(response.data, [['first'],
+                                             [bytearray('second'), 'ACTIVE']])
+
+    def test_literal_text(self):
+        text = 'line 1: error' + CRLF + 'line 2: error' + CRLF
+        data = 'NO {%d}%s%s%s' % (len(text), CRLF, text, CRLF)
+        response, = parse(data, chunk=4)
+        self.assertEqual(response.text, u'line 1: error\nline 2: error')
+
+    def test_literal_plus(self):
+        response, = parse('{3+}' + CRLF + 'abc' + CRLF + 'OK' + CRLF)
+        self.assertEqual(response.data, [[bytearray('abc')]])
+
+    def test_literal_buffer(self):
+        parser = ResponseParser()
+        parser.feed('{10}' + CRLF + 'abc')
+        self.assertEqual(parser.next_response(), None)
+        view = parser.literal_buffer()
+        self.assertEqual(len(view), 7)
+        view[:] = 'defghij'
+        parser.literal_received(7)
+        self.assertEqual(parser.literal_buffer(), None)
+        parser.feed(CRLF + 'OK' + CRLF)
+        response = parser.next_response()
+        self.assertEqual(response.data, [[bytearray('abcdefghij')]])
+
+    def test_compact_response(self):
+        response, = parse('NO "caf\xc3\xa9"' + CRLF)
+        self.assertTrue(response.status is Response.NO)
+        self.assertFalse(hasattr(response, '__dict__'))
+        self.assertEqual(response._text, None)
+        self.assertEqual(response.text, u'caf\xe9')
+        self.assertTrue(response.text is response.text)
+
+    def test_quoted_status_is_data(self):
+        response, = parse('"OK"' + CRLF + 'OK' + CRLF)
+        self.assertEqual(response.data, [['OK']])
+
+    def test_several_responses(self):
+        responses = parse('OK "one"' + CRLF + 'NO "two"' + CRLF +
+                          'BYE "three"' + CRLF, chunk=7)
+        self.assertEqual([r.status for r in responses], ['OK', 'NO', 'BYE'])
+        self.assertEqual([r.text for r in responses], ['one', 'two', 'three'])
+
+    def test_bare_lf(self):
+        response, = parse('"a"\n"b" ACTIVE\nOK\n')
+        self.assertEqual(response.data, [['a'], ['b', 'ACTIVE']])
+
+    def test_empty_line(self):
+        response, = parse('FOO bar' + CRLF + CRLF + 'OK' + CRLF)
+        self.assertEqual(response.status, 'OK')
+        self.assertEqual(response.data, [['FOO', 'bar'], []])
+
+    def test_invalid(self):
+        for data in ('OK "unterminated' + CRLF,
+                     'OK (CODE' + CRLF,
+                     'OK "a""b"' + CRLF,
+                     '"a" \\ "b"' + CRLF):
+            self.assertRaises(InvalidResponse, parse, data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Unit tests for managesieve.pool
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import socket
+import unittest
+import managesieve
+from managesieve.pool import ConnectionPool
+from sieveserver import SieveServer
+
+USERS = {'alice': 'secret1', 'bob': 'secret2'}
+
+
+class ConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SieveServer(users=USERS).start()
+        self.pool = ConnectionPool(max_size=2)
+
+    def tearDown(self):
+        self.pool.clear()
+        self.server.stop()
+
+    def acquire(self, user='alice', **kwargs):
+        host, port = self.server.address
+        return self.pool.acquire(host, port, user, USERS[user],
+                                 use_tls=False, **kwargs)
+
+    def drop_connections(self):
+        for sock in list(self.server.connections):
+            sock.shutdown(socket.SHUT_RDWR)
+
+    def test_reuse(self):
+        client = self.acquire()
+        self.assertEqual(client.state, 'AUTH')
+        self.pool.release(client)
+        self.assertEqual(len(self.pool), 1)
+        self.assertTrue(self.acquire() is client)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_keyed_by_user_and_mechanism(self):
+        alice = self.acquire()
+        self.pool.release(alice)
+        bob = self.acquire('bob')
+        self.assertFalse(bob is alice)
+        self.pool.release(bob)
+        self.assertFalse(self.acquire(mechanism='LOGIN') is alice)
+        self.assertTrue(self.acquire() is alice)
+
+    def test_keyed_by_authorization_and_tls(self):
+        alice = self.acquire()
+        self.pool.release(alice)
+        self.assertFalse(self.acquire(auth_name='admin') is alice)
+        self.assertFalse(self.acquire(certfile='alice.pem',
+                                      keyfile='alice.key') is alice)
+        self.assertTrue(self.acquire() is alice)
+
+    def test_stale_session_is_replaced(self):
+        client = self.acquire()
+        self.pool.release(client)
+        self.drop_connections()
+        fresh = self.acquire()
+        self.assertFalse(fresh is client)
+        self.assertEqual(fresh.list_scripts(), [])
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = -1
+        client = self.acquire()
+        self.pool.release(client)
+        self.assertEqual(len(self.pool), 0)
+        self.assertEqual(client.state, 'LOGOUT')
+
+    def test_max_lifetime(self):
+        client = self.acquire()
+        self.pool.max_lifetime = -1
+        self.pool.release(client)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_max_size(self):
+        clients = [self.acquire() for i in range(3)]
+        for client in clients:
+            self.pool.release(client)
+        self.assertEqual(len(self.pool), 2)
+        # the least recently used session was closed
+        self.assertEqual(clients[0].state, 'LOGOUT')
+        self.assertTrue(self.acquire() is clients[2])
+
+    def test_connection_discards_on_error(self):
+        try:
+            with self.pool.connection(*self.server.address, user='alice',
+                                      password='secret1',
+                                      use_tls=False) as client:
+                client.get_script(u'missing')
+        except managesieve.CommandFailed:
+            pass
+        self.assertEqual(len(self.pool), 0)
+
+    def test_authentication_failure(self):
+        host, port = self.server.address
+        self.assertRaises(managesieve.CommandFailed, self.pool.acquire,
+                          host, port, 'alice', 'wrong', use_tls=False)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_foreign_client(self):
+        self.assertRaises(ValueError, self.pool.release, object())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+"""Unit tests for managesieve.scram
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import logging
+import unittest
+import managesieve
+from managesieve.pool import ConnectionPool
+from managesieve.scram import ScramClient, ScramKeyCache, ScramError
+from sieveserver import SieveServer
+
+# keep the "No handlers could be found" warning out of the test output
+logging.getLogger('managesieve').addHandler(logging.NullHandler())
+
+SCRAM = ['SCRAM-SHA-256', 'SCRAM-SHA-1', 'PLAIN', 'LOGIN']
+
+# the examples of RFC 5802 and RFC 7677
+EXCHANGES = {
+    'SCRAM-SHA-1': (
+        'fyko+d2lbbFgONRv9qkxdawL',
+        'r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,s=QSXCR+Q6sek8bf92,'
+        'i=4096',
+        'c=biws,r=fyko+d2lbbFgONRv9qkxdawL3rfcNHYJY1ZVvWVs7j,'
+        'p=v0X8v3Bz2T0CJGbJQyF0X+HI4Ts=',
+        'v=rmF9pqV8S7suAoZWja4dJRkFsKQ='),
+    'SCRAM-SHA-256': (
+        'rOprNGfwEbeRWgbNEkqO',
+        'r=rOprNGfwEbeRWgbNEkqO%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0,'
+        's=W22ZaJ0SNY7soEsUEjb6gQ==,i=4096',
+        'c=biws,r=rOprNGfwEbeRWgbNEkqO%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0,'
+        'p=dHzbZapWIk4jUhN+Ute9ytag9zjfMHgsqmmiz7AndVQ=',
+        'v=6rriTRBi23WpRR/wtup+mMhUZUn/dB5nLTJRsjl95G4='),
+}
+
+
+class ScramClientTest(unittest.TestCase):
+
+    def test_rfc_examples(self):
+        for mechanism, (nonce, server_first, client_final,
+                        server_final) in EXCHANGES.items():
+            exchange = ScramClient(mechanism, 'user', u'pencil', nonce=nonce)
+            self.assertEqual(exchange.first(), 'n,,n=user,r=' + nonce)
+            self.assertEqual(exchange.respond(server_first), client_final)
+            self.assertFalse(exchange.done)
+            self.assertEqual(exchange.respond(server_final), '')
+            self.assertTrue(exchange.done)
+
+    def test_invalid_server_messages(self):
+        nonce, server_first, client_final, server_final = \
+            EXCHANGES['SCRAM-SHA-1']
+        exchange = ScramClient('SCRAM-SHA-1', 'user', 'pencil', nonce=nonce)
+        self.assertRaises(ScramError, exchange.verify, server_final)
+        for message in ('r=other,s=QSXCR+Q6sek8bf92,i=4096',
+                        'r=%s,s=QSXCR+Q6sek8bf92,i=4096' % nonce,
+                        server_first + ',m=ext', 'garbage'):
+            self.assertRaises(ScramError, exchange.final, message)
+        exchange.final(server_first)
+        for message in ('v=AAAA', 'e=invalid-proof', 'x=1'):
+            self.assertRaises(ScramError, exchange.verify, message)
+
+    def test_names(self):
+        exchange = ScramClient('scram-sha-1', u'a=b,c', 'secret',
+                               authzid='admin')
+        self.assertTrue(exchange.first().startswith('n,a=admin,n=a=3Db=2Cc,'
+                                                    'r='))
+
+    def test_key_cache(self):
+        cache = ScramKeyCache(max_entries=2)
+        nonce, server_first, client_final, server_final = \
+            EXCHANGES['SCRAM-SHA-256']
+        for i in range(2):
+            exchange = ScramClient('SCRAM-SHA-256', 'user', 'pencil',
+                                   key_cache=cache, nonce=nonce)
+            self.assertEqual(exchange.final(server_first), client_final)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # another password misses the cache
+        exchange = ScramClient('SCRAM-SHA-256', 'user', 'other',
+                               key_cache=cache, nonce=nonce)
+        self.assertNotEqual(exchange.final(server_first), client_final)
+        self.assertEqual((cache.misses, len(cache)), (2, 2))
+        # the cache doesn't keep the passwords
+        self.assertFalse([key for key in cache._keys
+                          if 'pencil' in key or 'other' in key])
+
+
+class ScramServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SieveServer()
+        self.server.mechanisms = SCRAM
+        self.server.start()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.socket.close()
+        self.server.stop()
+
+    def connect(self):
+        client = managesieve.ManageSieveClient(*self.server.address,
+                                               use_tls=False)
+        self.clients.append(client)
+        client.connect()
+        return client
+
+    def test_login_prefers_scram(self):
+        client = self.connect()
+        self.assertEqual(client.login('', 'user', 'secret').status, 'OK')
+        self.assertEqual(client.state, 'AUTH')
+        self.assertEqual(client.list_scripts(), [])
+        self.assertEqual(self.server.commands[:1], ['AUTHENTICATE'])
+
+    def test_mechanisms(self):
+        for final_in_code in (True, False):
+            self.server.scram_final_in_code = final_in_code
+            for mechanism in ('SCRAM-SHA-1', 'SCRAM-SHA-256'):
+                client = self.connect()
+                response = client.authenticate(mechanism, 'user', 'secret')
+                self.assertEqual(response.status, 'OK')
+                self.assertEqual(client.noop().status, 'OK')
+
+    def test_wrong_password(self):
+        client = self.connect()
+        response = client.authenticate('SCRAM-SHA-256', '', 'user', 'wrong')
+        self.assertEqual(response.status, 'NO')
+        self.assertEqual(client.state, 'NONAUTH')
+        # the connection is still usable
+        self.assertEqual(client.authenticate('PLAIN', 'user',
+                                             'secret').status, 'OK')
+
+    def test_invalid_challenge_cancels(self):
+        client = self.connect()
+        original = client._authenticate_command
+
+        # the challenges get mangled on their way to the exchange
+        def build(*args):
+            command = original(*args)
+            challenge = command.challenge
+            command.challenge = lambda tokens: challenge(['=invalid='])
+            return command
+        client._authenticate_command = build
+        self.assertRaises(managesieve.ManageSieveClientError,
+                          client.authenticate, 'SCRAM-SHA-1', 'user',
+                          'secret')
+        self.assertEqual(client.state, 'NONAUTH')
+        client._authenticate_command = original
+        self.assertEqual(client.login('', 'user', 'secret').status, 'OK')
+
+    def test_pool_reuses_keys(self):
+        cache = ScramKeyCache()
+        pool = ConnectionPool(scram_keys=cache)
+        for i in range(3):
+            client = pool.acquire(self.server.address[0],
+                                  self.server.address[1], 'user', 'secret',
+                                  mechanism='SCRAM-SHA-256', use_tls=False)
+            pool.release(client, discard=True)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""Tests of ManageSieveClient against slow and failing servers
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import time
+import socket
+import unittest
+import managesieve
+from managesieve.pool import ConnectionPool
+from sieveserver import ShapingSieveServer, TLSShapingSieveServer, Shaping
+
+SCRIPT = 'require "fileinto";\r\n' * 3000
+
+
+class ShapingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ShapingSieveServer().start()
+        self.server.mailbox('user').scripts['rules'] = SCRIPT
+        host, port = self.server.address
+        self.client = managesieve.ManageSieveClient(host, port,
+                                                    use_tls=False)
+        self.client.connect()
+        self.client.login('', 'user', 'secret')
+
+    def tearDown(self):
+        self.client.socket.close()
+        self.server.stop()
+
+    @property
+    def shaping(self):
+        return self.server.shaping
+
+    def latency(self, command):
+        host, port = self.server.address
+        stats = self.client.metrics.snapshot()['%s:%d' % (host, port)]
+        return stats[command]['latency']
+
+    def test_delays_bound_the_tail_latency(self):
+        self.shaping.delays = {'NOOP': 0.02}
+        for i in range(20):
+            self.client.noop()
+        latency = self.latency('NOOP')
+        self.assertTrue(latency['p50'] >= 0.01, latency)
+        self.assertTrue(latency['p99'] < 0.25, latency)
+        # other commands are not delayed
+        self.client.list_scripts()
+        self.assertTrue(self.latency('LISTSCRIPTS')['p99'] < 0.01)
+
+    def test_throttled_partial_writes(self):
+        self.shaping.chunk_size = 1000
+        self.shaping.bandwidth = 1000000
+        start = time.time()
+        data = self.client.get_script(u'rules', decode=False)
+        self.assertEqual(data, SCRIPT)
+        self.assertTrue(time.time() - start >= len(SCRIPT) / 1000000.0)
+
+    def test_byte_by_byte_responses(self):
+        self.shaping.chunk_size = 1
+        self.assertEqual(self.client.list_scripts(), [(u'rules', False)])
+        self.client.put_script(u'other', u'keep;')
+        self.assertEqual(self.client.get_script(u'other'), u'keep;')
+
+    def test_dropped_connection(self):
+        self.shaping.drop = set(['GETSCRIPT'])
+        self.assertRaises(managesieve.EOFFromServer, self.client.get_script,
+                          u'rules')
+
+    def test_truncated_literal(self):
+        self.shaping.truncate = {'GETSCRIPT': 1000}
+        self.assertRaises(managesieve.EOFFromServer, self.client.get_script,
+                          u'rules')
+
+    def test_bye(self):
+        self.shaping.bye = {'LISTSCRIPTS': 'Shutting down'}
+        try:
+            self.client.list_scripts()
+        except managesieve.CommandFailed, e:
+            self.assertEqual(e.response.status, 'BYE')
+            self.assertEqual(e.response.text, u'Shutting down')
+        else:
+            self.fail("BYE was not reported")
+        self.assertEqual(self.client.state, 'LOGOUT')
+        self.assertRaises(managesieve.InvalidState, self.client.noop)
+
+    def test_pipeline_fails_cleanly(self):
+        self.shaping.truncate = {'GETSCRIPT': 1000}
+        pipeline = self.client.pipeline()
+        pipeline.noop().get_script(u'rules').noop()
+        start = time.time()
+        results = pipeline.execute()
+        self.assertTrue(time.time() - start < 1.0)
+        self.assertTrue(results[0].is_ok)
+        self.assertTrue(isinstance(results[1].error,
+                                   managesieve.EOFFromServer))
+        self.assertTrue(results[2].error is results[1].error)
+
+
+class TimeoutTest(unittest.TestCase):
+    server_class = ShapingSieveServer
+    use_tls = False
+
+    def setUp(self):
+        self.server = self.server_class().start()
+        if self.use_tls and self.server.certfile is None:
+            self.server.stop()
+            self.skipTest("openssl is not available")
+        self.server.mailbox('user').scripts['rules'] = SCRIPT
+        self.address = self.server.address
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.socket.close()
+        self.server.stop()
+
+    def connect(self, **kwargs):
+        client = managesieve.ManageSieveClient(*self.address,
+                                               use_tls=self.use_tls,
+                                               **kwargs)
+        self.clients.append(client)
+        client.connect()
+        if self.use_tls:
+            self.assertTrue(isinstance(client.socket,
+                                       managesieve.SSLFakeSocket))
+        client.login('', 'user', 'secret')
+        return client
+
+    def assertTimeout(self, limit, fn, *args):
+        start = time.time()
+        self.assertRaises(managesieve.Timeout, fn, *args)
+        self.assertTrue(time.time() - start < limit)
+
+    def test_read_timeout(self):
+        client = self.connect(timeout=0.2)
+        self.server.shaping.delays = {'GETSCRIPT': 2}
+        self.assertTimeout(1, client.get_script, u'rules')
+        self.assertTrue(isinstance(client.unusable, managesieve.Timeout))
+        self.assertEqual(client.state, 'LOGOUT')
+        self.assertRaises(managesieve.ConnectionError, client.noop)
+        client.logout()
+
+    def test_operation_timeout(self):
+        # each read is quick, but the whole response is not
+        client = self.connect(timeout=0.5, operation_timeout=0.3)
+        self.server.shaping.chunk_size = 100
+        self.server.shaping.bandwidth = 1000
+        self.assertTimeout(1, client.get_script, u'rules')
+        self.assertTrue(client.unusable is not None)
+
+    def test_deadline(self):
+        client = self.connect()
+        self.server.shaping.delays = {'NOOP': 0.1}
+        with client.deadline(0.25):
+            client.noop()
+            client.noop()
+            self.assertTimeout(0.5, client.noop)
+
+    def test_deadline_passed_before_sending(self):
+        client = self.connect()
+        with client.deadline(0.01):
+            time.sleep(0.02)
+            self.assertRaises(managesieve.Timeout, client.noop)
+        # nothing was sent, the connection can still be used
+        self.assertTrue(client.unusable is None)
+        self.assertEqual(client.noop().status, 'OK')
+
+    def test_connect_timeout(self):
+        # the connection is accepted by the kernel, but no greeting comes
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(1)
+        try:
+            client = managesieve.ManageSieveClient(*sock.getsockname(),
+                                                   use_tls=False,
+                                                   connect_timeout=0.2)
+            self.clients.append(client)
+            self.assertTimeout(1, client.connect)
+        finally:
+            sock.close()
+
+    def test_pipeline_timeout(self):
+        client = self.connect(timeout=0.2)
+        self.server.shaping.delays = {'GETSCRIPT': 2}
+        pipeline = client.pipeline()
+        pipeline.noop().get_script(u'rules').noop()
+        start = time.time()
+        results = pipeline.execute()
+        self.assertTrue(time.time() - start < 1)
+        self.assertTrue(results[0].is_ok)
+        self.assertTrue(isinstance(results[1].error, managesieve.Timeout))
+        self.assertTrue(results[2].error is results[1].error)
+
+    def test_pool_discards_timed_out_sessions(self):
+        pool = ConnectionPool(timeout=0.2)
+        client = pool.acquire(self.address[0], self.address[1], 'user',
+                              'secret', use_tls=self.use_tls)
+        self.server.shaping.delays = {'LISTSCRIPTS': 2}
+        self.assertTimeout(1, client.list_scripts)
+        start = time.time()
+        pool.release(client)
+        self.assertTrue(time.time() - start < 0.1)
+        self.assertEqual(len(pool), 0)
+
+
+
+class TLSTimeoutTest(TimeoutTest):
+    """The same timeouts, over STARTTLS."""
+    server_class = TLSShapingSieveServer
+    use_tls = True
+
+    def test_session_stays_in_step(self):
+        client = self.connect(operation_timeout=0.3)
+        self.server.shaping.delays = {'GETSCRIPT': 1}
+        self.assertTimeout(1, client.get_script, u'rules')
+        self.assertTrue(isinstance(client.unusable, managesieve.Timeout))
+        self.assertRaises(managesieve.ConnectionError, client.list_scripts)
+
+if __name__ == "__main__":
+    unittest.main()
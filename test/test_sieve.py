@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""Unit tests for managesieve.sieve
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+from __future__ import with_statement
+import os
+import shutil
+import tempfile
+import unittest
+import managesieve
+from managesieve import sieve
+from managesieve.sieve import (SieveError, Validator, parse, tokenize,
+                               minify, minify_file)
+
+CRLF = '\r\n'
+
+SCRIPT = CRLF.join([
+    'require ["fileinto", "vacation"];',
+    '# comment',
+    '/* a comment',
+    '   on two lines */',
+    'if allof (header :contains ["subject", "x-subject"] "\\"sale\\"",',
+    '          size :over 100K) {',
+    '    fileinto "INBOX.spam";',
+    '    stop;',
+    '} elsif not exists "to" {',
+    '    discard;',
+    '} else {',
+    '    keep;',
+    '}',
+    'vacation :days 7 text:',
+    'Away.',
+    '..',
+    '.',
+    ';',
+    ''])
+
+
+class ParserTest(unittest.TestCase):
+
+    def assertError(self, script, lineno, column, message):
+        try:
+            parse(script)
+        except SieveError, e:
+            self.assertEqual((e.lineno, e.column, e.message),
+                             (lineno, column, message))
+        else:
+            self.fail("%r was accepted" % script)
+
+    def test_script(self):
+        script = parse(SCRIPT)
+        self.assertEqual([name for name, token in script.requires],
+                         [u'fileinto', u'vacation'])
+        self.assertEqual([node.name for node in script.commands],
+                         ['if', 'elsif', 'else', 'vacation'])
+        test = script.commands[0].tests[0]
+        self.assertEqual([node.name for node in test.tests],
+                         ['header', 'size'])
+        self.assertEqual([token.value for token in test.tests[0].arguments
+                          if not isinstance(token, list)],
+                         [u':contains', u'"sale"'])
+        self.assertEqual(test.tests[1].arguments[1].value, 100 * 1024)
+        self.assertEqual(script.commands[3].arguments[-1].value,
+                         u'Away.\r\n.\r\n')
+
+    def test_tokens(self):
+        tokens = tokenize(u'if :IS ["a", "b\\\\"] 2M;')
+        self.assertEqual([(token.kind, token.value) for token in tokens],
+                         [('identifier', u'if'), ('tag', u':is'),
+                          ('special', u'['), ('string', u'a'),
+                          ('special', u','), ('string', u'b\\'),
+                          ('special', u']'), ('number', 2 << 20),
+                          ('special', u';')])
+        self.assertEqual((tokens[1].start, tokens[1].end), (3, 6))
+
+    def test_syntax_errors(self):
+        self.assertError('keep', 1, 5, u'unexpected end of script, '
+                         u'expected ";" or "{"')
+        self.assertError('keep;\r\n  discard', 2, 10, u'unexpected end of '
+                         u'script, expected ";" or "{"')
+        self.assertError('if true { keep;', 1, 16, u'unexpected end of '
+                         u'script, expected "}"')
+        self.assertError('keep; }', 1, 7, u'unexpected "}"')
+        self.assertError('keep;\n"unterminated;', 2, 1,
+                         u'unterminated string')
+        self.assertError('/* unterminated', 1, 1, u'unterminated comment')
+        self.assertError('vacation text:\r\nno end\r\n', 1, 10,
+                         u'unterminated multi-line string')
+        self.assertError('header ["a",];', 1, 13,
+                         u'expected a string, found "]"')
+        self.assertError('keep; @', 1, 7, u"unexpected character u'@'")
+        self.assertError('keep;\xff', 1, 6, u'invalid UTF-8')
+
+    def test_semantic_errors(self):
+        self.assertError('fileinto "a";', 1, 1,
+                         u'fileinto needs require "fileinto"')
+        self.assertError('if header :regex "a" "b" { keep; }', 1, 11,
+                         u':regex needs require "regex"')
+        self.assertError('if header :comparator "i;ascii-numeric" "a" "1" '
+                         '{ keep; }', 1, 11, u':comparator needs require '
+                         u'"comparator-i;ascii-numeric"')
+        self.assertError('keep;\nrequire "fileinto";', 2, 1,
+                         u'require must come before other commands')
+        self.assertError('else { keep; }', 1, 1, u'else without if')
+        self.assertError('if true keep;', 1, 1, u'if needs a block')
+        self.assertError('stop { }', 1, 1, u'stop takes no block')
+        self.assertError('keep true;', 1, 6, u'keep takes no test')
+        self.assertError('if not (true, false) { }', 1, 4,
+                         u'not needs one test')
+        self.assertError('if allof { }', 1, 4, u'allof needs a test list')
+        self.assertError('kepe;', 1, 1, u'unknown command "kepe"')
+        self.assertError('if heder "a" "b" { }', 1, 4,
+                         u'unknown test "heder"')
+
+    def test_unknown_extensions_are_lenient(self):
+        script = parse('require "vnd.example.frobnicate"; frobnicate;')
+        self.assertEqual(script.requires[0][0], u'vnd.example.frobnicate')
+        parse('require "ihave"; if ihave "fileinto" { fileinto "a"; }')
+
+    def test_nesting_limit(self):
+        depth = sieve.MAX_NESTING + 2
+        self.assertRaises(SieveError, parse,
+                          'if true {' * depth + '}' * depth)
+        self.assertRaises(SieveError, parse,
+                          'if ' + 'not ' * depth + 'true {}')
+
+
+class ValidatorTest(unittest.TestCase):
+
+    def test_extensions(self):
+        validator = Validator()
+        validator.check(SCRIPT, ['fileinto', 'vacation', 'envelope'])
+        try:
+            validator.check(SCRIPT, ['fileinto'])
+        except SieveError, e:
+            self.assertEqual((e.lineno, e.column), (1, 22))
+            self.assertEqual(e.message,
+                             u'extension "vacation" is not supported')
+        else:
+            self.fail("missing extension not reported")
+        # unknown capabilities, only the syntax is checked
+        validator.check(SCRIPT)
+
+    def test_cache(self):
+        validator = Validator(max_entries=2)
+        script = validator.check(SCRIPT)
+        self.assertTrue(validator.check(SCRIPT.decode('utf-8')) is script)
+        self.assertRaises(SieveError, validator.check, 'keep')
+        # errors are cached too
+        self.assertEqual(len(validator), 2)
+        self.assertRaises(SieveError, validator.check, 'keep')
+        validator.check('stop;')
+        self.assertEqual(len(validator), 2)
+        # the least recently used entry was dropped
+        self.assertFalse(validator.check(SCRIPT) is script)
+
+    def test_check_file(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'rules.sieve')
+            with open(path, 'w') as fd:
+                fd.write('keep;\ndiscard\n')
+            try:
+                Validator().check_file(path)
+            except SieveError, e:
+                self.assertEqual(str(e), '%s: line 3, column 1: unexpected '
+                                 'end of script, expected ";" or "{"' % path)
+            else:
+                self.fail("invalid script accepted")
+        finally:
+            shutil.rmtree(directory)
+
+
+class MinifyTest(unittest.TestCase):
+
+    def tokens(self, script):
+        return [(token.kind, token.value)
+                for token in tokenize(script.decode('utf-8'))]
+
+    def test_minify(self):
+        minified = minify(SCRIPT)
+        self.assertEqual(self.tokens(minified), self.tokens(SCRIPT))
+        self.assertEqual(minified.split(CRLF), [
+            'require["fileinto","vacation"];',
+            'if allof(header :contains["subject","x-subject"]"\\"sale\\"",'
+            'size :over 100K){fileinto "INBOX.spam";stop;}',
+            'elsif not exists "to"{discard;}',
+            'else{keep;}',
+            'vacation :days 7 text:', 'Away.', '..', '.', ';', ''])
+        self.assertEqual(minify(minified), minified)
+
+    def test_multiline_comment(self):
+        self.assertEqual(minify(u'reject text: # why\n  caf\xe9  # no\n.\n;'),
+                         'reject text:\n  caf\xc3\xa9  # no\n.\n;\r\n')
+
+    def test_minify_file(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, 'keep; # done\r\n"unterminated')
+            os.close(fd)
+            try:
+                minify_file(path)
+            except SieveError, e:
+                self.assertEqual((e.filename, e.lineno), (path, 2))
+            else:
+                self.fail("invalid script accepted")
+        finally:
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
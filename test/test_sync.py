@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""Unit tests for managesieve.sync
+
+:copyright: (c) 2013 by Daniel Kertesz <daniel@spatof.org>
+:license: GNU Public License v3 (GPLv3)
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+import managesieve
+from managesieve import sync
+from sieveserver import SieveServer
+
+
+class SyncTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SieveServer().start()
+        self.tempdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tempdir, 'scripts')
+        os.mkdir(self.directory)
+        self.manifest = sync.Manifest(os.path.join(self.tempdir,
+                                                   'manifest.json'))
+        host, port = self.server.address
+        self.client = managesieve.ManageSieveClient(host, port,
+                                                    use_tls=False)
+        self.client.connect()
+        self.client.login('', 'user', 'secret')
+
+    def tearDown(self):
+        self.client.logout()
+        self.server.stop()
+        shutil.rmtree(self.tempdir)
+
+    def write(self, filename, data):
+        with open(os.path.join(self.directory, filename), 'w') as fd:
+            fd.write(data)
+
+    def push(self, **kwargs):
+        result = sync.push(self.client, self.directory, self.manifest,
+                           'account', **kwargs)
+        return [(action, name) for action, name, outcome in result.actions]
+
+    @property
+    def mailbox(self):
+        return self.server.mailbox('user')
+
+
+class PushTest(SyncTestCase):
+
+    def test_only_changed_scripts_are_uploaded(self):
+        self.write('a.sieve', 'keep;\r\n')
+        self.write('b.sieve', 'discard;\r\n')
+        self.write('notes.txt', 'not a script')
+        self.assertEqual(self.push(activate=u'a'),
+                         [('put', u'a'), ('put', u'b'), ('activate', u'a')])
+        self.assertEqual(self.mailbox.scripts, {'a': 'keep;\r\n',
+                                                'b': 'discard;\r\n'})
+        self.assertEqual(self.mailbox.active, 'a')
+
+        self.assertEqual(self.push(activate=u'a'), [])
+        self.write('b.sieve', 'stop;\r\n')
+        self.assertEqual(self.push(), [('put', u'b')])
+        self.assertEqual(self.mailbox.scripts['b'], 'stop;\r\n')
+        self.assertEqual(self.push(force=True), [('put', u'a'),
+                                                 ('put', u'b')])
+
+    def test_missing_remote_scripts_are_uploaded(self):
+        self.write('a.sieve', 'keep;\r\n')
+        self.push()
+        self.client.delete_script(u'a')
+        self.assertEqual(self.push(), [('put', u'a')])
+
+    def test_delete(self):
+        self.write('a.sieve', 'keep;\r\n')
+        self.write('b.sieve', 'keep;\r\n')
+        self.push(activate=u'b')
+        os.unlink(os.path.join(self.directory, 'b.sieve'))
+
+        self.assertEqual(self.push(), [])
+        # the active script is deleted once another one is activated
+        self.assertEqual(self.push(delete=True, activate=u'a'),
+                         [('activate', u'a'), ('delete', u'b')])
+        self.assertEqual(sorted(self.mailbox.scripts), ['a'])
+        self.assertEqual(self.manifest.scripts('account').keys(), [u'a'])
+
+    def test_failures_are_not_recorded(self):
+        self.server.max_script_size = 10
+        self.write('small.sieve', 'keep;\r\n')
+        self.write('large.sieve', 'keep;\r\n' * 10)
+        result = sync.push(self.client, self.directory, self.manifest,
+                           'account')
+        self.assertEqual([(action, name) for action, name, outcome
+                          in result.failures], [('put', u'large')])
+        self.assertEqual(self.manifest.scripts('account').keys(),
+                         [u'small'])
+
+    def test_minify(self):
+        self.write('a.sieve', '# sort\r\nif true { keep; }\r\n')
+        self.assertEqual(self.push(minify=True), [('put', u'a')])
+        self.assertEqual(self.mailbox.scripts, {'a': 'if true{keep;}\r\n'})
+        # the manifest records the local file
+        self.assertEqual(self.push(minify=True), [])
+
+    def test_validation(self):
+        from managesieve.sieve import SieveError, Validator
+        self.client.validator = Validator()
+        self.write('a.sieve', 'keep;\r\n')
+        self.write('b.sieve', 'keep\r\n')
+        self.assertRaises(SieveError, self.push)
+        # nothing was uploaded
+        self.assertEqual(self.mailbox.scripts, {})
+        self.assertEqual(self.manifest.scripts('account'), {})
+
+    def test_manifest_per_account(self):
+        self.manifest.update('one', {u'a': '1'})
+        self.manifest.update('two', {u'a': '2'})
+        self.manifest.update('one', {u'b': '3'}, deleted=[u'a'])
+        manifest = sync.Manifest(self.manifest.path)
+        self.assertEqual(manifest.scripts('one'), {u'b': '3'})
+        self.assertEqual(manifest.scripts('two'), {u'a': '2'})
+        self.assertEqual(manifest.scripts('three'), {})
+
+    def test_concurrent_updates(self):
+        # as with --all-accounts, each account has its own Manifest object
+        def update(account):
+            manifest = sync.Manifest(self.manifest.path)
+            for i in range(20):
+                manifest.update(account, {u'%d' % i: str(i)})
+        threads = [threading.Thread(target=update, args=('account%d' % n,))
+                   for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for n in range(8):
+            self.assertEqual(len(self.manifest.scripts('account%d' % n)), 20)
+
+
+class PullTest(SyncTestCase):
+
+    def test_pull_all(self):
+        mailbox = self.mailbox
+        mailbox.scripts.update({'a': 'keep;\r\n', 'b': 'discard;\r\n',
+                                '../evil': 'stop;\r\n'})
+        mailbox.active = 'b'
+        result = sync.pull(self.client, self.directory,
+                           manifest=self.manifest, account='account')
+
+        self.assertEqual(result.active, u'b')
+        self.assertEqual([(name, path) for name, path, outcome
+                          in result.scripts],
+                         [(u'../evil', None),
+                          (u'a', os.path.join(self.directory, 'a.sieve')),
+                          (u'b', os.path.join(self.directory, 'b.sieve'))])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['a.sieve', 'b.sieve'])
+        with open(os.path.join(self.directory, 'b.sieve')) as fd:
+            self.assertEqual(fd.read(), 'discard;\r\n')
+        self.assertEqual(len(result.failures), 1)
+        # what was pulled is not pushed back
+        self.assertEqual(self.push(), [])
+
+    def test_pull_names(self):
+        self.mailbox.scripts.update({'a': 'keep;\r\n', 'b': 'keep;\r\n'})
+        result = sync.pull(self.client, self.directory, [u'b', u'missing'])
+        self.assertEqual(os.listdir(self.directory), ['b.sieve'])
+        name, path, outcome = result.scripts[1]
+        self.assertEqual(path, None)
+        self.assertEqual(outcome.error.response.code, 'NONEXISTENT')
+
+    def test_pull_in_batches(self):
+        names = [u's%02d' % i for i in range(10)]
+        for name in names:
+            self.mailbox.scripts[str(name)] = 'keep; # %s\r\n' % name
+        executed = []
+        iter_execute = managesieve.Pipeline.iter_execute
+
+        def record(pipeline):
+            executed.append(len(pipeline))
+            return iter_execute(pipeline)
+        managesieve.Pipeline.iter_execute = record
+        try:
+            result = sync.pull(self.client, self.directory, batch_size=4)
+        finally:
+            managesieve.Pipeline.iter_execute = iter_execute
+        self.assertEqual(executed, [4, 4, 2])
+        self.assertEqual([name for name, path, outcome in result.scripts],
+                         names)
+        self.assertEqual(len(os.listdir(self.directory)), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()